@@ -1,3 +1,67 @@
 from django.contrib import admin
+from django.utils import timezone
 
 # Register your models here.
+from .models import IdempotencyKey, Job, OutboxEvent, StripeEvent, WebhookEndpoint
+
+
+@admin.register(StripeEvent)
+class StripeEventAdmin(admin.ModelAdmin):
+    """Очередь событий Stripe: необработанные события и ошибки обработки"""
+
+    list_display = ('event_id', 'type', 'received_at', 'processed_at', 'attempts')
+    list_filter = ('type', ('processed_at', admin.EmptyFieldListFilter))
+    search_fields = ('event_id',)
+    readonly_fields = ('event_id', 'type', 'payload', 'stripe_created', 'received_at')
+
+
+@admin.register(IdempotencyKey)
+class IdempotencyKeyAdmin(admin.ModelAdmin):
+    """Ключи идемпотентности: выполняющиеся запросы и сохраненные ответы"""
+
+    list_display = ('key', 'scope', 'method', 'path', 'status_code', 'created_at', 'expires_at')
+    list_filter = ('method', 'status_code')
+    search_fields = ('key', 'scope', 'path')
+    readonly_fields = ('scope', 'key', 'fingerprint', 'method', 'path', 'status_code',
+                       'response_headers', 'created_at', 'locked_until', 'expires_at')
+    exclude = ('response_body',)
+
+
+@admin.register(WebhookEndpoint)
+class WebhookEndpointAdmin(admin.ModelAdmin):
+    """Адреса исходящих вебхуков: подписки на события и состояние доставки"""
+
+    list_display = ('url', 'is_active', 'failures', 'next_attempt_at', 'created_at')
+    list_filter = ('is_active',)
+    search_fields = ('url',)
+    readonly_fields = ('created_at', 'failures', 'next_attempt_at', 'last_error')
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    """Исходящие события: очередь доставки и ошибки"""
+
+    list_display = ('event_id', 'type', 'endpoint', 'created_at', 'delivered_at', 'attempts')
+    list_filter = ('type', ('delivered_at', admin.EmptyFieldListFilter))
+    search_fields = ('event_id',)
+    readonly_fields = ('endpoint', 'event_id', 'type', 'payload', 'created_at', 'delivered_at', 'attempts',
+                       'last_error')
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    """Фоновые задачи: очередь, ошибки и повторный запуск"""
+
+    list_display = ('name', 'status', 'priority', 'run_at', 'attempts', 'max_attempts', 'finished_at')
+    list_filter = ('status', 'name')
+    search_fields = ('name', 'key', 'locked_by')
+    readonly_fields = ('attempts', 'locked_by', 'locked_until', 'last_error', 'created_at', 'started_at',
+                       'finished_at')
+    actions = ['retry']
+
+    @admin.action(description='Запустить повторно (задачи с ошибкой)')
+    def retry(self, request, queryset):
+        retried = queryset.filter(status=Job.Status.FAILED).update(
+            status=Job.Status.QUEUED, run_at=timezone.now(), attempts=0, key=None, finished_at=None
+        )
+        self.message_user(request, f'Поставлено в очередь: {retried}')
@@ -2,4 +2,17 @@ from django.apps import AppConfig
 
 
 class ApiConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from . import services  # noqa: F401 (пересоздание клиента Stripe при изменении настроек)
+        from . import signals  # noqa: F401 (исходящие вебхуки)
+        from .deadlines import install_sqlite_progress_handler
+        from .jobs import autodiscover
+
+        connection_created.connect(install_sqlite_progress_handler)
+        # Модули tasks.py всех приложений: задачи регистрируются до первого enqueue
+        autodiscover()
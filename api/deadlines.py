@@ -0,0 +1,255 @@
+"""
+Бюджет времени на обработку запроса (deadline).
+
+Middleware задает для каждого запроса крайний срок. Дальше он соблюдается:
+- в SQLite — через progress handler соединения: долгий запрос прерывается
+  с OperationalError('interrupted'), middleware превращает это в ответ 504
+- в вызовах Stripe — таймаут HTTP-запроса не больше оставшегося бюджета
+  (DeadlineRequestsClient для синхронных вызовов, DeadlineHTTPXClient для async)
+
+Бюджет по умолчанию берется из REQUEST_DEADLINE['DEFAULT'], для отдельных view его можно
+изменить атрибутом класса deadline_budget или декоратором @deadline_budget(секунды).
+Долгие административные операции, которые фиксируют результат частями (импорт
+пользователей), отключают срок через @deadline_budget(NO_DEADLINE): прерванный на середине
+импорт хуже медленного.
+"""
+import asyncio
+import ssl
+import time
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import stripe
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import OperationalError
+from django.http import JsonResponse
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+_deadline = ContextVar('request_deadline', default=None)
+
+# Бюджет view без крайнего срока
+NO_DEADLINE = 0
+
+
+class DeadlineExceeded(APIException):
+    """Бюджет времени запроса исчерпан"""
+    status_code = status.HTTP_504_GATEWAY_TIMEOUT
+    default_detail = 'Превышено время обработки запроса, повторите попытку позже'
+    default_code = 'deadline_exceeded'
+
+
+def remaining():
+    """Сколько секунд осталось до крайнего срока (None — срока нет)"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def expired():
+    """Истек ли крайний срок текущего запроса"""
+    deadline = _deadline.get()
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def check():
+    """Выбрасывает DeadlineExceeded, если бюджет уже исчерпан"""
+    if expired():
+        raise DeadlineExceeded()
+
+
+def cap_timeout(timeout):
+    """Ограничивает таймаут (число или пару connect/read) оставшимся бюджетом"""
+    left = remaining()
+    if left is None:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(min(value, left) for value in timeout)
+    return min(timeout, left)
+
+
+@contextmanager
+def deadline(seconds):
+    """Задает крайний срок для блока кода"""
+    token = _deadline.set(time.monotonic() + seconds if seconds is not None else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def deadline_budget(seconds):
+    """
+    Декоратор: свой бюджет времени для view-функции или действия ViewSet.
+    Для @api_view ставится над ним (внешним декоратором). NO_DEADLINE — без срока.
+    """
+    def decorator(view):
+        view.deadline_budget = seconds
+        return view
+    return decorator
+
+
+def _sqlite_progress_handler():
+    # Ненулевой результат прерывает выполняемый запрос
+    return 1 if expired() else 0
+
+
+def install_sqlite_progress_handler(sender, connection, **kwargs):
+    """Обработчик сигнала connection_created: подключает прерывание запросов по крайнему сроку"""
+    if connection.vendor == 'sqlite':
+        steps = settings.REQUEST_DEADLINE.get('SQLITE_PROGRESS_STEPS', 1000)
+        connection.connection.set_progress_handler(_sqlite_progress_handler, steps)
+
+
+class DeadlineRequestsClient(stripe.RequestsClient):
+    """HTTP-клиент Stripe, у которого таймаут каждого запроса не больше оставшегося бюджета"""
+
+    @property
+    def _timeout(self):
+        return cap_timeout(self._base_timeout)
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self._base_timeout = value
+
+    def _request_internal(self, *args, **kwargs):
+        check()
+        return super()._request_internal(*args, **kwargs)
+
+
+class DeadlineHTTPXClient(stripe.HTTPXClient):
+    """
+    Встроенный клиент Stripe на httpx для async-методов StripeClient, с таймаутом
+    не больше оставшегося бюджета. Соединения httpx привязаны к event loop, в котором
+    открыты, поэтому пул (httpx.AsyncClient) у каждого цикла свой: async_to_sync
+    (WSGI, тесты) запускает каждый вызов в новом цикле.
+    """
+
+    def __init__(self, timeout=80, pool_size=10, **kwargs):
+        self._loop_clients = weakref.WeakKeyDictionary()
+        super().__init__(timeout=timeout, **kwargs)
+        self._limits = self.httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+
+    @property
+    def _timeout(self):
+        timeout = cap_timeout(self._base_timeout)
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return self.httpx.Timeout(read, connect=connect)
+        return timeout
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self._base_timeout = value
+
+    @property
+    def _client_async(self):
+        loop = asyncio.get_running_loop()
+        client = self._loop_clients.get(loop)
+        if client is None:
+            if self._verify_ssl_certs:
+                verify = ssl.create_default_context(cafile=stripe.ca_bundle_path)
+            else:
+                verify = False
+            client = self._loop_clients[loop] = self.httpx.AsyncClient(verify=verify, limits=self._limits)
+        return client
+
+    @_client_async.setter
+    def _client_async(self, client):
+        # Общий клиент из HTTPXClient.__init__ не используется: пул создается для каждого цикла
+        pass
+
+    async def request_async(self, *args, **kwargs):
+        check()
+        return await super().request_async(*args, **kwargs)
+
+    def close(self):
+        """Закрывает пулы работающих циклов (из любого потока); пулы остановленных закроются с ними"""
+        clients, self._loop_clients = self._loop_clients, weakref.WeakKeyDictionary()
+        for loop, client in list(clients.items()):
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+
+    async def close_async(self):
+        client = self._loop_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+def _budget_for_view(view_func, method):
+    """Бюджет из атрибута deadline_budget функции, действия ViewSet или класса view"""
+    budget = getattr(view_func, 'deadline_budget', None)
+    if budget is not None:
+        return budget
+
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return None
+
+    actions = getattr(view_func, 'actions', None) or {}
+    handler = getattr(view_class, actions.get(method.lower(), ''), None)
+    budget = getattr(handler, 'deadline_budget', None)
+    if budget is not None:
+        return budget
+    return getattr(view_class, 'deadline_budget', None)
+
+
+class RequestDeadlineMiddleware:
+    """Задает крайний срок для каждого запроса и превращает прерванные запросы в ответ 504"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        try:
+            return self.get_response(request)
+        finally:
+            self._reset(request)
+
+    async def __acall__(self, request):
+        try:
+            return await self.get_response(request)
+        finally:
+            self._reset(request)
+
+    @staticmethod
+    def _reset(request):
+        token = getattr(request, '_deadline_token', None)
+        if token is not None:
+            try:
+                _deadline.reset(token)
+            except ValueError:
+                # Под ASGI process_view мог выполняться в другом контексте
+                _deadline.set(None)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        budget = _budget_for_view(view_func, request.method)
+        if budget is None:
+            budget = settings.REQUEST_DEADLINE.get('DEFAULT')
+        if budget:
+            request.deadline_budget = budget
+            request._deadline_token = _deadline.set(time.monotonic() + budget)
+        return None
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, OperationalError) and expired():
+            return JsonResponse(
+                {
+                    'error': DeadlineExceeded.default_detail,
+                    'code': DeadlineExceeded.default_code,
+                    'budget': getattr(request, 'deadline_budget', None),
+                },
+                status=status.HTTP_504_GATEWAY_TIMEOUT
+            )
+        return None
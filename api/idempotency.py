@@ -0,0 +1,291 @@
+"""
+Идемпотентность мутирующих запросов по заголовку Idempotency-Key.
+
+Клиент (например, мобильное приложение на плохой сети) повторяет POST с тем же ключом,
+а запрос выполняется один раз: платеж, урок или сессия оплаты Stripe не дублируются.
+
+- Первый запрос с ключом вставляет строку IdempotencyKey — уникальный индекс (владелец, ключ)
+  работает как блокировка: из одновременных дублей запрос выполняет только один
+- Дубль, пришедший, пока запрос выполняется, сразу получает 409 с Retry-After
+- После ответа он сохраняется, и повторы до истечения IDEMPOTENCY['TTL'] получают
+  тот же ответ (с заголовком Idempotent-Replayed) без обращения к view, базе и Stripe
+- Тот же ключ с другим методом, путем или телом — 422 (тело multipart-загрузок хэшируется
+  по частям, без чтения в память)
+- Ошибки сервера (5xx), перегрузка и ответы, зависящие от момента (401, 403, 409, 429),
+  не сохраняются: ключ освобождается, и повтор выполнится заново
+
+Владелец ключа — пользователь из JWT (без запроса к базе) или из сессии. Запросы без
+авторизации ключ не используют: у анонимных клиентов нет общего владельца, и один мог бы
+получить сохраненный ответ другого. Пути IDEMPOTENCY['EXCLUDED_PATHS'] (выдача токенов,
+регистрация) тоже обходят ключ: их ответы с токенами не должны храниться в базе.
+Если воркер упал посреди запроса, блокировку можно перехватить через IDEMPOTENCY['LOCK_TIMEOUT'].
+"""
+import datetime
+import hashlib
+import re
+from functools import lru_cache
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+
+# Ответы, которые не сохраняются: повтор с тем же ключом может дать другой результат
+TRANSIENT_STATUSES = frozenset({
+    status.HTTP_401_UNAUTHORIZED,
+    status.HTTP_403_FORBIDDEN,
+    status.HTTP_408_REQUEST_TIMEOUT,
+    status.HTTP_409_CONFLICT,
+    status.HTTP_429_TOO_MANY_REQUESTS,
+})
+
+# Заголовки ответа, которые воспроизводятся при повторе
+REPLAYED_HEADERS = ('Content-Type', 'Location')
+
+_jwt = JWTAuthentication()
+
+
+def request_scope(request):
+    """Владелец ключа: user:<id> из JWT или сессии; None — без авторизации или токен негоден"""
+    header = _jwt.get_header(request)
+    if header is not None:
+        raw_token = _jwt.get_raw_token(header)
+        if raw_token is None:
+            return None
+        try:
+            token = _jwt.get_validated_token(raw_token)
+        except (InvalidToken, TokenError):
+            # View все равно ответит 401, ключ не нужен
+            return None
+        user_id = token.get(jwt_settings.USER_ID_CLAIM)
+        return f'user:{user_id}' if user_id is not None else None
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return None
+
+
+@lru_cache(maxsize=8)
+def _compile_excluded(patterns):
+    return [re.compile(pattern) for pattern in patterns]
+
+
+def is_excluded(path):
+    """Путь, ответы которого не сохраняются (токены, регистрация)"""
+    patterns = tuple(settings.IDEMPOTENCY.get('EXCLUDED_PATHS', ()))
+    return any(pattern.search(path) for pattern in _compile_excluded(patterns))
+
+
+def _update_multipart(digest, request):
+    """
+    Хэширует поля и файлы multipart-запроса, не читая тело целиком: request.body для загрузок
+    больше DATA_UPLOAD_MAX_MEMORY_SIZE падает с RequestDataTooBig. Файлы разбирает потоковый
+    парсер Django, и хэшируются они по частям; DRF затем берет уже разобранные POST и FILES.
+    """
+    for name, values in sorted(request.POST.lists()):
+        digest.update(name.encode())
+        for value in values:
+            digest.update(b'\0')
+            digest.update(value.encode())
+        digest.update(b'\0')
+    for name, uploads in sorted(request.FILES.lists()):
+        digest.update(name.encode())
+        for upload in uploads:
+            digest.update(b'\0')
+            digest.update((upload.name or '').encode())
+            digest.update(b'\0')
+            for chunk in upload.chunks():
+                digest.update(chunk)
+            upload.seek(0)
+        digest.update(b'\0')
+
+
+def request_fingerprint(request):
+    digest = hashlib.sha256()
+    for part in (request.method, request.get_full_path()):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    if request.content_type == 'multipart/form-data':
+        _update_multipart(digest, request)
+    else:
+        digest.update(request.body)
+    return digest.hexdigest()
+
+
+def _error(message, code, status_code):
+    return JsonResponse({'error': message, 'code': code}, status=status_code)
+
+
+def _in_progress():
+    response = _error(
+        'Запрос с этим Idempotency-Key еще выполняется, повторите позже',
+        'idempotency_key_in_use', status.HTTP_409_CONFLICT
+    )
+    response['Retry-After'] = '1'
+    return response
+
+
+def _replay(record):
+    response = HttpResponse(bytes(record.response_body), status=record.status_code)
+    for name, value in record.response_headers.items():
+        response[name] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def begin(scope, key, fingerprint, request):
+    """
+    Занимает ключ. Возвращает (запись, None), если запрос нужно выполнить,
+    или (None, ответ) — сохраненный ответ либо отказ.
+    """
+    config = settings.IDEMPOTENCY
+    for _ in range(3):
+        now = timezone.now()
+        locked_until = now + datetime.timedelta(seconds=config['LOCK_TIMEOUT'])
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    scope=scope,
+                    key=key,
+                    fingerprint=fingerprint,
+                    method=request.method,
+                    path=request.path[:2048],
+                    locked_until=locked_until,
+                    expires_at=now + datetime.timedelta(seconds=config['TTL']),
+                )
+            return record, None
+        except IntegrityError:
+            pass
+
+        record = IdempotencyKey.objects.filter(scope=scope, key=key).first()
+        if record is None:
+            # Ключ успели освободить — пробуем занять снова
+            continue
+        if record.expires_at <= now:
+            IdempotencyKey.objects.filter(pk=record.pk, expires_at__lte=now).delete()
+            continue
+        if record.fingerprint != fingerprint:
+            return None, _error(
+                'Idempotency-Key уже использован для другого запроса',
+                'idempotency_key_reused', status.HTTP_422_UNPROCESSABLE_ENTITY
+            )
+        if record.status_code is not None:
+            return None, _replay(record)
+        if record.locked_until is not None and record.locked_until > now:
+            return None, _in_progress()
+
+        # Выполнявший запрос воркер не вернулся: перехватываем блокировку условным UPDATE
+        taken = IdempotencyKey.objects.filter(
+            pk=record.pk, status_code__isnull=True, locked_until=record.locked_until
+        ).update(locked_until=locked_until)
+        if taken:
+            return record, None
+        return None, _in_progress()
+    return None, _in_progress()
+
+
+def finish(record, response):
+    """Сохраняет ответ для повторов или освобождает ключ, если ответ сохранять нельзя"""
+    if (
+        response is None or response.streaming
+        or response.status_code >= 500 or response.status_code in TRANSIENT_STATUSES
+    ):
+        release(record)
+        return
+    IdempotencyKey.objects.filter(pk=record.pk).update(
+        status_code=response.status_code,
+        response_body=response.content,
+        response_headers={name: response[name] for name in REPLAYED_HEADERS if response.has_header(name)},
+        locked_until=None,
+    )
+
+
+def release(record):
+    IdempotencyKey.objects.filter(pk=record.pk, status_code__isnull=True).delete()
+
+
+def purge_expired(now=None):
+    """Удаляет истекшие ключи. Возвращает число удаленных"""
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=now or timezone.now()).delete()
+    return deleted
+
+
+class IdempotencyMiddleware:
+    """
+    Выполняет запрос с Idempotency-Key не больше одного раза и воспроизводит его ответ.
+    Стоит до контроля допуска: повтор уже выполненного запроса не занимает слот.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def _key(request):
+        """(владелец, ключ, отпечаток), ответ 400 или None, если ключ не нужен"""
+        key = request.headers.get(HEADER)
+        if key is None or request.method not in settings.IDEMPOTENCY['METHODS'] or is_excluded(request.path):
+            return None
+        key = key.strip()
+        if not key or len(key) > 255:
+            return _error(
+                'Idempotency-Key должен содержать от 1 до 255 символов',
+                'invalid_idempotency_key', status.HTTP_400_BAD_REQUEST
+            )
+        scope = request_scope(request)
+        if scope is None:
+            return None
+        return scope, key, request_fingerprint(request)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        key = self._key(request)
+        if key is None:
+            return self.get_response(request)
+        if isinstance(key, HttpResponse):
+            return key
+
+        record, response = begin(*key, request)
+        if response is not None:
+            return response
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            release(record)
+            raise
+        finish(record, response)
+        return response
+
+    async def __acall__(self, request):
+        key = self._key(request)
+        if key is None:
+            return await self.get_response(request)
+        if isinstance(key, HttpResponse):
+            return key
+
+        record, response = await sync_to_async(begin)(*key, request)
+        if response is not None:
+            return response
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            await sync_to_async(release)(record)
+            raise
+        await sync_to_async(finish)(record, response)
+        return response
@@ -0,0 +1,411 @@
+"""
+Фоновые задачи в очереди базы данных, без отдельного брокера.
+
+Задача — функция, зарегистрированная декоратором @task под именем (модули tasks.py
+приложений подключаются при запуске, как admin.py). enqueue() пишет строку Job в текущей
+транзакции: воркеры увидят задачу только после коммита, а при откате ее не будет.
+Аргументы задачи — JSON (ID объектов, а не сами объекты).
+
+Воркер (Worker, команда run_worker) — несколько потоков; каждый захватывает готовую задачу
+(run_at наступил, сначала больший priority) и выполняет ее:
+- на PostgreSQL и других базах с SELECT ... FOR UPDATE SKIP LOCKED строки захватываются
+  с пропуском заблокированных, и воркеры не ждут друг друга
+- на SQLite блокировок строк нет: задача захватывается одним UPDATE ... WHERE id IN
+  (SELECT ... LIMIT n) с уникальным токеном, а запись в SQLite всегда одна на базу,
+  поэтому одну задачу не захватят двое
+- ошибка возвращает задачу в очередь через BACKOFF_BASE * 2^(попытка - 1) секунд
+  (не больше BACKOFF_MAX), после max_attempts попыток задача остается со статусом failed
+- захват действует LEASE секунд: задачу упавшего воркера вернет в очередь requeue_stale
+
+Задачи с одинаковым key не дублируются, пока одна из них ждет в очереди. Задачи
+exclusive=True (например, обработка очереди событий Stripe) ставятся в очередь в одном
+экземпляре и выполняются под блокировкой lock(имя задачи): ее же берут команды, делающие
+ту же работу. Если блокировку держит другой, задача откладывается без траты попытки.
+Блокировка действует, как и захват, lease секунд, поэтому exclusive-задача должна делать
+ограниченную порцию работы и ставить себя в очередь снова, если работа осталась.
+"""
+import datetime
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, OperationalError, connections, router, transaction
+from django.db.models import Case, Count, F, Min, Q, Value, When
+from django.utils import timezone
+from django.utils.module_loading import autodiscover_modules
+
+from .models import Job, JobLock
+
+logger = logging.getLogger(__name__)
+
+Task = namedtuple('Task', 'name func priority max_attempts exclusive lease')
+
+# Сколько раз повторять запись очереди, если база занята другим писателем (SQLite)
+LOCKED_RETRIES = 20
+
+_registry = {}
+
+
+def task(name, priority=0, max_attempts=None, exclusive=False, lease=None):
+    """
+    Регистрирует функцию как задачу name. lease — сколько секунд задача может
+    выполняться, прежде чем ее сочтут брошенной (по умолчанию JOBS['LEASE']).
+    """
+    def decorator(func):
+        if name in _registry and _registry[name].func is not func:
+            raise ValueError(f'Задача {name} уже зарегистрирована')
+        _registry[name] = Task(name, func, priority, max_attempts, exclusive, lease)
+        return func
+    return decorator
+
+
+def autodiscover():
+    autodiscover_modules('tasks')
+
+
+def registered():
+    return dict(_registry)
+
+
+def enqueue(name, args=(), kwargs=None, key=None, priority=None, delay=0, max_attempts=None):
+    """
+    Ставит задачу name в очередь в текущей транзакции; delay — через сколько секунд ее выполнить.
+    Если задача с тем же key уже ждет в очереди, новая не добавляется.
+    """
+    registered_task = _registry.get(name)
+    if registered_task is None:
+        raise LookupError(f'Задача {name} не зарегистрирована')
+    if registered_task.exclusive and key is None:
+        key = name
+    job = Job(
+        name=name,
+        args=list(args),
+        kwargs=kwargs or {},
+        key=key,
+        priority=registered_task.priority if priority is None else priority,
+        run_at=timezone.now() + datetime.timedelta(seconds=delay),
+        max_attempts=max_attempts or registered_task.max_attempts or settings.JOBS['MAX_ATTEMPTS'],
+    )
+    Job.objects.bulk_create([job], ignore_conflicts=key is not None)
+
+
+def backoff(attempts):
+    """Пауза перед повтором после attempts попыток, секунды"""
+    config = settings.JOBS
+    delay = min(config['BACKOFF_MAX'], config['BACKOFF_BASE'] * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+def _retry_locked(func):
+    """Выполняет запись очереди, повторяя ее с короткой паузой, пока база заблокирована"""
+    for attempt in range(LOCKED_RETRIES):
+        try:
+            return func()
+        except OperationalError as e:
+            if 'locked' not in str(e) or attempt == LOCKED_RETRIES - 1:
+                raise
+            time.sleep(random.uniform(0.005, 0.02) * (attempt + 1))
+
+
+class LockHeld(Exception):
+    """Блокировку держит другой владелец"""
+
+
+def acquire_lock(name, owner, ttl=None):
+    """
+    Берет блокировку name для owner на ttl секунд (по умолчанию JOBS['LEASE']).
+    Своя или истекшая блокировка перехватывается. Возвращает True, если блокировка взята.
+    """
+    def acquire():
+        now = timezone.now()
+        expires_at = now + datetime.timedelta(seconds=ttl or settings.JOBS['LEASE'])
+        taken = JobLock.objects.filter(name=name).filter(Q(owner=owner) | Q(expires_at__lt=now)).update(
+            owner=owner, expires_at=expires_at
+        )
+        if taken:
+            return True
+        try:
+            with transaction.atomic(using=router.db_for_write(JobLock)):
+                JobLock.objects.create(name=name, owner=owner, expires_at=expires_at)
+        except IntegrityError:
+            return False
+        return True
+    return _retry_locked(acquire)
+
+
+def release_lock(name, owner):
+    _retry_locked(lambda: JobLock.objects.filter(name=name, owner=owner).delete())
+
+
+@contextmanager
+def lock(name, ttl=None):
+    """
+    Блокировка name на время блока; LockHeld, если ее держит другой. Блок получает функцию
+    продления: ее вызывают между порциями работы, она выбрасывает LockHeld, если блокировку
+    перехватили после истечения.
+    """
+    owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:12]}'[-100:]
+    if not acquire_lock(name, owner, ttl):
+        raise LockHeld(name)
+
+    def renew():
+        if not acquire_lock(name, owner, ttl):
+            raise LockHeld(name)
+
+    try:
+        yield renew
+    finally:
+        release_lock(name, owner)
+
+
+def _ready(now):
+    """Готовые к выполнению задачи в порядке выполнения"""
+    ready = Job.objects.filter(status=Job.Status.QUEUED, run_at__lte=now)
+    exclusive = [name for name, registered_task in _registry.items() if registered_task.exclusive]
+    if exclusive:
+        running = Job.objects.filter(status=Job.Status.RUNNING, name__in=exclusive).values('name')
+        ready = ready.exclude(name__in=running)
+    return ready.order_by('-priority', 'run_at', 'id')
+
+
+def _lease(now):
+    """Срок захвата: JOBS['LEASE'] или lease задачи"""
+    default = now + datetime.timedelta(seconds=settings.JOBS['LEASE'])
+    custom = [
+        When(name=name, then=Value(now + datetime.timedelta(seconds=registered_task.lease)))
+        for name, registered_task in _registry.items() if registered_task.lease
+    ]
+    return Case(*custom, default=Value(default)) if custom else default
+
+
+def claim(worker, limit=1):
+    """Захватывает до limit готовых задач для воркера worker. Возвращает список Job"""
+    return _retry_locked(lambda: _claim(worker, limit))
+
+
+def _claim(worker, limit):
+    now = timezone.now()
+    token = f'{worker}:{uuid.uuid4().hex[:12]}'[-100:]
+    values = {
+        'status': Job.Status.RUNNING,
+        'locked_by': token,
+        'locked_until': _lease(now),
+        'started_at': now,
+        'attempts': F('attempts') + 1,
+    }
+
+    alias = router.db_for_write(Job)
+    if connections[alias].features.has_select_for_update_skip_locked:
+        with transaction.atomic(using=alias):
+            pks = list(_ready(now).select_for_update(skip_locked=True).values_list('pk', flat=True)[:limit])
+            if not pks:
+                return []
+            Job.objects.filter(pk__in=pks).update(**values)
+    else:
+        # Один UPDATE: выбор и захват строк не разделены, второй воркер ждет конца записи
+        claimed = Job.objects.filter(
+            pk__in=_ready(now).values('pk')[:limit], status=Job.Status.QUEUED
+        ).update(**values)
+        if not claimed:
+            return []
+    return list(Job.objects.filter(locked_by=token).order_by('-priority', 'run_at', 'id'))
+
+
+def _finish(job, **values):
+    """Записывает результат, если задачу не перехватили после истечения захвата"""
+    return _retry_locked(
+        lambda: Job.objects.filter(pk=job.pk, locked_by=job.locked_by, status=Job.Status.RUNNING).update(
+            locked_until=None, **values
+        )
+    )
+
+
+def _fail(job, error):
+    now = timezone.now()
+    if job.attempts >= job.max_attempts:
+        logger.error('Задача %s #%s: %s (попыток больше нет)', job.name, job.pk, error)
+        return _finish(job, status=Job.Status.FAILED, finished_at=now, last_error=error)
+    values = {
+        'status': Job.Status.QUEUED,
+        'run_at': now + datetime.timedelta(seconds=backoff(job.attempts)),
+        'last_error': error,
+    }
+    try:
+        with transaction.atomic(using=router.db_for_write(Job)):
+            return _finish(job, **values)
+    except IntegrityError:
+        # Пока задача выполнялась, в очередь встала такая же: повтор идет без ключа
+        return _finish(job, key=None, **values)
+
+
+def _postpone(job):
+    """Возвращает задачу в очередь без траты попытки: ее блокировку держит другой"""
+    values = {
+        'status': Job.Status.QUEUED,
+        'run_at': timezone.now() + datetime.timedelta(seconds=max(1, settings.JOBS['POLL_INTERVAL'])),
+        'attempts': F('attempts') - 1,
+    }
+    try:
+        with transaction.atomic(using=router.db_for_write(Job)):
+            return _finish(job, **values)
+    except IntegrityError:
+        # Такая же задача уже ждет в очереди и сделает ту же работу
+        return _finish(job, status=Job.Status.DONE, finished_at=timezone.now())
+
+
+def run(job):
+    """
+    Выполняет захваченную задачу и записывает результат. Возвращает True при успехе,
+    False при ошибке и None, если exclusive-задача отложена из-за чужой блокировки.
+    """
+    registered_task = _registry.get(job.name)
+    exclusive = registered_task is not None and registered_task.exclusive
+    if exclusive and not acquire_lock(job.name, job.locked_by, registered_task.lease):
+        logger.info('Задача %s #%s отложена: блокировку держит другой процесс', job.name, job.pk)
+        _postpone(job)
+        return None
+    try:
+        if registered_task is None:
+            raise LookupError(f'Задача {job.name} не зарегистрирована')
+        registered_task.func(*job.args, **job.kwargs)
+    except Exception as e:
+        logger.warning('Задача %s #%s завершилась ошибкой', job.name, job.pk, exc_info=True)
+        _fail(job, f'{type(e).__name__}: {e}')
+        return False
+    finally:
+        if exclusive:
+            release_lock(job.name, job.locked_by)
+    _finish(job, status=Job.Status.DONE, finished_at=timezone.now(), last_error='')
+    return True
+
+
+def run_ready(worker=None, stop=None):
+    """
+    Выполняет готовые задачи в текущем потоке, пока они есть (или пока не выставлено
+    событие stop). Возвращает (выполнено, с ошибкой)
+    """
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}/{threading.get_ident()}'
+    done = failed = 0
+    while stop is None or not stop.is_set():
+        jobs = claim(worker)
+        if not jobs:
+            break
+        for job in jobs:
+            result = run(job)
+            if result:
+                done += 1
+            elif result is False:
+                failed += 1
+    return done, failed
+
+
+def requeue_stale(now=None):
+    """Возвращает в очередь задачи, захват которых истек (воркер упал). Возвращает их число"""
+    stale = Job.objects.filter(status=Job.Status.RUNNING, locked_until__lt=now or timezone.now())
+    return sum(_fail(job, 'Воркер не завершил задачу до истечения захвата') for job in stale)
+
+
+def purge_finished(days=None):
+    """Удаляет выполненные задачи старше RETENTION_DAYS дней. Возвращает число удаленных"""
+    days = settings.JOBS['RETENTION_DAYS'] if days is None else days
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    deleted, _ = Job.objects.filter(status=Job.Status.DONE, finished_at__lt=cutoff).delete()
+    return deleted
+
+
+def stats(now=None):
+    """Состояние очереди: задачи по статусам и именам, готовые, отложенные и брошенные"""
+    now = now or timezone.now()
+    statuses = dict.fromkeys(Job.Status.values, 0)
+    tasks = {}
+    for row in Job.objects.order_by().values('name', 'status').annotate(count=Count('id')):
+        statuses[row['status']] += row['count']
+        tasks.setdefault(row['name'], dict.fromkeys(Job.Status.values, 0))[row['status']] = row['count']
+    queue = Job.objects.aggregate(
+        ready=Count('id', filter=Q(status=Job.Status.QUEUED, run_at__lte=now)),
+        scheduled=Count('id', filter=Q(status=Job.Status.QUEUED, run_at__gt=now)),
+        stale=Count('id', filter=Q(status=Job.Status.RUNNING, locked_until__lt=now)),
+        oldest_ready=Min('run_at', filter=Q(status=Job.Status.QUEUED, run_at__lte=now)),
+    )
+    oldest_ready = queue.pop('oldest_ready')
+    return {
+        'statuses': statuses,
+        **queue,
+        # Сколько ждет самая старая готовая задача: растет, если воркеров не хватает
+        'oldest_ready_age': round((now - oldest_ready).total_seconds(), 3) if oldest_ready else None,
+        'tasks': tasks,
+    }
+
+
+class Worker:
+    """
+    Потоки, выполняющие задачи очереди. run() возвращает (выполнено, с ошибкой),
+    когда вызван stop() или, с burst=True, когда готовых задач не осталось.
+    Основной поток раз в JOBS['MAINTENANCE_INTERVAL'] секунд возвращает брошенные задачи
+    в очередь и удаляет старые выполненные.
+    """
+
+    def __init__(self, threads=None, poll_interval=None, name=None):
+        config = settings.JOBS
+        self.threads = threads or config['THREADS']
+        self.poll_interval = config['POLL_INTERVAL'] if poll_interval is None else poll_interval
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.done = self.failed = 0
+
+    def stop(self):
+        self._stopping.set()
+
+    def maintain(self):
+        requeued = requeue_stale()
+        purged = purge_finished()
+        if requeued or purged:
+            logger.info('Очередь задач: возвращено брошенных %s, удалено выполненных %s', requeued, purged)
+
+    def _loop(self, index, burst):
+        worker = f'{self.name}/{index}'
+        try:
+            while not self._stopping.is_set():
+                try:
+                    done, failed = run_ready(worker, self._stopping)
+                except DatabaseError:
+                    # Задача, результат которой не записался, вернется в очередь после LEASE
+                    logger.exception('Воркер %s: ошибка базы очереди задач', worker)
+                    self._stopping.wait(self.poll_interval)
+                    continue
+                with self._lock:
+                    self.done += done
+                    self.failed += failed
+                if burst:
+                    return
+                self._stopping.wait(self.poll_interval)
+        finally:
+            # Соединения потока с базой не переживают поток
+            connections.close_all()
+
+    def run(self, burst=False):
+        interval = settings.JOBS['MAINTENANCE_INTERVAL']
+        self.maintain()
+        threads = [
+            threading.Thread(target=self._loop, args=(index, burst), name=f'job-worker-{index}', daemon=True)
+            for index in range(self.threads)
+        ]
+        for thread in threads:
+            thread.start()
+        next_maintenance = time.monotonic() + interval
+        while True:
+            alive = [thread for thread in threads if thread.is_alive()]
+            if not alive:
+                return self.done, self.failed
+            alive[0].join(timeout=max(0, next_maintenance - time.monotonic()))
+            if not burst and time.monotonic() >= next_maintenance:
+                self.maintain()
+                next_maintenance = time.monotonic() + interval
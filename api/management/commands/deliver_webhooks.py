@@ -0,0 +1,65 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.jobs import LockHeld, lock
+from api.outbox import Deliverer, purge_delivered
+
+
+class Command(BaseCommand):
+    help = (
+        'Доставка исходящих вебхуков партнерам: пачками, параллельно по адресам. '
+        'Работает под той же блокировкой, что и задача api.deliver_webhooks'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Сколько событий адреса отправлять одним запросом (по умолчанию OUTBOUND_WEBHOOKS[\'BATCH_SIZE\'])'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Сколько адресов обслуживать одновременно (по умолчанию OUTBOUND_WEBHOOKS[\'WORKERS\'])'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Не завершаться: после опустошения очереди ждать новые события'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1.0,
+            help='Пауза между проверками очереди в режиме --loop, секунды (по умолчанию 1)'
+        )
+
+    def handle(self, *args, **options):
+        for name in ('batch_size', 'workers'):
+            if options[name] is not None and options[name] < 1:
+                raise CommandError(f'--{name.replace("_", "-")} должен быть положительным')
+        if options['interval'] <= 0:
+            raise CommandError('--interval должен быть положительным')
+
+        with Deliverer(options['batch_size'], options['workers']) as deliverer:
+            while True:
+                try:
+                    with lock('api.deliver_webhooks') as renew:
+                        delivered, failed = deliverer.deliver(on_round=lambda *totals: renew())
+                except LockHeld:
+                    if not options['loop']:
+                        raise CommandError('Вебхуки уже доставляет другой процесс')
+                    time.sleep(options['interval'])
+                    continue
+                purged = purge_delivered()
+                if delivered or failed or purged or not options['loop']:
+                    self.stdout.write(self.style.SUCCESS(
+                        f'Доставлено событий: {delivered}, неудачных пачек: {failed}, '
+                        f'удалено старых: {purged}'
+                    ))
+                if not options['loop']:
+                    return
+                time.sleep(options['interval'])
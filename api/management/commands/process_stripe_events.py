@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.jobs import LockHeld, lock
+from api.webhooks import process_events
+
+
+class Command(BaseCommand):
+    help = (
+        'Обработка очереди событий Stripe: создание и подтверждение платежей по оплаченным сессиям. '
+        'Работает под той же блокировкой, что и задача api.process_stripe_events'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Сколько событий обрабатывать в одной транзакции (по умолчанию STRIPE_EVENTS[\'BATCH_SIZE\'])'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Не завершаться: после опустошения очереди ждать новые события'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1.0,
+            help='Пауза между проверками очереди в режиме --loop, секунды (по умолчанию 1)'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть положительным')
+        if options['interval'] <= 0:
+            raise CommandError('--interval должен быть положительным')
+
+        while True:
+            try:
+                with lock('api.process_stripe_events') as renew:
+                    events, created, confirmed = process_events(
+                        options['batch_size'], on_batch=lambda *totals: renew()
+                    )
+            except LockHeld:
+                if not options['loop']:
+                    raise CommandError('Очередь событий Stripe уже обрабатывает другой процесс')
+                time.sleep(options['interval'])
+                continue
+            if events or not options['loop']:
+                self.stdout.write(self.style.SUCCESS(
+                    f'Обработано событий: {events}, создано платежей: {created}, подтверждено: {confirmed}'
+                ))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
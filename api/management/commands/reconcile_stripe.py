@@ -0,0 +1,105 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api.reconciliation import reconcile
+
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'Некорректная дата: {value} (ожидается ГГГГ-ММ-ДД)')
+
+
+class Command(BaseCommand):
+    help = 'Сверка платежей с оплаченными сессиями Checkout и PaymentIntent в Stripe за период'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since',
+            default=None,
+            help='Начало периода, ГГГГ-ММ-ДД (по умолчанию вчера)'
+        )
+        parser.add_argument(
+            '--until',
+            default=None,
+            help='Конец периода не включительно, ГГГГ-ММ-ДД (по умолчанию сегодня)'
+        )
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Подтвердить платежи, оплаченные в Stripe, но не подтвержденные в базе'
+        )
+        parser.add_argument(
+            '--slices',
+            type=int,
+            default=None,
+            help='На сколько интервалов делить период (по умолчанию STRIPE_RECONCILE[\'SLICES\'])'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Число потоков для запросов к Stripe (по умолчанию STRIPE_RECONCILE[\'WORKERS\'])'
+        )
+        parser.add_argument(
+            '--rate',
+            default=None,
+            help='Лимит запросов к Stripe, например 25/s (по умолчанию STRIPE_RECONCILE[\'RATE\'])'
+        )
+        parser.add_argument(
+            '--show',
+            type=int,
+            default=20,
+            help='Сколько расхождений каждого вида вывести (по умолчанию 20)'
+        )
+
+    def handle(self, *args, **options):
+        for name in ('slices', 'workers'):
+            if options[name] is not None and options[name] < 1:
+                raise CommandError(f'--{name} должен быть положительным')
+
+        today = timezone.localdate()
+        since = parse_date(options['since']) if options['since'] else today - datetime.timedelta(days=1)
+        until = parse_date(options['until']) if options['until'] else today
+        if since >= until:
+            raise CommandError('--since должен быть раньше --until')
+
+        started = time.monotonic()
+        report = reconcile(
+            timezone.make_aware(datetime.datetime.combine(since, datetime.time.min)),
+            timezone.make_aware(datetime.datetime.combine(until, datetime.time.min)),
+            fix=options['fix'],
+            slices=options['slices'],
+            workers=options['workers'],
+            rate=options['rate'],
+        )
+        self.stdout.write(
+            f'Период {since} — {until}: в Stripe {report.remote}, в базе {report.local}, '
+            f'страниц Stripe {report.pages}, {time.monotonic() - started:.1f} с'
+        )
+
+        show = options['show']
+        sections = (
+            ('Нет в базе', report.missing, lambda row: f'{row[0]}: {row[1]}'),
+            ('Нет в Stripe', report.extra, lambda row: f'платеж {row[0]} ({row[1]}): {row[2]}'),
+            ('Суммы расходятся', report.mismatched,
+             lambda row: f'платеж {row[0]} ({row[1]}): в базе {row[2]}, в Stripe {row[3]}'),
+            ('Не подтверждены', report.unconfirmed, lambda row: f'платеж {row[0]} ({row[1]})'),
+        )
+        for title, rows, describe in sections:
+            if not rows:
+                continue
+            self.stdout.write(self.style.WARNING(f'{title}: {len(rows)}'))
+            for row in rows[:show]:
+                self.stdout.write(f'  {describe(row)}')
+            if len(rows) > show:
+                self.stdout.write(f'  ... и еще {len(rows) - show}')
+
+        if options['fix'] and report.unconfirmed:
+            self.stdout.write(self.style.SUCCESS(f'Подтверждено платежей: {report.fixed}'))
+        if report.ok:
+            self.stdout.write(self.style.SUCCESS('Расхождений нет'))
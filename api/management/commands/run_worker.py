@@ -0,0 +1,47 @@
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import jobs
+
+
+class Command(BaseCommand):
+    help = 'Воркер фоновых задач (api.jobs): несколько потоков выполняют задачи из очереди в базе'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=None,
+            help='Сколько задач выполнять одновременно (по умолчанию JOBS[\'THREADS\']). '
+                 'Для нескольких процессов запустите несколько воркеров'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=None,
+            help='Пауза между проверками пустой очереди, секунды (по умолчанию JOBS[\'POLL_INTERVAL\'])'
+        )
+        parser.add_argument(
+            '--burst',
+            action='store_true',
+            help='Выполнить готовые задачи и завершиться'
+        )
+
+    def handle(self, *args, **options):
+        if options['threads'] is not None and options['threads'] < 1:
+            raise CommandError('--threads должен быть положительным')
+        if options['poll_interval'] is not None and options['poll_interval'] <= 0:
+            raise CommandError('--poll-interval должен быть положительным')
+
+        worker = jobs.Worker(options['threads'], options['poll_interval'])
+        if not options['burst']:
+            # Текущие задачи дорабатываются, новые не берутся
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *_: worker.stop())
+            self.stdout.write(
+                f'Воркер {worker.name}: потоков {worker.threads}, задачи: {", ".join(sorted(jobs.registered()))}'
+            )
+
+        done, failed = worker.run(burst=options['burst'])
+        self.stdout.write(self.style.SUCCESS(f'Выполнено задач: {done}, с ошибкой: {failed}'))
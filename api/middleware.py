@@ -0,0 +1,253 @@
+import re
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import JsonResponse
+
+
+class EndpointClass:
+    """Класс эндпоинтов со своим лимитом одновременных запросов и очередью"""
+
+    def __init__(self, name, paths, limit, queue, timeout, priority=0):
+        self.name = name
+        self.patterns = [re.compile(path) for path in paths]
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.priority = priority
+
+        # Текущее состояние
+        self.in_flight = 0
+        self.waiting = 0
+
+        # Накопительная статистика
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.peak_in_flight = 0
+
+    def matches(self, path):
+        return any(pattern.search(path) for pattern in self.patterns)
+
+    def stats(self):
+        return {
+            'priority': self.priority,
+            'limit': self.limit,
+            'queue': self.queue,
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'peak_in_flight': self.peak_in_flight,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+        }
+
+
+class AdmissionController:
+    """
+    Ограничивает число одновременных запросов по классам эндпоинтов.
+
+    - Если у класса есть свободный слот — запрос проходит сразу
+    - Иначе он ждет в короткой очереди ограниченного размера не дольше timeout
+    - Если очередь заполнена или время ожидания вышло — быстрый отказ (503)
+
+    Приоритет: общий лимит MAX_IN_FLIGHT делится между всеми классами, причем последние
+    RESERVED слотов доступны только приоритетным классам (оплата), а пока приоритетный
+    запрос ждет общего слота, менее приоритетные не занимают освободившиеся слоты.
+    """
+
+    def __init__(self, classes, max_in_flight, reserved=0):
+        self.classes = classes
+        self.max_in_flight = max_in_flight
+        self.reserved = reserved
+        self.top_priority = max((cls.priority for cls in classes), default=0)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_settings(cls, config):
+        classes = [
+            EndpointClass(name, **options)
+            for name, options in config.get('CLASSES', {}).items()
+        ]
+        return cls(classes, config.get('MAX_IN_FLIGHT', 100), config.get('RESERVED', 0))
+
+    def classify(self, path):
+        """Класс эндпоинта по пути запроса (первый подходящий) или None"""
+        for endpoint_class in self.classes:
+            if endpoint_class.matches(path):
+                return endpoint_class
+        return None
+
+    def _can_admit(self, endpoint_class):
+        if endpoint_class.in_flight >= endpoint_class.limit:
+            return False
+
+        global_limit = self.max_in_flight
+        if endpoint_class.priority < self.top_priority:
+            global_limit -= self.reserved
+        if self.in_flight >= global_limit:
+            return False
+
+        # Уступаем место более приоритетным запросам, которые ждут общего слота. Запрос,
+        # который ждет только из-за лимита своего класса, наш слот бы не занял
+        return not any(
+            other.waiting and other.priority > endpoint_class.priority and other.in_flight < other.limit
+            for other in self.classes
+        )
+
+    def _admit(self, endpoint_class):
+        endpoint_class.in_flight += 1
+        endpoint_class.admitted += 1
+        endpoint_class.peak_in_flight = max(endpoint_class.peak_in_flight, endpoint_class.in_flight)
+        self.in_flight += 1
+
+    def try_acquire(self, endpoint_class):
+        """Занимает слот, только если он свободен прямо сейчас (без ожидания в очереди)"""
+        with self._condition:
+            if self._can_admit(endpoint_class):
+                self._admit(endpoint_class)
+                return True
+            return False
+
+    def acquire(self, endpoint_class):
+        """Занимает слот. Возвращает False, если запрос нужно отклонить"""
+        with self._condition:
+            if self._can_admit(endpoint_class):
+                self._admit(endpoint_class)
+                return True
+
+            if endpoint_class.waiting >= endpoint_class.queue:
+                endpoint_class.rejected += 1
+                return False
+
+            endpoint_class.waiting += 1
+            endpoint_class.queued += 1
+            deadline = time.monotonic() + endpoint_class.timeout
+            try:
+                while not self._can_admit(endpoint_class):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        endpoint_class.timed_out += 1
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                endpoint_class.waiting -= 1
+                # Наш уход из очереди мог разблокировать менее приоритетные запросы
+                self._condition.notify_all()
+
+            self._admit(endpoint_class)
+            return True
+
+    def release(self, endpoint_class):
+        with self._condition:
+            endpoint_class.in_flight -= 1
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'max_in_flight': self.max_in_flight,
+                'reserved': self.reserved,
+                'in_flight': self.in_flight,
+                'classes': {cls.name: cls.stats() for cls in self.classes},
+            }
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """Общий для процесса контроллер, собранный по настройкам ADMISSION_CONTROL"""
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController.from_settings(settings.ADMISSION_CONTROL)
+    return _controller
+
+
+@receiver(setting_changed)
+def reset_admission_controller(setting, **kwargs):
+    global _controller
+    if setting == 'ADMISSION_CONTROL':
+        _controller = None
+
+
+class AdmissionControlMiddleware:
+    """
+    Контроль допуска запросов: при всплесках нагрузки лишние запросы быстро получают 503
+    с заголовком Retry-After вместо того, чтобы замедлять всех остальных.
+
+    Работает и под WSGI, и под ASGI: в async-режиме свободный слот занимается сразу,
+    а ожидание в очереди (блокирующее) уходит в отдельный поток и не держит event loop.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def _classify(request):
+        """Контроллер и класс эндпоинта запроса или (None, None), если контроль не нужен"""
+        if not settings.ADMISSION_CONTROL.get('ENABLED', True):
+            return None, None
+        controller = get_admission_controller()
+        return controller, controller.classify(request.path)
+
+    @staticmethod
+    def _reject(endpoint_class):
+        response = JsonResponse(
+            {
+                'error': 'Сервер перегружен, повторите запрос позже',
+                'endpoint_class': endpoint_class.name,
+            },
+            status=503
+        )
+        response['Retry-After'] = str(settings.ADMISSION_CONTROL.get('RETRY_AFTER', 1))
+        return response
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        controller, endpoint_class = self._classify(request)
+        if endpoint_class is None:
+            return self.get_response(request)
+
+        if not controller.acquire(endpoint_class):
+            return self._reject(endpoint_class)
+
+        try:
+            return self.get_response(request)
+        finally:
+            controller.release(endpoint_class)
+
+    async def __acall__(self, request):
+        controller, endpoint_class = self._classify(request)
+        if endpoint_class is None:
+            return await self.get_response(request)
+
+        admitted = controller.try_acquire(endpoint_class) or await sync_to_async(
+            controller.acquire, thread_sensitive=False
+        )(endpoint_class)
+        if not admitted:
+            return self._reject(endpoint_class)
+
+        try:
+            return await self.get_response(request)
+        finally:
+            controller.release(endpoint_class)
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True, verbose_name='ID события в Stripe')),
+                ('type', models.CharField(max_length=100, verbose_name='тип события')),
+                ('payload', models.JSONField(help_text='Событие в том виде, в каком его прислал Stripe', verbose_name='событие')),
+                ('stripe_created', models.PositiveBigIntegerField(default=0, verbose_name='создано в Stripe')),
+                ('received_at', models.DateTimeField(auto_now_add=True, verbose_name='получено')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='обработано')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='попыток обработки')),
+                ('last_error', models.TextField(blank=True, verbose_name='последняя ошибка')),
+            ],
+            options={
+                'verbose_name': 'событие Stripe',
+                'verbose_name_plural': 'события Stripe',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['processed_at', 'id'], name='api_stripee_process_f5eedc_idx')],
+            },
+        ),
+    ]
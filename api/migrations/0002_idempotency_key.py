@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_stripe_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=64, verbose_name='владелец ключа')),
+                ('key', models.CharField(max_length=255, verbose_name='ключ')),
+                ('fingerprint', models.CharField(max_length=64, verbose_name='отпечаток запроса')),
+                ('method', models.CharField(max_length=10, verbose_name='метод')),
+                ('path', models.CharField(max_length=2048, verbose_name='путь')),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='код ответа')),
+                ('response_body', models.BinaryField(default=b'', verbose_name='тело ответа')),
+                ('response_headers', models.JSONField(default=dict, verbose_name='заголовки ответа')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='создан')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='заблокирован до')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='истекает')),
+            ],
+            options={
+                'verbose_name': 'ключ идемпотентности',
+                'verbose_name_plural': 'ключи идемпотентности',
+                'constraints': [models.UniqueConstraint(fields=('scope', 'key'), name='unique_idempotency_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:55
+
+import api.models
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEndpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(max_length=500, verbose_name='адрес')),
+                ('secret', models.CharField(default=api.models.generate_webhook_secret, help_text='Тело запроса подписывается HMAC-SHA256 в заголовке Webhook-Signature', max_length=64, verbose_name='секрет подписи')),
+                ('event_types', models.JSONField(blank=True, default=list, help_text='Например ["payment.created", "course.updated"]; пустой список — все события', verbose_name='типы событий')),
+                ('is_active', models.BooleanField(default=True, verbose_name='активен')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='создан')),
+                ('failures', models.PositiveIntegerField(default=0, verbose_name='ошибок подряд')),
+                ('next_attempt_at', models.DateTimeField(blank=True, null=True, verbose_name='следующая попытка')),
+                ('last_error', models.TextField(blank=True, verbose_name='последняя ошибка')),
+            ],
+            options={
+                'verbose_name': 'адрес вебхуков',
+                'verbose_name_plural': 'адреса вебхуков',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.UUIDField(default=uuid.uuid4, verbose_name='ID события')),
+                ('type', models.CharField(max_length=100, verbose_name='тип события')),
+                ('payload', models.JSONField(verbose_name='данные')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='создано')),
+                ('delivered_at', models.DateTimeField(blank=True, null=True, verbose_name='доставлено')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='попыток доставки')),
+                ('last_error', models.TextField(blank=True, verbose_name='последняя ошибка')),
+                ('endpoint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='api.webhookendpoint', verbose_name='адрес')),
+            ],
+            options={
+                'verbose_name': 'исходящее событие',
+                'verbose_name_plural': 'исходящие события',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['endpoint', 'delivered_at', 'id'], name='api_outboxe_endpoin_46d810_idx')],
+            },
+        ),
+    ]
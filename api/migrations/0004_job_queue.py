@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:03
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_outbound_webhooks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='задача')),
+                ('args', models.JSONField(blank=True, default=list, verbose_name='позиционные аргументы')),
+                ('kwargs', models.JSONField(blank=True, default=dict, verbose_name='именованные аргументы')),
+                ('key', models.CharField(blank=True, max_length=255, null=True, verbose_name='ключ')),
+                ('priority', models.SmallIntegerField(default=0, help_text='Больше — раньше', verbose_name='приоритет')),
+                ('status', models.CharField(choices=[('queued', 'в очереди'), ('running', 'выполняется'), ('done', 'выполнена'), ('failed', 'ошибка')], default='queued', max_length=10, verbose_name='статус')),
+                ('run_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='выполнить после')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='попыток')),
+                ('max_attempts', models.PositiveIntegerField(default=5, verbose_name='максимум попыток')),
+                ('locked_by', models.CharField(blank=True, max_length=100, verbose_name='захвачена воркером')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='захвачена до')),
+                ('last_error', models.TextField(blank=True, verbose_name='последняя ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='создана')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='начата')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='завершена')),
+            ],
+            options={
+                'verbose_name': 'фоновая задача',
+                'verbose_name_plural': 'фоновые задачи',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['status', '-priority', 'run_at', 'id'], name='api_job_status_a39c7f_idx'), models.Index(fields=['locked_by'], name='api_job_locked__726526_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status', 'queued')), fields=('key',), name='unique_queued_job_key')],
+            },
+        ),
+    ]
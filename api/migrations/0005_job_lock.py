@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_job_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='имя')),
+                ('owner', models.CharField(max_length=100, verbose_name='владелец')),
+                ('expires_at', models.DateTimeField(verbose_name='действует до')),
+            ],
+            options={
+                'verbose_name': 'блокировка задачи',
+                'verbose_name_plural': 'блокировки задач',
+            },
+        ),
+    ]
@@ -1,3 +1,273 @@
+import secrets
+import uuid
+
 from django.db import models
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+
+def generate_webhook_secret():
+    return secrets.token_hex(32)
+
+
+class StripeEvent(models.Model):
+    """
+    Входящее событие Stripe (webhook) — очередь на обработку (api.webhooks).
+
+    Вебхук только проверяет подпись и сохраняет событие; повтор события с тем же
+    event_id отбрасывается уникальным индексом. Команда process_stripe_events
+    обрабатывает необработанные события пачками и отмечает processed_at.
+    """
+
+    event_id = models.CharField(
+        _('ID события в Stripe'),
+        max_length=255,
+        unique=True
+    )
+
+    type = models.CharField(
+        _('тип события'),
+        max_length=100
+    )
+
+    payload = models.JSONField(
+        _('событие'),
+        help_text=_('Событие в том виде, в каком его прислал Stripe')
+    )
+
+    # Время создания события в Stripe (unix time): события приходят не по порядку
+    stripe_created = models.PositiveBigIntegerField(_('создано в Stripe'), default=0)
+
+    received_at = models.DateTimeField(_('получено'), auto_now_add=True)
+
+    processed_at = models.DateTimeField(_('обработано'), null=True, blank=True)
+
+    attempts = models.PositiveIntegerField(_('попыток обработки'), default=0)
+
+    last_error = models.TextField(_('последняя ошибка'), blank=True)
+
+    class Meta:
+        verbose_name = _('событие Stripe')
+        verbose_name_plural = _('события Stripe')
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['processed_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f'{self.event_id} ({self.type})'
+
+
+class IdempotencyKey(models.Model):
+    """
+    Ключ идемпотентности (заголовок Idempotency-Key) мутирующего запроса — api.idempotency.
+
+    Пока запрос выполняется, status_code пуст, а locked_until ограничивает блокировку:
+    повтор с тем же ключом в это время получает 409. После ответа здесь хранится
+    сам ответ, и повторы до expires_at получают его без повторного выполнения.
+    """
+
+    # Чей ключ: user:<id> — одинаковые ключи разных пользователей не пересекаются
+    scope = models.CharField(_('владелец ключа'), max_length=64)
+
+    key = models.CharField(_('ключ'), max_length=255)
+
+    # sha256 от метода, пути и тела: тот же ключ с другим запросом — ошибка клиента
+    fingerprint = models.CharField(_('отпечаток запроса'), max_length=64)
+
+    method = models.CharField(_('метод'), max_length=10)
+
+    path = models.CharField(_('путь'), max_length=2048)
+
+    status_code = models.PositiveSmallIntegerField(_('код ответа'), null=True, blank=True)
+
+    response_body = models.BinaryField(_('тело ответа'), default=b'')
+
+    response_headers = models.JSONField(_('заголовки ответа'), default=dict)
+
+    created_at = models.DateTimeField(_('создан'), auto_now_add=True)
+
+    locked_until = models.DateTimeField(_('заблокирован до'), null=True, blank=True)
+
+    expires_at = models.DateTimeField(_('истекает'), db_index=True)
+
+    class Meta:
+        verbose_name = _('ключ идемпотентности')
+        verbose_name_plural = _('ключи идемпотентности')
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f'{self.scope}: {self.key}'
+
+
+class WebhookEndpoint(models.Model):
+    """
+    Адрес партнера (CRM, бухгалтерия) для исходящих вебхуков — api.outbox.
+
+    События пишутся в OutboxEvent отдельно для каждого подходящего адреса и доставляются
+    пачками в порядке возникновения. После ошибки доставки адрес ждет до next_attempt_at
+    (экспоненциальная пауза), а более новые события не обгоняют недоставленные.
+    """
+
+    url = models.URLField(_('адрес'), max_length=500)
+
+    secret = models.CharField(
+        _('секрет подписи'),
+        max_length=64,
+        default=generate_webhook_secret,
+        help_text=_('Тело запроса подписывается HMAC-SHA256 в заголовке Webhook-Signature')
+    )
+
+    event_types = models.JSONField(
+        _('типы событий'),
+        default=list,
+        blank=True,
+        help_text=_('Например ["payment.created", "course.updated"]; пустой список — все события')
+    )
+
+    is_active = models.BooleanField(_('активен'), default=True)
+
+    created_at = models.DateTimeField(_('создан'), auto_now_add=True)
+
+    # Ошибок доставки подряд: от них зависит пауза перед следующей попыткой
+    failures = models.PositiveIntegerField(_('ошибок подряд'), default=0)
+
+    next_attempt_at = models.DateTimeField(_('следующая попытка'), null=True, blank=True)
+
+    last_error = models.TextField(_('последняя ошибка'), blank=True)
+
+    class Meta:
+        verbose_name = _('адрес вебхуков')
+        verbose_name_plural = _('адреса вебхуков')
+        ordering = ['id']
+
+    def __str__(self):
+        return self.url
+
+    def accepts(self, event_type):
+        return not self.event_types or event_type in self.event_types
+
+
+class OutboxEvent(models.Model):
+    """Событие для доставки на адрес вебхуков (исходящая очередь, api.outbox)"""
+
+    endpoint = models.ForeignKey(
+        WebhookEndpoint,
+        on_delete=models.CASCADE,
+        related_name='events',
+        verbose_name=_('адрес')
+    )
+
+    # Общий для всех адресов ID события: по нему партнер отбрасывает повторы
+    event_id = models.UUIDField(_('ID события'), default=uuid.uuid4)
+
+    type = models.CharField(_('тип события'), max_length=100)
+
+    payload = models.JSONField(_('данные'))
+
+    created_at = models.DateTimeField(_('создано'), auto_now_add=True)
+
+    delivered_at = models.DateTimeField(_('доставлено'), null=True, blank=True)
+
+    attempts = models.PositiveIntegerField(_('попыток доставки'), default=0)
+
+    last_error = models.TextField(_('последняя ошибка'), blank=True)
+
+    class Meta:
+        verbose_name = _('исходящее событие')
+        verbose_name_plural = _('исходящие события')
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['endpoint', 'delivered_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f'{self.type} → {self.endpoint_id}'
+
+
+class Job(models.Model):
+    """
+    Фоновая задача в очереди базы данных (api.jobs, команда run_worker).
+
+    Воркер берет готовые задачи (run_at наступил) по убыванию priority и захватывает их
+    до locked_until. Ошибка возвращает задачу в очередь с паузой, пока не кончатся попытки.
+    Задачи с одинаковым key не дублируются, пока одна из них ждет в очереди.
+    """
+
+    class Status(models.TextChoices):
+        QUEUED = 'queued', _('в очереди')
+        RUNNING = 'running', _('выполняется')
+        DONE = 'done', _('выполнена')
+        FAILED = 'failed', _('ошибка')
+
+    name = models.CharField(_('задача'), max_length=100)
+
+    args = models.JSONField(_('позиционные аргументы'), default=list, blank=True)
+
+    kwargs = models.JSONField(_('именованные аргументы'), default=dict, blank=True)
+
+    # Ключ дедупликации: пока задача с ключом ждет в очереди, такая же не добавляется
+    key = models.CharField(_('ключ'), max_length=255, null=True, blank=True)
+
+    priority = models.SmallIntegerField(_('приоритет'), default=0, help_text=_('Больше — раньше'))
+
+    status = models.CharField(_('статус'), max_length=10, choices=Status.choices, default=Status.QUEUED)
+
+    run_at = models.DateTimeField(_('выполнить после'), default=timezone.now)
+
+    attempts = models.PositiveIntegerField(_('попыток'), default=0)
+
+    max_attempts = models.PositiveIntegerField(_('максимум попыток'), default=5)
+
+    # Токен захвата: воркер отмечает результат, только если задачу не перехватили
+    locked_by = models.CharField(_('захвачена воркером'), max_length=100, blank=True)
+
+    locked_until = models.DateTimeField(_('захвачена до'), null=True, blank=True)
+
+    last_error = models.TextField(_('последняя ошибка'), blank=True)
+
+    created_at = models.DateTimeField(_('создана'), auto_now_add=True)
+
+    started_at = models.DateTimeField(_('начата'), null=True, blank=True)
+
+    finished_at = models.DateTimeField(_('завершена'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('фоновая задача')
+        verbose_name_plural = _('фоновые задачи')
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_at', 'id']),
+            models.Index(fields=['locked_by']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['key'], condition=models.Q(status='queued'), name='unique_queued_job_key'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.name} #{self.pk} ({self.status})'
+
+
+class JobLock(models.Model):
+    """
+    Именованная блокировка (api.jobs.lock): exclusive-задача и команда, выполняющая ту же
+    работу, не идут параллельно. Действует до expires_at; владелец продлевает ее, пока работает,
+    а блокировку упавшего процесса можно перехватить после истечения.
+    """
+
+    name = models.CharField(_('имя'), max_length=100, unique=True)
+
+    owner = models.CharField(_('владелец'), max_length=100)
+
+    expires_at = models.DateTimeField(_('действует до'))
+
+    class Meta:
+        verbose_name = _('блокировка задачи')
+        verbose_name_plural = _('блокировки задач')
 
-# Create your models here.
+    def __str__(self):
+        return f'{self.name} ({self.owner})'
@@ -0,0 +1,248 @@
+"""
+Исходящие вебхуки для партнеров (CRM, бухгалтерия): платежи, подписки и курсы.
+
+Запись (record) — только INSERT в таблицу OutboxEvent из сигналов моделей (api.signals),
+по строке на каждый активный адрес, которому нужен этот тип события. Запись идет в той же
+транзакции, что и изменение, поэтому событие не теряется и не остается после отката
+(для платежей в шардах — в транзакции default, которую держит вместе с шардом insert_payments).
+HTTP-запросов к партнерам в потоке запроса нет.
+
+Доставка (Deliverer: фоновая задача api.deliver_webhooks, которую ставит record, или команда
+deliver_webhooks) идет раундами:
+- для каждого адреса, у которого есть недоставленные события и не идет пауза после ошибки,
+  берется пачка самых старых событий (OUTBOUND_WEBHOOKS['BATCH_SIZE'])
+- пачки разных адресов отправляются параллельно из пула потоков (WORKERS), каждая — одним
+  POST {"events": [...]} с подписью Webhook-Signature: t=<unix time>,v1=<HMAC-SHA256
+  от "<t>.<тело>" секретом адреса>
+- ответ 2xx отмечает пачку доставленной; иначе адрес ждет BACKOFF_BASE * 2^(ошибок подряд)
+  секунд (не больше BACKOFF_MAX, со случайным разбросом), и события не обгоняют друг друга
+
+С базой работает только основной поток, потоки пула только отправляют запросы.
+Доставка «хотя бы один раз»: партнер отбрасывает повторы по ID события.
+"""
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Exists, F, Min, OuterRef, Q
+from django.utils import timezone
+
+from . import jobs
+from .models import OutboxEvent, WebhookEndpoint
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = 'Webhook-Signature'
+
+
+def payment_data(payment):
+    return {
+        'id': payment.pk,
+        'user_id': payment.user_id,
+        'course_id': payment.paid_course_id,
+        'lesson_id': payment.paid_lesson_id,
+        'amount': str(payment.amount),
+        'payment_method': payment.payment_method,
+        'stripe_id': payment.stripe_id,
+        'is_confirmed': payment.is_confirmed,
+        'payment_date': payment.payment_date,
+    }
+
+
+def subscription_data(subscription):
+    return {
+        'id': subscription.pk,
+        'user_id': subscription.user_id,
+        'course_id': subscription.course_id,
+        'created_at': subscription.created_at,
+    }
+
+
+def course_data(course):
+    return {
+        'id': course.pk,
+        'title': course.title,
+        'price': str(course.price),
+        'owner_id': course.owner_id,
+    }
+
+
+def record(event_type, payloads):
+    """
+    Ставит события типа event_type в очередь каждого подходящего активного адреса:
+    один запрос к адресам и один bulk_create на любое число событий
+    """
+    endpoints = [
+        endpoint for endpoint in WebhookEndpoint.objects.filter(is_active=True).only('id', 'event_types')
+        if endpoint.accepts(event_type)
+    ]
+    if not endpoints or not payloads:
+        return []
+    events = []
+    for payload in payloads:
+        # Даты и Decimal — в строки сразу, как их увидит партнер
+        payload = json.loads(json.dumps(payload, cls=DjangoJSONEncoder))
+        event = OutboxEvent(endpoint=endpoints[0], type=event_type, payload=payload)
+        events.append(event)
+        events.extend(
+            OutboxEvent(endpoint=endpoint, event_id=event.event_id, type=event_type, payload=payload)
+            for endpoint in endpoints[1:]
+        )
+    events = OutboxEvent.objects.bulk_create(events)
+    # Одна задача доставки на все события, пока она ждет в очереди (api.tasks)
+    jobs.enqueue('api.deliver_webhooks')
+    return events
+
+
+def sign(body, secret, timestamp=None):
+    """Значение заголовка Webhook-Signature для тела body (bytes)"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f'{timestamp}.'.encode() + body, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def backoff(failures):
+    """Пауза после failures ошибок подряд, секунды"""
+    config = settings.OUTBOUND_WEBHOOKS
+    delay = min(config['BACKOFF_MAX'], config['BACKOFF_BASE'] * 2 ** (failures - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+def _envelope(event):
+    return {
+        'id': str(event.event_id),
+        'type': event.type,
+        'created': event.created_at.isoformat(),
+        'data': event.payload,
+    }
+
+
+class Deliverer:
+    """
+    Доставка очереди раундами (deliver_round) или до опустошения (deliver).
+    Держит пул потоков и по HTTP-сессии (keep-alive) на адрес; закрывается close().
+    """
+
+    def __init__(self, batch_size=None, workers=None):
+        config = settings.OUTBOUND_WEBHOOKS
+        self.batch_size = batch_size or config['BATCH_SIZE']
+        self.timeout = config['TIMEOUT']
+        self._pool = ThreadPoolExecutor(max_workers=workers or config['WORKERS'])
+        # Адрес обслуживает один поток за раунд, поэтому сессия адреса не делится между потоками
+        self._sessions = {}
+
+    def close(self):
+        self._pool.shutdown()
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _session(self, endpoint_id):
+        session = self._sessions.get(endpoint_id)
+        if session is None:
+            session = self._sessions[endpoint_id] = requests.Session()
+        return session
+
+    def _send(self, endpoint, events):
+        """Отправляет пачку; возвращает None при успехе или текст ошибки"""
+        body = json.dumps({'events': [_envelope(event) for event in events]}, cls=DjangoJSONEncoder).encode()
+        headers = {'Content-Type': 'application/json', SIGNATURE_HEADER: sign(body, endpoint.secret)}
+        try:
+            response = self._session(endpoint.pk).post(endpoint.url, data=body, headers=headers,
+                                                       timeout=self.timeout)
+        except requests.RequestException as e:
+            return f'{type(e).__name__}: {e}'
+        if 200 <= response.status_code < 300:
+            return None
+        return f'HTTP {response.status_code}: {response.text[:500]}'
+
+    def _due_endpoints(self, now):
+        pending = OutboxEvent.objects.filter(endpoint=OuterRef('pk'), delivered_at__isnull=True)
+        return list(
+            WebhookEndpoint.objects
+            .filter(is_active=True)
+            .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+            .filter(Exists(pending))
+        )
+
+    def deliver_round(self):
+        """Одна пачка на каждый готовый адрес, параллельно. Возвращает (доставлено, ошибок)"""
+        now = timezone.now()
+        batches = []
+        for endpoint in self._due_endpoints(now):
+            events = list(endpoint.events.filter(delivered_at__isnull=True).order_by('id')[:self.batch_size])
+            if events:
+                batches.append((endpoint, events, self._pool.submit(self._send, endpoint, events)))
+
+        delivered = failed = 0
+        for endpoint, events, future in batches:
+            error = future.result()
+            pks = [event.pk for event in events]
+            if error is None:
+                OutboxEvent.objects.filter(pk__in=pks).update(
+                    delivered_at=timezone.now(), attempts=F('attempts') + 1, last_error=''
+                )
+                if endpoint.failures or endpoint.next_attempt_at:
+                    WebhookEndpoint.objects.filter(pk=endpoint.pk).update(
+                        failures=0, next_attempt_at=None, last_error=''
+                    )
+                delivered += len(events)
+            else:
+                failures = endpoint.failures + 1
+                logger.warning('Вебхук %s: %s (ошибок подряд: %s)', endpoint.url, error, failures)
+                OutboxEvent.objects.filter(pk__in=pks).update(attempts=F('attempts') + 1, last_error=error)
+                WebhookEndpoint.objects.filter(pk=endpoint.pk).update(
+                    failures=failures,
+                    next_attempt_at=timezone.now() + datetime.timedelta(seconds=backoff(failures)),
+                    last_error=error,
+                )
+                failed += 1
+        return delivered, failed
+
+    def deliver(self, on_round=None):
+        """
+        Раунды, пока есть что доставлять без ожидания. on_round(доставлено, ошибок)
+        вызывается после каждого раунда. Возвращает (доставлено, ошибок)
+        """
+        delivered = failed = 0
+        while True:
+            round_delivered, round_failed = self.deliver_round()
+            delivered += round_delivered
+            failed += round_failed
+            if not round_delivered:
+                return delivered, failed
+            if on_round is not None:
+                on_round(delivered, failed)
+
+
+def next_attempt_at():
+    """Ближайшая попытка среди адресов на паузе, у которых есть недоставленные события, или None"""
+    pending = OutboxEvent.objects.filter(endpoint=OuterRef('pk'), delivered_at__isnull=True)
+    return (
+        WebhookEndpoint.objects
+        .filter(is_active=True, next_attempt_at__isnull=False)
+        .filter(Exists(pending))
+        .aggregate(next_attempt_at=Min('next_attempt_at'))['next_attempt_at']
+    )
+
+
+def purge_delivered(days=None):
+    """Удаляет доставленные события старше RETENTION_DAYS дней. Возвращает число удаленных"""
+    days = settings.OUTBOUND_WEBHOOKS['RETENTION_DAYS'] if days is None else days
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    deleted, _ = OutboxEvent.objects.filter(delivered_at__lt=cutoff).delete()
+    return deleted
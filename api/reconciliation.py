@@ -0,0 +1,267 @@
+"""
+Сверка платежей со Stripe за период (команда reconcile_stripe).
+
+Из Stripe берутся завершенные сессии Checkout и успешные PaymentIntent, созданные за период
+с запасом STRIPE_RECONCILE['MARGIN'] по краям: платеж в базе появляется позже объекта в Stripe.
+Период делится на SLICES интервалов, каждый интервал листается постранично (starting_after)
+в своем потоке из пула WORKERS, все потоки — под общим лимитом RATE. В памяти остаются только
+словари ID -> сумма, поэтому сотни тысяч платежей сравниваются за один проход.
+
+Платеж в Stripe — это сессия Checkout или PaymentIntent без сессии. Платеж в базе хранит
+в stripe_id ID сессии (платежи из вебхуков) или ID PaymentIntent: совпадение ищется по обоим.
+Платежи базы читаются из всех шардов и архива.
+
+Отчет (Report):
+- missing — оплачено в Stripe за период, в базе нет
+- extra — в базе есть платеж со stripe_id за период, в Stripe его нет (или это дубль)
+- mismatched — суммы в базе и в Stripe расходятся (платежи сессии корзины суммируются)
+- unconfirmed — оплачено в Stripe, в базе не подтверждено; с fix=True такие платежи
+  подтверждаются через save(), чтобы сигналы обновили итоги и доступ к курсу
+  (архивные платежи только попадают в отчет)
+"""
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.conf import settings
+
+from users.models import ArchivedPayment, Payment
+from users.sharding import payment_querysets
+
+from .services import stripe_service
+from .throttling import RateLimiter
+from .webhooks import PAID_STATUSES
+
+logger = logging.getLogger(__name__)
+
+# База платежа из архива в отчетах и индексах
+ARCHIVE = 'archive'
+
+# Сколько ID искать в базе одним запросом
+LOOKUP_BATCH = 500
+
+LOCAL_FIELDS = ('pk', 'stripe_id', 'amount', 'is_confirmed', 'payment_date')
+
+
+class Report:
+    """Итоги сверки; строки отчетов — кортежи, чтобы их можно было держать сотнями тысяч"""
+
+    def __init__(self, since, until):
+        self.since = since
+        self.until = until
+        self.pages = 0
+        self.remote = 0
+        self.local = 0
+        self.missing = []      # (stripe_id, сумма в Stripe)
+        self.extra = []        # (ID платежа, stripe_id, сумма в базе)
+        self.mismatched = []   # (ID платежа, stripe_id, сумма в базе, сумма в Stripe)
+        self.unconfirmed = []  # (ID платежа, stripe_id)
+        self.fixed = 0
+
+    @property
+    def ok(self):
+        return not (self.missing or self.extra or self.mismatched or len(self.unconfirmed) > self.fixed)
+
+
+def time_slices(start, end, count):
+    """Делит [start, end) (unix time) на count интервалов почти равной длины"""
+    count = max(1, min(count, end - start))
+    step = (end - start) / count
+    bounds = [start + round(step * index) for index in range(count)] + [end]
+    return [(low, high) for low, high in zip(bounds, bounds[1:]) if low < high]
+
+
+def _pages(list_page, start, end, limiter):
+    """Все страницы интервала: курсор starting_after — последний объект предыдущей страницы"""
+    starting_after = None
+    while True:
+        if limiter is not None:
+            limiter.wait()
+        page = list_page(start, end, starting_after=starting_after)
+        yield page.data
+        if not page.has_more or not page.data:
+            return
+        starting_after = page.data[-1]['id']
+
+
+def _fetch_sessions(start, end, limiter):
+    """Оплаченные сессии интервала: ([(ID, сумма в центах, ID PaymentIntent, создана)], страниц)"""
+    def list_page(created_gte, created_lt, starting_after=None):
+        return stripe_service.list_checkout_sessions(created_gte, created_lt, starting_after, status='complete')
+
+    rows = []
+    pages = 0
+    for data in _pages(list_page, start, end, limiter):
+        pages += 1
+        rows.extend(
+            (session['id'], session.get('amount_total') or 0, session.get('payment_intent'), session['created'])
+            for session in data if session.get('payment_status') in PAID_STATUSES
+        )
+    return rows, pages
+
+
+def _fetch_intents(start, end, limiter):
+    """Успешные PaymentIntent интервала: ([(ID, получено в центах, создан)], страниц)"""
+    rows = []
+    pages = 0
+    for data in _pages(stripe_service.list_payment_intents, start, end, limiter):
+        pages += 1
+        rows.extend(
+            (intent['id'], intent.get('amount_received') or 0, intent['created'])
+            for intent in data if intent.get('status') == 'succeeded'
+        )
+    return rows, pages
+
+
+def fetch_remote(start, end, slices=None, workers=None, rate=None):
+    """
+    Платежи Stripe за [start, end) (unix time), листая интервалы параллельно.
+    Возвращает (ID -> (сумма в центах, создан), PaymentIntent сессии -> ID сессии, страниц).
+    """
+    config = settings.STRIPE_RECONCILE
+    limiter = RateLimiter(rate or config['RATE'], key='stripe-reconcile')
+    intervals = time_slices(start, end, slices or config['SLICES'])
+    with ThreadPoolExecutor(max_workers=workers or config['WORKERS']) as pool:
+        sessions = [pool.submit(_fetch_sessions, low, high, limiter) for low, high in intervals]
+        intents = [pool.submit(_fetch_intents, low, high, limiter) for low, high in intervals]
+
+        remote = {}
+        aliases = {}
+        pages = 0
+        for future in sessions:
+            rows, count = future.result()
+            pages += count
+            for session_id, amount, intent_id, created in rows:
+                remote[session_id] = (amount, created)
+                if intent_id:
+                    aliases[intent_id] = session_id
+        for future in intents:
+            rows, count = future.result()
+            pages += count
+            for intent_id, amount, created in rows:
+                if intent_id not in aliases:
+                    remote[intent_id] = (amount, created)
+    return remote, aliases, pages
+
+
+def _local_sources():
+    """(база или ARCHIVE, выборка) для всех мест, где лежат платежи"""
+    for payments in payment_querysets():
+        yield payments.db, payments
+    yield ARCHIVE, ArchivedPayment.objects.all()
+
+
+def _local_rows(since, until):
+    """Платежи со stripe_id за [since, until): (база, ID, stripe_id, сумма, подтвержден, дата)"""
+    for alias, payments in _local_sources():
+        rows = (
+            payments
+            .filter(payment_date__gte=since, payment_date__lt=until, stripe_id__isnull=False)
+            .exclude(stripe_id='')
+            .values_list(*LOCAL_FIELDS)
+            .iterator(chunk_size=5000)
+        )
+        for row in rows:
+            yield (alias, *row)
+
+
+def _lookup(stripe_ids):
+    """Платежи с этими stripe_id за любые даты (для платежей Stripe, не найденных за период)"""
+    stripe_ids = list(stripe_ids)
+    for alias, payments in _local_sources():
+        for index in range(0, len(stripe_ids), LOOKUP_BATCH):
+            batch = stripe_ids[index:index + LOOKUP_BATCH]
+            for row in payments.filter(stripe_id__in=batch).values_list(*LOCAL_FIELDS):
+                yield (alias, *row)
+
+
+def confirm(payments):
+    """Подтверждает платежи [(база, ID)] через save(). Возвращает число подтвержденных"""
+    by_alias = {}
+    for alias, pk in payments:
+        if alias != ARCHIVE:
+            by_alias.setdefault(alias, []).append(pk)
+
+    confirmed = 0
+    for alias, pks in by_alias.items():
+        for index in range(0, len(pks), LOOKUP_BATCH):
+            batch = pks[index:index + LOOKUP_BATCH]
+            for payment in Payment.objects.using(alias).filter(pk__in=batch, is_confirmed=False):
+                payment.is_confirmed = True
+                payment.save(update_fields=['is_confirmed'])
+                confirmed += 1
+    return confirmed
+
+
+def reconcile(since, until, fix=False, slices=None, workers=None, rate=None):
+    """Сверяет платежи за [since, until) (datetime с часовым поясом). Возвращает Report"""
+    report = Report(since, until)
+    margin = datetime.timedelta(seconds=settings.STRIPE_RECONCILE['MARGIN'])
+    start, end = int(since.timestamp()), int(until.timestamp())
+
+    remote, aliases, report.pages = fetch_remote(
+        start - int(margin.total_seconds()), end + int(margin.total_seconds()), slices, workers, rate
+    )
+    report.remote = sum(1 for _, created in remote.values() if start <= created < end)
+
+    # Платежи базы по ключу платежа в Stripe (ID сессии, если stripe_id — PaymentIntent сессии).
+    # У сессии корзины несколько платежей с одним stripe_id — по платежу на курс
+    local = {}
+    seen = set()
+    duplicates = []
+
+    def add(row):
+        if row[:2] in seen:
+            return
+        seen.add(row[:2])
+        key = aliases.get(row[2], row[2])
+        rows = local.get(key)
+        if rows is None:
+            local[key] = [row]
+        elif rows[0][2] == row[2]:
+            rows.append(row)
+        else:
+            duplicates.append(row)
+
+    for row in _local_rows(since - margin, until + margin):
+        add(row)
+
+    # Платежи Stripe за период, для которых в окне базы ничего нет: ищем по ID за любые даты
+    unmatched = {key for key, (_, created) in remote.items() if start <= created < end and key not in local}
+    if unmatched:
+        intent_ids = [intent_id for intent_id, session_id in aliases.items() if session_id in unmatched]
+        for row in _lookup([*unmatched, *intent_ids]):
+            add(row)
+
+    to_confirm = []
+    for key, (amount, created) in remote.items():
+        rows = local.get(key)
+        if rows is None:
+            if start <= created < end:
+                report.missing.append((key, Decimal(amount) / 100))
+            continue
+        if not (start <= created < end or any(since <= row[5] < until for row in rows)):
+            continue
+        report.local += len(rows)
+        _, pk, stripe_id = rows[0][:3]
+        local_amount = sum(Decimal(row[3]) for row in rows)
+        if local_amount != Decimal(amount) / 100:
+            report.mismatched.append((pk, stripe_id, local_amount, Decimal(amount) / 100))
+        for alias, pk, stripe_id, _, is_confirmed, _ in rows:
+            if not is_confirmed:
+                report.unconfirmed.append((pk, stripe_id))
+                to_confirm.append((alias, pk))
+
+    for key, rows in local.items():
+        if key not in remote:
+            duplicates.extend(rows)
+    for alias, pk, stripe_id, local_amount, _, payment_date in duplicates:
+        if since <= payment_date < until:
+            report.local += 1
+            report.extra.append((pk, stripe_id, Decimal(local_amount)))
+
+    if fix and to_confirm:
+        report.fixed = confirm(to_confirm)
+        logger.info('Сверка со Stripe: подтверждено платежей %s', report.fixed)
+    return report
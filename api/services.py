@@ -0,0 +1,351 @@
+"""
+Клиент Stripe для всего проекта (stripe_service).
+
+Один настроенный StripeClient вместо глобального stripe.api_key:
+- общая requests.Session с пулом keep-alive соединений (STRIPE_CLIENT['POOL_SIZE'])
+- таймауты connect/read из STRIPE_TIMEOUT, ограниченные бюджетом запроса (api.deadlines)
+- ограниченное число повторов (MAX_RETRIES) с экспоненциальной задержкой и случайным
+  разбросом — только после сбоев, которые имеет смысл повторить; все попытки одного
+  вызова идут с одним Idempotency-Key, поэтому Stripe не создаст объект дважды
+- автомат отключения (circuit breaker): после BREAKER_FAILURES сбоев Stripe подряд вызовы
+  сразу получают StripeUnavailable (503), пока не пройдет BREAKER_RESET секунд; затем
+  один пробный вызов решает, замкнуть автомат или снова разомкнуть
+
+Для async-view есть асинхронные версии вызовов (request_async, create_checkout_session_async):
+они идут через отдельный StripeClient на встроенном клиенте httpx (api.deadlines.DeadlineHTTPXClient),
+который создается при первом async-вызове. Пауза между повторами не занимает поток,
+автомат отключения общий с синхронными вызовами.
+
+Адрес API берется из STRIPE_API_BASE, поэтому в тестах клиент работает с локальным
+сервером api.stripe_stub. Клиент создается при первом обращении и пересоздается,
+если настройки Stripe меняются (override_settings в тестах).
+"""
+import asyncio
+import random
+import threading
+import time
+import uuid
+
+import requests
+import stripe
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from api import deadlines
+from api.deadlines import DeadlineHTTPXClient, DeadlineRequestsClient
+
+# Настройки, после изменения которых клиент нужно пересоздать
+STRIPE_SETTINGS = ('STRIPE_API_KEY', 'STRIPE_API_BASE', 'STRIPE_TIMEOUT', 'STRIPE_CLIENT')
+
+
+class StripeUnavailable(APIException):
+    """Stripe недоступен: автомат отключения разомкнут"""
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Платежная система временно недоступна, повторите попытку позже'
+    default_code = 'stripe_unavailable'
+
+
+def is_outage(error):
+    """Сбой сети или самого Stripe (а не ошибка в запросе): признак деградации сервиса"""
+    if isinstance(error, stripe.APIConnectionError):
+        return True
+    return isinstance(error, stripe.StripeError) and (error.http_status or 0) >= 500
+
+
+def is_retryable(error):
+    """Можно ли повторить вызов после ошибки"""
+    return is_outage(error) or isinstance(error, stripe.RateLimitError)
+
+
+class CircuitBreaker:
+    """Автомат отключения: считает сбои подряд и на время перестает пропускать вызовы"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def before_call(self):
+        """Пропускает вызов или выбрасывает StripeUnavailable; после паузы пропускает один пробный"""
+        with self._lock:
+            state = self._state()
+            if state == self.OPEN or (state == self.HALF_OPEN and self._probing):
+                raise StripeUnavailable()
+            if state == self.HALF_OPEN:
+                self._probing = True
+
+    def release_probe(self):
+        """Вызов прервался не ответом Stripe (срок запроса, отмена): исход неизвестен, пробуем снова"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            # Неудачный пробный вызов снова размыкает автомат на полный срок
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+
+
+class StripeService:
+    """Общий клиент Stripe с пулом соединений, повторами и автоматом отключения"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._session = None
+        self._async_client = None
+        self._async_http_client = None
+        self._breaker = None
+
+    def _build(self):
+        config = settings.STRIPE_CLIENT
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config['POOL_SIZE'])
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._client = self._stripe_client(
+            DeadlineRequestsClient(timeout=settings.STRIPE_TIMEOUT, session=self._session)
+        )
+        self._breaker = CircuitBreaker(config['BREAKER_FAILURES'], config['BREAKER_RESET'])
+
+    @staticmethod
+    def _stripe_client(http_client):
+        return stripe.StripeClient(
+            settings.STRIPE_API_KEY,
+            base_addresses={'api': settings.STRIPE_API_BASE},
+            http_client=http_client,
+            # Повторы делает сам сервис: с учетом автомата отключения и бюджета запроса
+            max_network_retries=0,
+        )
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._build()
+            return self._client
+
+    @property
+    def async_client(self):
+        """StripeClient для async-методов (create_async и т.д.)"""
+        with self._lock:
+            if self._client is None:
+                self._build()
+            if self._async_client is None:
+                self._async_http_client = DeadlineHTTPXClient(
+                    timeout=settings.STRIPE_TIMEOUT, pool_size=settings.STRIPE_CLIENT['POOL_SIZE']
+                )
+                self._async_client = self._stripe_client(self._async_http_client)
+            return self._async_client
+
+    @property
+    def breaker(self):
+        with self._lock:
+            if self._breaker is None:
+                self._build()
+            return self._breaker
+
+    def reset(self):
+        """Закрывает соединения; клиент будет создан заново по текущим настройкам"""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            if self._async_http_client is not None:
+                self._async_http_client.close()
+            self._client = self._session = self._async_client = self._async_http_client = self._breaker = None
+
+    def _backoff_delay(self, attempt):
+        """Пауза перед повтором: случайная в пределах экспоненциально растущего окна"""
+        config = settings.STRIPE_CLIENT
+        delay = random.uniform(0, min(config['BACKOFF_MAX'], config['BACKOFF_BASE'] * 2 ** attempt))
+        left = deadlines.remaining()
+        if left is not None:
+            delay = min(delay, left)
+        return delay
+
+    def _backoff(self, attempt):
+        time.sleep(self._backoff_delay(attempt))
+
+    def _record_error(self, breaker, error):
+        # Ошибка в самом запросе (4xx) значит, что Stripe отвечает
+        if is_outage(error):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    def request(self, method, params, idempotency_key=None):
+        """
+        Вызывает метод StripeClient (например, client.v1.checkout.sessions.create)
+        с повторами и автоматом отключения
+        """
+        breaker = self.breaker
+        options = {'idempotency_key': idempotency_key or uuid.uuid4().hex}
+        attempts = 1 + settings.STRIPE_CLIENT['MAX_RETRIES']
+        for attempt in range(attempts):
+            deadlines.check()
+            breaker.before_call()
+            try:
+                result = method(params=params, options=options)
+            except stripe.StripeError as e:
+                self._record_error(breaker, e)
+                if not is_retryable(e) or attempt == attempts - 1:
+                    raise
+                self._backoff(attempt)
+            except BaseException:
+                # Иначе пробный вызов остался бы незавершенным, и автомат не пропускал бы больше ничего
+                breaker.release_probe()
+                raise
+            else:
+                breaker.record_success()
+                return result
+
+    async def request_async(self, method, params, idempotency_key=None):
+        """
+        То же, что request, для async-методов StripeClient
+        (например, async_client.v1.checkout.sessions.create_async)
+        """
+        breaker = self.breaker
+        options = {'idempotency_key': idempotency_key or uuid.uuid4().hex}
+        attempts = 1 + settings.STRIPE_CLIENT['MAX_RETRIES']
+        for attempt in range(attempts):
+            deadlines.check()
+            breaker.before_call()
+            try:
+                result = await method(params=params, options=options)
+            except stripe.StripeError as e:
+                self._record_error(breaker, e)
+                if not is_retryable(e) or attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(self._backoff_delay(attempt))
+            except BaseException:
+                breaker.release_probe()
+                raise
+            else:
+                breaker.record_success()
+                return result
+
+    @staticmethod
+    def checkout_session_params(price_id, success_url, cancel_url, client_reference_id=None,
+                                metadata=None, customer_email=None, quantity=1, expires_at=None):
+        """
+        Параметры Checkout Session на оплату цены price_id (expires_at — unix time истечения).
+        price_id может быть списком цен: одна сессия с позицией на каждую цену (корзина).
+        """
+        price_ids = [price_id] if isinstance(price_id, str) else price_id
+        params = {
+            'mode': 'payment',
+            'line_items': [{'price': item, 'quantity': quantity} for item in price_ids],
+            'success_url': success_url,
+            'cancel_url': cancel_url,
+        }
+        if client_reference_id:
+            params['client_reference_id'] = client_reference_id
+        if metadata:
+            params['metadata'] = metadata
+        if customer_email:
+            params['customer_email'] = customer_email
+        if expires_at:
+            params['expires_at'] = expires_at
+        return params
+
+    def create_checkout_session(self, price_id, success_url, cancel_url, idempotency_key=None, **options):
+        """Создает Checkout Session (параметры — как у checkout_session_params)"""
+        params = self.checkout_session_params(price_id, success_url, cancel_url, **options)
+        return self.request(self.client.v1.checkout.sessions.create, params, idempotency_key)
+
+    def create_product(self, name, metadata=None, idempotency_key=None):
+        """Создает продукт каталога Stripe"""
+        params = {'name': name}
+        if metadata:
+            params['metadata'] = metadata
+        return self.request(self.client.v1.products.create, params, idempotency_key)
+
+    def create_price(self, product, unit_amount, currency, metadata=None, idempotency_key=None):
+        """Создает цену продукта (unit_amount — в центах)"""
+        params = {'product': product, 'unit_amount': unit_amount, 'currency': currency}
+        if metadata:
+            params['metadata'] = metadata
+        return self.request(self.client.v1.prices.create, params, idempotency_key)
+
+    def activate_price(self, price_id, idempotency_key=None):
+        """Возвращает в работу архивированную цену"""
+        return self.request(
+            lambda params, options: self.client.v1.prices.update(price_id, params=params, options=options),
+            {'active': True},
+            idempotency_key
+        )
+
+    def deactivate_price(self, price_id, idempotency_key=None):
+        """Архивирует цену: цены в Stripe неизменяемы, устаревшую можно только отключить"""
+        return self.request(
+            lambda params, options: self.client.v1.prices.update(price_id, params=params, options=options),
+            {'active': False},
+            idempotency_key
+        )
+
+    @staticmethod
+    def list_params(created_gte, created_lt, starting_after=None, limit=100):
+        """Параметры страницы списка за период [created_gte, created_lt) (unix time)"""
+        params = {'created': {'gte': created_gte, 'lt': created_lt}, 'limit': limit}
+        if starting_after:
+            params['starting_after'] = starting_after
+        return params
+
+    def list_checkout_sessions(self, created_gte, created_lt, starting_after=None, limit=100, status=None):
+        """Страница сессий Checkout за период (новые первыми)"""
+        params = self.list_params(created_gte, created_lt, starting_after, limit)
+        if status:
+            params['status'] = status
+        return self.request(self.client.v1.checkout.sessions.list, params)
+
+    def list_payment_intents(self, created_gte, created_lt, starting_after=None, limit=100):
+        """Страница платежей (PaymentIntent) за период (новые первыми)"""
+        params = self.list_params(created_gte, created_lt, starting_after, limit)
+        return self.request(self.client.v1.payment_intents.list, params)
+
+    async def create_checkout_session_async(self, price_id, success_url, cancel_url, idempotency_key=None,
+                                            **options):
+        """Асинхронная версия create_checkout_session"""
+        params = self.checkout_session_params(price_id, success_url, cancel_url, **options)
+        return await self.request_async(self.async_client.v1.checkout.sessions.create_async, params, idempotency_key)
+
+
+stripe_service = StripeService()
+
+
+@receiver(setting_changed)
+def stripe_settings_changed(setting, **kwargs):
+    if setting in STRIPE_SETTINGS:
+        stripe_service.reset()
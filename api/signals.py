@@ -0,0 +1,54 @@
+"""
+Изменения платежей, подписок и курсов -> исходящие вебхуки (api.outbox).
+
+Типы событий: payment.created, payment.confirmed, subscription.created, subscription.deleted,
+course.created, course.updated, course.deleted.
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from materials.models import Course, Subscription
+from users.models import Payment
+from users.signals import payment_signals_muted, payments_bulk_created
+
+from . import outbox
+
+
+@receiver(post_save, sender=Payment)
+def payment_saved(sender, instance, created, **kwargs):
+    if payment_signals_muted():
+        # Перенос в архив — не новое событие
+        return
+    if created:
+        outbox.record('payment.created', [outbox.payment_data(instance)])
+        return
+    # Прежние значения запоминает users.signals.remember_previous_payment
+    previous = getattr(instance, '_rollup_previous', None)
+    if instance.is_confirmed and previous is not None and not previous['is_confirmed']:
+        outbox.record('payment.confirmed', [outbox.payment_data(instance)])
+
+
+@receiver(payments_bulk_created, sender=Payment)
+def payments_created_in_bulk(sender, payments, **kwargs):
+    outbox.record('payment.created', [outbox.payment_data(payment) for payment in payments])
+
+
+@receiver(post_save, sender=Subscription)
+def subscription_saved(sender, instance, created, **kwargs):
+    if created:
+        outbox.record('subscription.created', [outbox.subscription_data(instance)])
+
+
+@receiver(post_delete, sender=Subscription)
+def subscription_deleted(sender, instance, **kwargs):
+    outbox.record('subscription.deleted', [outbox.subscription_data(instance)])
+
+
+@receiver(post_save, sender=Course)
+def course_saved(sender, instance, created, **kwargs):
+    outbox.record('course.created' if created else 'course.updated', [outbox.course_data(instance)])
+
+
+@receiver(post_delete, sender=Course)
+def course_deleted(sender, instance, **kwargs):
+    outbox.record('course.deleted', [outbox.course_data(instance)])
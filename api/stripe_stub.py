@@ -0,0 +1,371 @@
+"""
+Локальный заменитель API Stripe для тестов и ручной проверки.
+
+    stub = StripeStub().start()         # адрес — stub.url, например http://127.0.0.1:54321
+    with override_settings(STRIPE_API_BASE=stub.url):
+        stripe_service.create_checkout_session(...)
+    stub.stop()
+
+Из консоли: python -m api.stripe_stub --port 12111, затем STRIPE_API_BASE=http://127.0.0.1:12111.
+
+Сервер понимает HTTP/1.1 keep-alive и отвечает как Stripe: JSON-объекты, ошибки в виде
+{"error": {...}}, повтор запроса с тем же Idempotency-Key возвращает сохраненный ответ.
+Для проверки устойчивости клиента можно задать сбои (fail) и задержку ответов (delay).
+Все запросы сохраняются в stub.requests вместе с моментами начала и конца обработки
+(started, finished — time.monotonic()): по ним видно, шли ли запросы параллельно.
+
+События для вебхуков строит stub.event(...) (например, complete_session), а заголовок
+Stripe-Signature для тела — sign(payload, secret). Списки сессий и PaymentIntent отдаются
+страницами, как в Stripe (created[gte/lt], limit, starting_after); оплаченные сессии для них
+можно создать сразу через paid_session(...).
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+def unflatten(pairs):
+    """Параметры формы Stripe (line_items[0][price]=...) -> вложенные словари и списки"""
+    result = {}
+    for key, value in pairs:
+        parts = re.findall(r'[^\[\]]+', key)
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return _lists(result)
+
+
+def error(error_type, message, code=None):
+    """Тело ответа с ошибкой в формате Stripe"""
+    return {'error': {'type': error_type, 'message': message, 'code': code}}
+
+
+def sign(payload, secret, timestamp=None):
+    """Заголовок Stripe-Signature для тела вебхука, подписанного секретом secret"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def _lists(value):
+    if not isinstance(value, dict):
+        return value
+    if value and all(key.isdigit() for key in value):
+        return [_lists(value[key]) for key in sorted(value, key=int)]
+    return {key: _lists(item) for key, item in value.items()}
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Очередь входящих соединений: при нагрузочных тестах их открываются десятки сразу
+    request_queue_size = 128
+
+
+class StripeStub:
+    """Фейковый сервер Stripe с состоянием в памяти"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.requests = []
+        self.connections = set()
+        self.objects = {}
+        self.idempotent = {}
+        self.failures = []
+        self.delay = 0
+        self.counter = 0
+        self.routes = [
+            ('POST', r'^/v1/checkout/sessions$', self.create_checkout_session),
+            ('GET', r'^/v1/checkout/sessions$', self.list_checkout_sessions),
+            ('GET', r'^/v1/checkout/sessions/(?P<object_id>[^/]+)$', self.retrieve),
+            ('POST', r'^/v1/products$', self.create_product),
+            ('GET', r'^/v1/products/(?P<object_id>[^/]+)$', self.retrieve),
+            ('POST', r'^/v1/prices$', self.create_price),
+            ('GET', r'^/v1/prices/(?P<object_id>[^/]+)$', self.retrieve),
+            ('POST', r'^/v1/prices/(?P<object_id>[^/]+)$', self.update),
+            ('GET', r'^/v1/payment_intents$', self.list_payment_intents),
+            ('GET', r'^/v1/payment_intents/(?P<object_id>[^/]+)$', self.retrieve),
+        ]
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def start(self):
+        self._server = _Server((self.host, self.port), self._handler_class())
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def reset(self):
+        """Забывает запросы, объекты и заданные сбои"""
+        with self.lock:
+            self.requests.clear()
+            self.connections.clear()
+            self.objects.clear()
+            self.idempotent.clear()
+            self.failures.clear()
+            self.delay = 0
+
+    def fail(self, status=500, times=1, message='Stub failure'):
+        """Следующие times запросов получат ошибку со статусом status"""
+        with self.lock:
+            self.failures.extend([(status, message)] * times)
+
+    def new_id(self, prefix):
+        with self.lock:
+            self.counter += 1
+            return f'{prefix}_test_{self.counter:06d}'
+
+    def save(self, obj):
+        with self.lock:
+            self.objects[obj['id']] = obj
+        return obj
+
+    def event(self, event_type, obj, created=None):
+        """Событие Stripe с объектом obj, как его присылает вебхук"""
+        return {
+            'id': self.new_id('evt'),
+            'object': 'event',
+            'type': event_type,
+            'created': int(time.time()) if created is None else created,
+            'data': {'object': obj},
+        }
+
+    def payment_intent(self, amount, created=None, status='succeeded', metadata=None):
+        """Создает платеж (PaymentIntent) на amount центов"""
+        return self.save({
+            'id': self.new_id('pi'),
+            'object': 'payment_intent',
+            'amount': amount,
+            'amount_received': amount if status == 'succeeded' else 0,
+            'currency': 'usd',
+            'status': status,
+            'metadata': metadata or {},
+            'created': int(time.time()) if created is None else created,
+        })
+
+    def complete_session(self, session_id, amount_total, payment_status='paid', event_type=None):
+        """Завершает сессию Checkout и возвращает событие о завершении"""
+        intent = None
+        if payment_status == 'paid':
+            intent = self.payment_intent(amount_total, metadata=self.objects[session_id].get('metadata'))
+        with self.lock:
+            session = self.objects[session_id]
+            session.update(status='complete', payment_status=payment_status, amount_total=amount_total,
+                           currency='usd', payment_intent=intent['id'] if intent else None)
+            session = dict(session)
+        return self.event(event_type or 'checkout.session.completed', session)
+
+    def paid_session(self, amount_total, created=None, metadata=None):
+        """Оплаченная сессия Checkout с ее PaymentIntent, созданная в момент created"""
+        created = int(time.time()) if created is None else created
+        intent = self.payment_intent(amount_total, created=created, metadata=metadata)
+        return self.save({
+            'id': self.new_id('cs'),
+            'object': 'checkout.session',
+            'mode': 'payment',
+            'status': 'complete',
+            'payment_status': 'paid',
+            'amount_total': amount_total,
+            'currency': 'usd',
+            'payment_intent': intent['id'],
+            'metadata': metadata or {},
+            'created': created,
+        })
+
+    # Обработчики возвращают (статус, тело ответа)
+
+    def create_checkout_session(self, params, **kwargs):
+        session_id = self.new_id('cs')
+        line_items = params.get('line_items', [])
+        created = int(time.time())
+        return 200, self.save({
+            'id': session_id,
+            'object': 'checkout.session',
+            'url': f'https://checkout.stripe.com/c/pay/{session_id}',
+            'mode': params.get('mode', 'payment'),
+            'status': 'open',
+            'payment_status': 'unpaid',
+            'amount_total': None,
+            'currency': None,
+            'client_reference_id': params.get('client_reference_id'),
+            'customer_email': params.get('customer_email'),
+            'metadata': params.get('metadata', {}),
+            'line_items': line_items,
+            'success_url': params.get('success_url'),
+            'cancel_url': params.get('cancel_url'),
+            'created': created,
+            # Как в Stripe: по умолчанию сессия действует 24 часа
+            'expires_at': int(params.get('expires_at') or created + 24 * 60 * 60),
+        })
+
+    def create_product(self, params, **kwargs):
+        if not params.get('name'):
+            return 400, error('invalid_request_error', 'Missing required param: name.', code='parameter_missing')
+        return 200, self.save({
+            'id': self.new_id('prod'),
+            'object': 'product',
+            'name': params['name'],
+            'active': True,
+            'metadata': params.get('metadata', {}),
+            'created': int(time.time()),
+        })
+
+    def create_price(self, params, **kwargs):
+        if params.get('product') not in self.objects:
+            return 400, error('invalid_request_error', f"No such product: '{params.get('product')}'",
+                              code='resource_missing')
+        return 200, self.save({
+            'id': self.new_id('price'),
+            'object': 'price',
+            'product': params['product'],
+            'unit_amount': int(params['unit_amount']),
+            'currency': params.get('currency'),
+            'active': True,
+            'metadata': params.get('metadata', {}),
+            'created': int(time.time()),
+        })
+
+    def update(self, params, object_id, **kwargs):
+        obj = self.objects.get(object_id)
+        if obj is None:
+            return 404, error('invalid_request_error', f"No such object: '{object_id}'", code='resource_missing')
+        changes = dict(params)
+        if 'active' in changes:
+            changes['active'] = changes['active'] == 'true'
+        with self.lock:
+            obj.update(changes)
+        return 200, obj
+
+    def retrieve(self, params, object_id, **kwargs):
+        obj = self.objects.get(object_id)
+        if obj is None:
+            return 404, error('invalid_request_error', f"No such object: '{object_id}'", code='resource_missing')
+        return 200, obj
+
+    def list_objects(self, object_type, params, **filters):
+        """
+        Страница списка как в Stripe: новые объекты первыми, фильтр created[gte/gt/lte/lt],
+        limit (до 100) и курсор starting_after
+        """
+        created = params.get('created') or {}
+        bounds = {name: int(value) for name, value in created.items()} if isinstance(created, dict) else {}
+        with self.lock:
+            items = [
+                obj for obj in self.objects.values()
+                if obj.get('object') == object_type
+                and all(obj.get(name) == value for name, value in filters.items())
+                and ('gte' not in bounds or obj['created'] >= bounds['gte'])
+                and ('gt' not in bounds or obj['created'] > bounds['gt'])
+                and ('lte' not in bounds or obj['created'] <= bounds['lte'])
+                and ('lt' not in bounds or obj['created'] < bounds['lt'])
+            ]
+        items.sort(key=lambda obj: (obj['created'], obj['id']), reverse=True)
+        starting_after = params.get('starting_after')
+        if starting_after:
+            ids = [obj['id'] for obj in items]
+            items = items[ids.index(starting_after) + 1:] if starting_after in ids else []
+        limit = min(int(params.get('limit') or 10), 100)
+        return 200, {'object': 'list', 'data': items[:limit], 'has_more': len(items) > limit}
+
+    def list_checkout_sessions(self, params, **kwargs):
+        filters = {'status': params['status']} if params.get('status') else {}
+        return self.list_objects('checkout.session', params, **filters)
+
+    def list_payment_intents(self, params, **kwargs):
+        return self.list_objects('payment_intent', params)
+
+    def dispatch(self, method, path, params, headers):
+        request = {'method': method, 'path': path, 'params': params, 'headers': headers,
+                   'started': time.monotonic(), 'finished': None}
+        try:
+            return self._dispatch(request)
+        finally:
+            request['finished'] = time.monotonic()
+
+    def _dispatch(self, request):
+        method, path, params, headers = request['method'], request['path'], request['params'], request['headers']
+        with self.lock:
+            self.requests.append(request)
+            failure = self.failures.pop(0) if self.failures else None
+            key = headers.get('Idempotency-Key') if method == 'POST' else None
+            if failure is None and key in self.idempotent:
+                return self.idempotent[key]
+        if self.delay:
+            time.sleep(self.delay)
+        if failure is not None:
+            status, message = failure
+            return status, error('api_error', message)
+
+        for route_method, pattern, handler in self.routes:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                response = handler(params, **match.groupdict())
+                break
+        else:
+            response = 404, error('invalid_request_error', f'Unrecognized request URL ({method}: {path})')
+
+        if key is not None:
+            with self.lock:
+                self.idempotent[key] = response
+        return response
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                path, _, query = self.path.partition('?')
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode() if length else query
+                with stub.lock:
+                    stub.connections.add(self.client_address)
+                status, payload = stub.dispatch(
+                    self.command, path, unflatten(parse_qsl(body, keep_blank_values=True)), dict(self.headers)
+                )
+                content = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальный заменитель API Stripe')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12111)
+    arguments = parser.parse_args()
+    stub = StripeStub(arguments.host, arguments.port).start()
+    print(f'Stripe stub: {stub.url}')
+    try:
+        stub._thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
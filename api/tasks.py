@@ -0,0 +1,35 @@
+"""
+Фоновые задачи приложения api (api.jobs).
+
+Обе задачи exclusive: очередь событий Stripe должен обрабатывать один обработчик,
+а исходящие события одного адреса должны уходить по порядку. Каждая задача делает одну
+пачку (раунд), чтобы уложиться в срок захвата, и ставит себя в очередь снова, пока работа есть.
+"""
+from django.utils import timezone
+
+from . import jobs, outbox, webhooks
+
+
+@jobs.task('api.process_stripe_events', priority=10, exclusive=True)
+def process_stripe_events():
+    """Пачка очереди событий Stripe; ставится в очередь при приеме события (store_event)"""
+    events, created, confirmed = webhooks.process_batch()
+    if events:
+        jobs.enqueue('api.process_stripe_events')
+
+
+@jobs.task('api.deliver_webhooks', exclusive=True)
+def deliver_webhooks():
+    """Раунд доставки исходящих вебхуков; ставится в очередь при записи события (outbox.record)"""
+    with outbox.Deliverer() as deliverer:
+        delivered, failed = deliverer.deliver_round()
+    if delivered:
+        jobs.enqueue('api.deliver_webhooks')
+    # Адреса на паузе после ошибки: повтор к ближайшей попытке. Свой ключ, чтобы отложенный
+    # повтор не мешал поставить в очередь немедленную доставку новых событий
+    next_attempt_at = outbox.next_attempt_at()
+    if next_attempt_at is not None:
+        jobs.enqueue(
+            'api.deliver_webhooks', key='api.deliver_webhooks:retry',
+            delay=max(0, (next_attempt_at - timezone.now()).total_seconds()),
+        )
@@ -1,3 +1,1095 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api import deadlines, jobs, outbox, reconciliation, webhooks
+from api.idempotency import purge_expired
+from api.middleware import AdmissionController, EndpointClass, get_admission_controller
+from api.services import CircuitBreaker, StripeUnavailable, stripe_service
+from api.models import IdempotencyKey, Job, JobLock, OutboxEvent, StripeEvent, WebhookEndpoint
+from api.stripe_stub import StripeStub, sign
+from api.throttling import CacheRateStore, LocalRateStore, _local_store
+from materials.models import Course, Subscription
+from users.batch import insert_payments
+from users.models import Payment, User
+
+
+class RateStoreTestCase(TestCase):
+    """
+    Тесты алгоритма GCRA в хранилищах троттлинга.
+    """
+
+    def test_local_store_allows_burst_then_blocks(self):
+        """В окне пропускается ровно лимит запросов, дальше — отказ со временем ожидания"""
+        store = LocalRateStore()
+        now = 1000.0
+        results = [store.consume('k', now, interval=6, period=60) for _ in range(11)]
+
+        self.assertEqual(results[:10], [0] * 10)
+        self.assertAlmostEqual(results[10], 6)
+
+    def test_local_store_window_slides(self):
+        """После интервала освобождается место для одного запроса"""
+        store = LocalRateStore()
+        for _ in range(10):
+            store.consume('k', 1000.0, interval=6, period=60)
+
+        self.assertGreater(store.consume('k', 1003.0, interval=6, period=60), 0)
+        self.assertEqual(store.consume('k', 1006.0, interval=6, period=60), 0)
+
+    def test_local_store_forgets_expired_keys(self):
+        """Ключи с закончившимся окном удаляются, у продленного ключа одна запись о сроке"""
+        store = LocalRateStore()
+        for i in range(1000):
+            store.consume(f'user:{i}', 1000.0, interval=6, period=60)
+        for second in range(5):
+            store.consume('hot', 1000.0 + second, interval=6, period=60)
+        self.assertEqual(len(store._expiry), 1001)
+
+        store.consume('hot', 1010.0, interval=6, period=60)
+        self.assertEqual(set(store._data), {'hot'})
+        self.assertEqual(len(store._expiry), 1)
+
+    def test_cache_store_shares_state(self):
+        """Хранилище в кеше Django видит запросы, сделанные через другой экземпляр"""
+        first, second = CacheRateStore(), CacheRateStore()
+        self.assertEqual(first.consume('shared', 1000.0, interval=30, period=60), 0)
+        self.assertEqual(second.consume('shared', 1000.0, interval=30, period=60), 0)
+        self.assertGreater(first.consume('shared', 1000.0, interval=30, period=60), 0)
+
+    def test_local_store_overhead(self):
+        """Проверка лимита занимает доли миллисекунды"""
+        store = LocalRateStore()
+        started = time.perf_counter()
+        for i in range(10_000):
+            store.consume(f'user:{i % 100}', 1000.0 + i, interval=0.2, period=60)
+        per_call = (time.perf_counter() - started) / 10_000
+
+        self.assertLess(per_call, 0.0005)
+
+
+class TokenThrottleTestCase(TestCase):
+    """
+    Тесты троттлинга эндпоинта получения токена.
+    """
+
+    def setUp(self):
+        _local_store.clear()
+        self.user = User.objects.create_user(email='user@test.com', password='testpass123')
+        self.client = APIClient()
+
+    def tearDown(self):
+        _local_store.clear()
+
+    @override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': {'token': '2/min'}})
+    def test_token_endpoint_is_throttled(self):
+        """Третья попытка входа за минуту получает 429 и Retry-After"""
+        data = {'email': 'user@test.com', 'password': 'wrong-password'}
+        for _ in range(2):
+            response = self.client.post('/api/users/token/', data)
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = self.client.post('/api/users/token/', data)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+
+
+class AdmissionControlTestCase(TestCase):
+    """
+    Тесты контроля допуска запросов.
+    """
+
+    def make_controller(self, max_in_flight=10, reserved=0):
+        catalog = EndpointClass('catalog', [r'^/catalog/'], limit=1, queue=1, timeout=0.05, priority=0)
+        checkout = EndpointClass('checkout', [r'^/checkout/'], limit=1, queue=1, timeout=1, priority=2)
+        return AdmissionController([checkout, catalog], max_in_flight, reserved), catalog, checkout
+
+    def test_excess_requests_are_rejected(self):
+        """Сверх лимита и очереди запросы отклоняются, по таймауту в очереди — тоже"""
+        controller, catalog, _ = self.make_controller()
+
+        self.assertTrue(controller.acquire(catalog))
+        # Очередь из одного места: ждет и отваливается по таймауту
+        self.assertFalse(controller.acquire(catalog))
+        self.assertEqual(catalog.timed_out, 1)
+
+        catalog.waiting = catalog.queue  # очередь занята
+        self.assertFalse(controller.acquire(catalog))
+        self.assertEqual(catalog.rejected, 1)
+
+    def test_priority_class_uses_reserved_slots(self):
+        """Резервные слоты достаются только приоритетным классам"""
+        controller, catalog, checkout = self.make_controller(max_in_flight=1, reserved=1)
+
+        self.assertFalse(controller.acquire(catalog))
+        self.assertTrue(controller.acquire(checkout))
+
+    def test_waiting_request_gets_released_slot(self):
+        """Запрос из очереди получает слот, как только он освобождается"""
+        controller, _, checkout = self.make_controller()
+        self.assertTrue(controller.acquire(checkout))
+
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(controller.acquire(checkout)))
+        waiter.start()
+        time.sleep(0.05)
+        controller.release(checkout)
+        waiter.join()
+
+        self.assertEqual(result, [True])
+        self.assertEqual(checkout.queued, 1)
+
+    def test_priority_waiter_blocked_by_own_limit_does_not_block_others(self):
+        """Приоритетный запрос, упершийся в лимит своего класса, не задерживает остальные классы"""
+        controller, catalog, checkout = self.make_controller(max_in_flight=10)
+        self.assertTrue(controller.acquire(checkout))
+        checkout.waiting = 1  # ждет слота класса checkout, общих слотов свободно 9
+        self.assertTrue(controller.try_acquire(catalog))
+
+        controller.release(catalog)
+        controller.release(checkout)
+        self.assertFalse(controller.try_acquire(catalog))  # теперь checkout ждет общего слота
+
+    @override_settings(ADMISSION_CONTROL={
+        'ENABLED': True,
+        'MAX_IN_FLIGHT': 10,
+        'RETRY_AFTER': 2,
+        'CLASSES': {
+            'catalog': {'paths': [r'^/api/materials/'], 'limit': 1, 'queue': 0, 'timeout': 0.1},
+        },
+    })
+    def test_middleware_returns_503_with_retry_after(self):
+        """Перегруженный класс эндпоинтов отвечает 503 с Retry-After"""
+        controller = get_admission_controller()
+        catalog = controller.classify('/api/materials/courses/')
+        controller.acquire(catalog)
+
+        response = APIClient().get('/api/materials/courses/')
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '2')
+        self.assertEqual(controller.stats()['classes']['catalog']['rejected'], 1)
+
+
+class RequestDeadlineTestCase(TestCase):
+    """
+    Тесты бюджета времени запроса.
+    """
+
+    # Запрос, который выполняется заведомо дольше бюджета
+    SLOW_QUERY = (
+        'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 50000000) '
+        'SELECT count(*) FROM n'
+    )
+
+    def test_slow_sqlite_query_is_interrupted(self):
+        """Долгий запрос к SQLite прерывается по истечении бюджета"""
+        started = time.monotonic()
+        with deadlines.deadline(0.05):
+            with self.assertRaises(OperationalError):
+                with connection.cursor() as cursor:
+                    cursor.execute(self.SLOW_QUERY)
+
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_queries_without_deadline_are_not_affected(self):
+        """Без крайнего срока запросы выполняются как обычно"""
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            self.assertEqual(cursor.fetchone(), (1,))
+
+    def test_timeout_is_capped_by_remaining_budget(self):
+        """Таймаут внешнего вызова не превышает оставшийся бюджет"""
+        self.assertEqual(deadlines.cap_timeout((3, 20)), (3, 20))
+        with deadlines.deadline(1):
+            connect, read = deadlines.cap_timeout((3, 20))
+        self.assertLessEqual(connect, 1)
+        self.assertLessEqual(read, 1)
+
+    def test_middleware_returns_structured_504(self):
+        """Прерванный запрос к базе превращается в ответ 504"""
+        def view(request):
+            with connection.cursor() as cursor:
+                cursor.execute(self.SLOW_QUERY)
+            return HttpResponse()
+
+        view = deadlines.deadline_budget(0.05)(view)
+        request = RequestFactory().get('/slow/')
+        middleware = deadlines.RequestDeadlineMiddleware(lambda request: None)
+
+        middleware.process_view(request, view, (), {})
+        try:
+            view(request)
+        except OperationalError as e:
+            response = middleware.process_exception(request, e)
+        finally:
+            deadlines._deadline.reset(request._deadline_token)
+
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertIn(b'deadline_exceeded', response.content)
+
+
+STRIPE_TEST_CLIENT = {
+    'POOL_SIZE': 2,
+    'MAX_RETRIES': 2,
+    'BACKOFF_BASE': 0.001,
+    'BACKOFF_MAX': 0.01,
+    'BREAKER_FAILURES': 3,
+    'BREAKER_RESET': 30,
+}
+
+
+class StripeServiceTestCase(TestCase):
+    """
+    Тесты клиента Stripe на локальном заменителе API.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = StripeStub().start()
+        cls.addClassCleanup(cls.stub.stop)
+
+    def setUp(self):
+        """Свежий клиент и пустое состояние заменителя для каждого теста"""
+        cache.clear()
+        self.stub.reset()
+        overrides = override_settings(STRIPE_API_BASE=self.stub.url, STRIPE_CLIENT=STRIPE_TEST_CLIENT)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def create_session(self, **kwargs):
+        return stripe_service.create_checkout_session(
+            price_id='price_1', success_url='http://test/ok', cancel_url='http://test/cancel', **kwargs
+        )
+
+    def test_session_is_created_over_pooled_connection(self):
+        """Сессия создается через заменитель, повторные вызовы используют то же соединение"""
+        session = self.create_session(metadata={'course_id': '1'})
+        self.create_session()
+
+        self.assertTrue(session['id'].startswith('cs_test_'))
+        self.assertEqual(session.url, f'https://checkout.stripe.com/c/pay/{session.id}')
+        first = self.stub.requests[0]
+        self.assertEqual(first['params']['line_items'], [{'price': 'price_1', 'quantity': '1'}])
+        self.assertEqual(first['params']['metadata'], {'course_id': '1'})
+        self.assertTrue(first['headers']['Authorization'].startswith('Bearer '))
+        self.assertEqual(len(self.stub.connections), 1)
+
+    def test_failures_are_retried_with_same_idempotency_key(self):
+        """Сбои 5xx повторяются с тем же ключом идемпотентности, ошибки запроса — нет"""
+        self.stub.fail(500, times=2)
+        session = self.create_session()
+
+        self.assertEqual(len(self.stub.requests), 3)
+        keys = {request['headers']['Idempotency-Key'] for request in self.stub.requests}
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(len(self.stub.objects), 1)
+        self.assertIn(session.id, self.stub.objects)
+
+        self.stub.reset()
+        self.stub.fail(400)
+        with self.assertRaises(stripe.InvalidRequestError):
+            self.create_session()
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_breaker_opens_after_repeated_failures(self):
+        """После серии сбоев автомат размыкается и вызовы отклоняются без обращения к Stripe"""
+        self.stub.fail(503, times=3)
+        with self.assertRaises(stripe.APIError):
+            # Все три попытки неудачны — этого достаточно, чтобы разомкнуть автомат
+            self.create_session()
+        self.assertEqual(len(self.stub.requests), 3)
+        self.assertEqual(stripe_service.breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(StripeUnavailable):
+            self.create_session()
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_breaker_lets_one_probe_through_after_pause(self):
+        """После паузы пробный вызов замыкает автомат или снова размыкает его"""
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+        breaker.record_failure()
+        breaker.record_failure()
+        with self.assertRaises(StripeUnavailable):
+            breaker.before_call()
+
+        now[0] = 10
+        breaker.before_call()
+        with self.assertRaises(StripeUnavailable):
+            # Пока идет пробный вызов, остальные отклоняются
+            breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        now[0] = 20
+        breaker.before_call()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_probe_interrupted_by_other_error_does_not_stick(self):
+        """Пробный вызов, прерванный не ошибкой Stripe (например, сроком запроса), не блокирует автомат"""
+        breaker = stripe_service.breaker
+        breaker._opened_at = breaker._clock() - settings.STRIPE_CLIENT['BREAKER_RESET']
+
+        def interrupted(params, options):
+            raise deadlines.DeadlineExceeded()
+
+        async def interrupted_async(params, options):
+            raise asyncio.CancelledError()
+
+        with self.assertRaises(deadlines.DeadlineExceeded):
+            stripe_service.request(interrupted, {})
+        with self.assertRaises(asyncio.CancelledError):
+            async_to_sync(stripe_service.request_async)(interrupted_async, {})
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+        self.create_session()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_async_calls_do_not_wait_for_each_other(self):
+        """Асинхронные вызовы идут параллельно в одном потоке и повторяются с тем же ключом"""
+        self.stub.delay = 0.2
+
+        async def create_sessions():
+            return await asyncio.gather(*(
+                stripe_service.create_checkout_session_async(
+                    price_id='price_1', success_url='http://test/ok', cancel_url='http://test/cancel'
+                )
+                for _ in range(5)
+            ))
+
+        sessions = async_to_sync(create_sessions)()
+        self.assertEqual(len({session.id for session in sessions}), 5)
+        # Все 5 запросов начались до того, как закончился первый: они шли одновременно
+        self.assertLess(
+            max(request['started'] for request in self.stub.requests),
+            min(request['finished'] for request in self.stub.requests),
+        )
+
+        self.stub.reset()
+        self.stub.fail(500)
+        async_to_sync(create_sessions)()
+        self.assertEqual(len(self.stub.requests), 6)
+        self.assertEqual(len(self.stub.objects), 5)
+        # Соединения возвращаются в пул и используются повторно
+        self.assertLessEqual(len(self.stub.connections), 5)
+
+    def test_checkout_endpoints_use_service(self):
+        """Оба эндпоинта оплаты создают сессию через общий клиент"""
+        user = User.objects.create_user(email='buyer@test.com', password='testpass123')
+        course = Course.objects.create(title='Курс', price=1000, owner=user, stripe_price_id='price_course')
+        client = APIClient()
+        client.force_authenticate(user=user)
+
+        response = client.post('/api/stripe-payments/create-checkout/', {
+            'course_id': course.id, 'success_url': 'http://localhost:8000/ok', 'cancel_url': 'http://localhost:8000/cancel'
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertTrue(response.data['session_id'].startswith('cs_test_'))
+
+        response = client.post(f'/api/materials/courses/{course.id}/checkout/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stub.requests[-1]['params']['customer_email'], 'buyer@test.com')
+
+        self.stub.fail(503, times=3)
+        body = {'course_id': course.id, 'success_url': 'http://localhost:8000/ok', 'cancel_url': 'http://localhost:8000/no'}
+        response = client.post('/api/stripe-payments/create-checkout/', body, format='json')
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        response = client.post('/api/stripe-payments/create-checkout/', body, format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeWebhookTestCase(TestCase):
+    """
+    Тесты приема вебхуков Stripe и обработки очереди событий.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = StripeStub().start()
+        cls.addClassCleanup(cls.stub.stop)
+
+    def setUp(self):
+        cache.clear()
+        self.stub.reset()
+        overrides = override_settings(STRIPE_API_BASE=self.stub.url, STRIPE_CLIENT=STRIPE_TEST_CLIENT)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.user = User.objects.create_user(email='buyer@test.com', password='testpass123')
+        self.course = Course.objects.create(title='Курс', price=1000, owner=self.user, stripe_price_id='price_1')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def checkout(self):
+        response = self.client.post(f'/api/materials/courses/{self.course.id}/checkout/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['session_id']
+
+    def deliver(self, event, secret='whsec_test'):
+        payload = json.dumps(event)
+        return self.client.generic(
+            'POST', '/api/stripe/webhook/', payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=sign(payload, secret)
+        )
+
+    def payments(self):
+        return list(Payment.objects.filter(stripe_id__isnull=False))
+
+    def test_webhook_verifies_signature_and_deduplicates(self):
+        """Событие с чужой подписью отклоняется, повторная доставка сохраняется один раз"""
+        event = self.stub.event('checkout.session.completed', {'id': 'cs_1'})
+
+        self.assertEqual(self.deliver(event, secret='whsec_other').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(StripeEvent.objects.exists())
+
+        for _ in range(2):
+            response = self.deliver(event)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.json(), {'received': True})
+        self.assertEqual(StripeEvent.objects.get().event_id, event['id'])
+
+        with override_settings(STRIPE_WEBHOOK_SECRET=None):
+            self.assertEqual(self.deliver(event).status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_completed_session_creates_confirmed_payment_once(self):
+        """Оплаченная сессия дает подтвержденный платеж, доступ к курсу и новую сессию при повторе"""
+        session_id = self.checkout()
+        event = self.stub.complete_session(session_id, amount_total=100000)
+        self.deliver(event)
+        # Та же сессия в другом событии (Stripe может прислать несколько)
+        self.deliver(self.stub.complete_session(session_id, amount_total=100000))
+
+        self.assertEqual(webhooks.process_events(), (2, 1, 0))
+        payment, = self.payments()
+        self.assertEqual(payment.stripe_id, session_id)
+        self.assertEqual((payment.user, payment.paid_course), (self.user, self.course))
+        self.assertEqual(payment.amount, 1000)
+        self.assertTrue(payment.is_confirmed)
+        self.assertFalse(StripeEvent.objects.filter(processed_at__isnull=True).exists())
+        # Открытая сессия оплаченного курса больше не отдается из кеша
+        self.assertNotEqual(self.checkout(), session_id)
+
+        # Повтор уже обработанного события ничего не меняет
+        StripeEvent.objects.update(processed_at=None)
+        self.assertEqual(webhooks.process_events(), (2, 0, 0))
+        self.assertEqual(len(self.payments()), 1)
+
+    def test_paid_cart_fans_out_into_payment_per_course(self):
+        """Оплаченная корзина дает по подтвержденному платежу на курс, вставленных одной пачкой"""
+        second = Course.objects.create(title='Курс 2', price=250, owner=self.user, stripe_price_id='price_2')
+        response = self.client.post(
+            '/api/materials/cart/checkout/', {'course_ids': [self.course.id, second.id]}, format='json'
+        )
+        session_id = response.data['session_id']
+        self.deliver(self.stub.complete_session(session_id, amount_total=125000))
+
+        with mock.patch('api.webhooks.insert_payments', wraps=webhooks.insert_payments) as insert:
+            self.assertEqual(webhooks.process_events(), (1, 2, 0))
+        insert.assert_called_once()
+        payments = sorted(self.payments(), key=lambda payment: payment.amount)
+        self.assertEqual([(payment.paid_course, payment.amount) for payment in payments],
+                         [(second, 250), (self.course, 1000)])
+        self.assertTrue(all(payment.is_confirmed and payment.stripe_id == session_id for payment in payments))
+
+        # Повтор события ничего не добавляет, а корзина снова создает новую сессию
+        self.deliver(self.stub.complete_session(session_id, amount_total=125000))
+        self.assertEqual(webhooks.process_events(), (1, 0, 0))
+        self.assertEqual(len(self.payments()), 2)
+        response = self.client.post(
+            '/api/materials/cart/checkout/', {'course_ids': [second.id, self.course.id]}, format='json'
+        )
+        self.assertNotEqual(response.data['session_id'], session_id)
+
+    def test_out_of_order_events_never_unconfirm(self):
+        """Подтверждение, пришедшее раньше завершения, не отменяется; позднее — подтверждает платеж"""
+        first = self.checkout()
+        succeeded = self.stub.complete_session(first, 100000, event_type='checkout.session.async_payment_succeeded')
+        completed = self.stub.complete_session(first, 100000, payment_status='unpaid')
+        completed['created'] = succeeded['created'] - 10
+        self.deliver(succeeded)
+        webhooks.process_events()
+        self.deliver(completed)
+        webhooks.process_events()
+        self.assertTrue(Payment.objects.get(stripe_id=first).is_confirmed)
+
+        cache.clear()
+        second = self.checkout()
+        self.deliver(self.stub.complete_session(second, 100000, payment_status='unpaid'))
+        webhooks.process_events()
+        self.assertFalse(Payment.objects.get(stripe_id=second).is_confirmed)
+        self.deliver(self.stub.complete_session(
+            second, 100000, event_type='checkout.session.async_payment_succeeded'
+        ))
+        self.assertEqual(webhooks.process_events(), (1, 0, 1))
+        self.assertTrue(Payment.objects.get(stripe_id=second).is_confirmed)
+
+    def test_failing_event_does_not_block_others(self):
+        """Ошибка одного события не мешает остальным, событие повторяется до MAX_ATTEMPTS"""
+        other = User.objects.create_user(email='other@test.com', password='testpass123')
+        self.deliver(self.stub.event('checkout.session.completed', {
+            'id': 'cs_bad', 'payment_status': 'paid', 'amount_total': 100000,
+            'metadata': {'user_id': str(other.id), 'course_id': str(self.course.id)},
+        }))
+        self.deliver(self.stub.complete_session(self.checkout(), amount_total=100000))
+        forget = webhooks.checkout_cache.forget
+
+        def failing_forget(user_id, course_id):
+            if user_id == other.id:
+                raise RuntimeError('сбой')
+            forget(user_id, course_id)
+
+        with override_settings(STRIPE_EVENTS={'BATCH_SIZE': 10, 'MAX_ATTEMPTS': 2}), \
+                mock.patch('api.webhooks.checkout_cache.forget', failing_forget):
+            # Два события в первой пачке и повтор ошибочного во второй
+            self.assertEqual(webhooks.process_events(), (3, 1, 0))
+
+        bad = StripeEvent.objects.get(payload__data__object__id='cs_bad')
+        self.assertIsNone(bad.processed_at)
+        self.assertEqual(bad.attempts, 2)
+        self.assertIn('сбой', bad.last_error)
+        self.assertEqual([payment.user for payment in self.payments()], [self.user])
+
+
+class IdempotencyTestCase(TestCase):
+    """
+    Тесты заголовка Idempotency-Key.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='mobile@test.com', password='testpass123')
+        self.other = User.objects.create_user(email='other@test.com', password='testpass123')
+        self.course = Course.objects.create(title='Курс', price=1000, owner=self.user)
+
+    def pay(self, key, user=None, amount='100.00'):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user or self.user)}')
+        return client.post(
+            '/api/users/payments/',
+            {'paid_course': self.course.id, 'amount': amount, 'payment_method': 'cash'},
+            format='json', HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_retry_replays_response_without_second_payment(self):
+        """Повтор с тем же ключом получает тот же ответ, платеж создается один раз"""
+        first = self.pay('retry-1')
+        second = self.pay('retry-1')
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Payment.objects.filter(user=self.user).count(), 1)
+
+        # Другой ключ и тот же ключ другого пользователя — новые запросы
+        self.assertEqual(self.pay('retry-2').status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.pay('retry-1', user=self.other).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Payment.objects.count(), 3)
+
+    def test_concurrent_duplicate_and_reused_key_are_rejected(self):
+        """Дубль выполняющегося запроса получает 409, ключ с другим телом — 422"""
+        self.pay('used')
+        self.assertEqual(self.pay('used', amount='200.00').status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        now = timezone.now()
+        self.pay('locked')
+        IdempotencyKey.objects.filter(key='locked').update(
+            status_code=None, locked_until=now + timedelta(seconds=60)
+        )
+        response = self.pay('locked')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Retry-After'], '1')
+
+        # Блокировка упавшего воркера истекла — запрос выполняется заново
+        IdempotencyKey.objects.filter(key='locked').update(locked_until=now - timedelta(seconds=1))
+        self.assertEqual(self.pay('locked').status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Payment.objects.filter(user=self.user).count(), 3)
+
+    def test_anonymous_and_token_requests_are_not_stored(self):
+        """Ответы с токенами и анонимные запросы не сохраняются и не воспроизводятся"""
+        client = APIClient()
+        credentials = {'email': 'mobile@test.com', 'password': 'testpass123'}
+        response = client.post('/api/users/token/', credentials, format='json', HTTP_IDEMPOTENCY_KEY='login')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        refreshed = client.post(
+            '/api/users/token/refresh/', {'refresh': response.json()['refresh']}, format='json',
+            HTTP_IDEMPOTENCY_KEY='refresh'
+        )
+        self.assertEqual(refreshed.status_code, status.HTTP_200_OK)
+        self.assertFalse(refreshed.has_header('Idempotent-Replayed'))
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_failures_and_expired_keys_are_not_replayed(self):
+        """Ошибка сервера освобождает ключ, истекший ключ выполняется заново"""
+        with mock.patch('users.views.PaymentViewSet.create', side_effect=RuntimeError('сбой')):
+            client = APIClient(raise_request_exception=False)
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+            response = client.post('/api/users/payments/', {}, format='json', HTTP_IDEMPOTENCY_KEY='flaky')
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertFalse(IdempotencyKey.objects.filter(key='flaky').exists())
+
+        self.pay('old')
+        IdempotencyKey.objects.filter(key='old').update(expires_at=timezone.now())
+        self.assertNotIn('Idempotent-Replayed', self.pay('old'))
+        self.assertEqual(Payment.objects.filter(user=self.user).count(), 2)
+
+        self.assertEqual(purge_expired(), 0)
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        self.assertEqual(purge_expired(), 1)
+
+
+    @override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=1024)
+    def test_large_multipart_upload_is_fingerprinted_without_reading_body(self):
+        """Загрузка больше DATA_UPLOAD_MAX_MEMORY_SIZE с ключом выполняется один раз, а не получает 400"""
+        admin = User.objects.create_user(email='admin@test.com', password='testpass123', is_staff=True)
+        lines = ''.join(f'upload{index}@school.com,pass-{index}\n' for index in range(100))
+        content = f'email,password\n{lines}'.encode()
+        self.assertGreater(len(content), settings.DATA_UPLOAD_MAX_MEMORY_SIZE)
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(admin)}')
+
+        def upload(data):
+            return client.post(
+                '/api/users/users/import/',
+                {'file': SimpleUploadedFile('users.csv', data, content_type='text/csv')},
+                format='multipart', HTTP_IDEMPOTENCY_KEY='import-1'
+            )
+
+        first = upload(content)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.json()['created'], 100)
+
+        second = upload(content)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(User.objects.filter(email__startswith='upload').count(), 100)
+
+        # Другой файл с тем же ключом — другой запрос
+        changed = upload(content.replace(b'upload0@', b'upload-new@'))
+        self.assertEqual(changed.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+@override_settings(STRIPE_RECONCILE={'SLICES': 4, 'WORKERS': 4, 'RATE': '1000/s', 'MARGIN': 3600})
+class ReconciliationTestCase(TestCase):
+    """
+    Тесты сверки платежей со Stripe.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = StripeStub().start()
+        cls.addClassCleanup(cls.stub.stop)
+
+    def setUp(self):
+        self.stub.reset()
+        overrides = override_settings(STRIPE_API_BASE=self.stub.url, STRIPE_CLIENT=STRIPE_TEST_CLIENT)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.user = User.objects.create_user(email='buyer@test.com', password='testpass123')
+        self.now = timezone.now()
+        self.since = self.now - timedelta(hours=3)
+        self.until = self.now + timedelta(hours=1)
+
+    def paid_sessions(self, count):
+        """Оплаченные сессии по 10.00, созданные равномерно за период"""
+        start = int(self.since.timestamp())
+        step = int((self.now - self.since).total_seconds()) // count
+        return [self.stub.paid_session(1000, created=start + index * step) for index in range(count)]
+
+    def record(self, sessions, **overrides):
+        payments = []
+        for session in sessions:
+            fields = {'stripe_id': session['id'], 'amount': 10, 'is_confirmed': True, **overrides}
+            payments.append(Payment(user=self.user, payment_method=Payment.PaymentMethod.TRANSFER, **fields))
+        insert_payments(payments)
+
+    def test_reports_missing_extra_and_mismatched_payments(self):
+        """Сверка находит все виды расхождений, листая страницы параллельно"""
+        sessions = self.paid_sessions(250)
+        missing, by_intent, mismatched, unconfirmed, *matched = sessions
+        self.record(matched)
+        self.record([by_intent], stripe_id=by_intent['payment_intent'])
+        self.record([mismatched], amount=12)
+        self.record([unconfirmed], is_confirmed=False)
+        self.record([{'id': 'cs_unknown'}])
+        standalone = self.stub.payment_intent(500, created=int(self.now.timestamp()) - 60)
+        # Вне периода (с учетом запаса) — не сверяется
+        self.stub.paid_session(1000, created=int((self.since - timedelta(hours=2)).timestamp()))
+
+        report = reconciliation.reconcile(self.since, self.until)
+
+        self.assertEqual(report.remote, 251)
+        self.assertEqual(report.local, 250)
+        self.assertEqual(report.missing, [(missing['id'], Decimal('10')), (standalone['id'], Decimal('5'))])
+        self.assertEqual([row[1] for row in report.extra], ['cs_unknown'])
+        self.assertEqual([row[1:] for row in report.mismatched], [(mismatched['id'], Decimal('12'), Decimal('10'))])
+        self.assertEqual([row[1] for row in report.unconfirmed], [unconfirmed['id']])
+        self.assertFalse(report.ok)
+        # Больше страниц, чем интервалов: интервалы листались постранично
+        self.assertGreater(report.pages, 8)
+
+    def test_fix_confirms_payments_paid_in_stripe(self):
+        """С fix=True неподтвержденные, но оплаченные платежи подтверждаются"""
+        sessions = self.paid_sessions(3)
+        self.record(sessions, is_confirmed=False)
+        # Платеж из старой сессии: в период попадает только по stripe_id
+        old = self.stub.paid_session(1000, created=int(self.now.timestamp()))
+        self.record([old])
+        Payment.objects.filter(stripe_id=old['id']).update(payment_date=self.since - timedelta(days=30))
+
+        report = reconciliation.reconcile(self.since, self.until, fix=True)
+
+        self.assertEqual(report.fixed, 3)
+        self.assertTrue(report.ok)
+        self.assertEqual(report.missing, [])
+        self.assertEqual(Payment.objects.filter(is_confirmed=True).count(), 4)
+
+        out = io.StringIO()
+        call_command('reconcile_stripe', since=str(self.since.date()),
+                     until=str((self.until + timedelta(days=1)).date()), stdout=out)
+        self.assertIn('Расхождений нет', out.getvalue())
+
+
+class PartnerServer:
+    """Локальный сервер партнера: сохраняет полученные вебхуки, отвечает статусами из statuses"""
+
+    def __init__(self, delay=0):
+        self.received = []
+        self.statuses = []
+        self.delay = delay
+        # (начало, конец) обработки каждого запроса
+        self.timings = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                started = time.monotonic()
+                time.sleep(server.delay)
+                server.timings.append((started, time.monotonic()))
+                status_code = server.statuses.pop(0) if server.statuses else 200
+                if status_code == 200:
+                    server.received.append((body, self.headers[outbox.SIGNATURE_HEADER]))
+                self.send_response(status_code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self._server.server_address[1]}/hooks'
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def events(self):
+        return [event for body, _ in self.received for event in json.loads(body)['events']]
+
+
+@override_settings(OUTBOUND_WEBHOOKS={
+    'BATCH_SIZE': 100, 'WORKERS': 4, 'TIMEOUT': 5, 'BACKOFF_BASE': 60, 'BACKOFF_MAX': 3600, 'RETENTION_DAYS': 7,
+})
+class OutboundWebhookTestCase(TestCase):
+    """
+    Тесты исходящих вебхуков.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@test.com', password='testpass123')
+
+    def partner(self, **kwargs):
+        partner = PartnerServer(**kwargs)
+        self.addCleanup(partner.stop)
+        return partner
+
+    def deliver(self, **kwargs):
+        with outbox.Deliverer(**kwargs) as deliverer:
+            return deliverer.deliver()
+
+    def test_model_changes_are_queued_per_endpoint(self):
+        """Сигналы только пишут события в очередь подходящих адресов"""
+        everything = WebhookEndpoint.objects.create(url='http://crm.test/hooks')
+        payments = WebhookEndpoint.objects.create(
+            url='http://accounting.test/hooks', event_types=['payment.created', 'payment.confirmed']
+        )
+        WebhookEndpoint.objects.create(url='http://old.test/hooks', is_active=False)
+
+        course = Course.objects.create(title='Курс', price=1000, owner=self.user)
+        Subscription.objects.create(user=self.user, course=course)
+        payment = Payment.objects.create(user=self.user, paid_course=course, amount=1000)
+        payment.is_confirmed = True
+        payment.save()
+        insert_payments([Payment(user=self.user, amount=10), Payment(user=self.user, amount=20)])
+
+        self.assertEqual(list(everything.events.values_list('type', flat=True)), [
+            'course.created', 'subscription.created', 'payment.created', 'payment.confirmed',
+            'payment.created', 'payment.created',
+        ])
+        self.assertEqual(payments.events.count(), 4)
+        self.assertEqual(OutboxEvent.objects.count(), 10)
+        # Одно событие для всех адресов — один ID
+        self.assertEqual(
+            set(everything.events.filter(type='payment.confirmed').values_list('event_id', flat=True)),
+            set(payments.events.filter(type='payment.confirmed').values_list('event_id', flat=True)),
+        )
+        self.assertEqual(payments.events.filter(type='payment.confirmed').get().payload['id'], payment.pk)
+
+    def test_events_are_delivered_in_signed_ordered_batches(self):
+        """События адреса уходят пачками по порядку, с проверяемой подписью"""
+        crm, accounting = self.partner(), self.partner()
+        first = WebhookEndpoint.objects.create(url=crm.url)
+        second = WebhookEndpoint.objects.create(url=accounting.url, event_types=['course.deleted'])
+        courses = Course.objects.bulk_create([Course(title=f'Курс {index}', owner=self.user) for index in range(250)])
+        for course in courses:
+            outbox.record('course.updated', [outbox.course_data(course)])
+        course_ids = [course.id for course in courses]
+        courses[0].delete()
+
+        self.assertEqual(self.deliver(), (252, 0))
+
+        self.assertEqual(len(crm.received), 3)
+        self.assertEqual([event['data']['id'] for event in crm.events()][:250], course_ids)
+        self.assertEqual([event['type'] for event in accounting.events()], ['course.deleted'])
+        body, signature = crm.received[0]
+        timestamp = signature.split(',')[0][2:]
+        self.assertEqual(outbox.sign(body, first.secret, int(timestamp)), signature)
+        self.assertFalse(OutboxEvent.objects.filter(delivered_at__isnull=True).exists())
+        self.assertEqual(self.deliver(), (0, 0))
+        self.assertEqual(second.events.get().attempts, 1)
+
+    def test_failing_endpoint_backs_off_without_reordering(self):
+        """После ошибки адрес ждет паузу, а потом получает события в исходном порядке"""
+        partner, healthy = self.partner(), self.partner()
+        partner.statuses = [500]
+        endpoint = WebhookEndpoint.objects.create(url=partner.url)
+        WebhookEndpoint.objects.create(url=healthy.url)
+        course = Course.objects.create(title='Курс', price=1000, owner=self.user)
+
+        self.assertEqual(self.deliver(batch_size=1), (1, 1))
+        endpoint.refresh_from_db()
+        self.assertEqual(endpoint.failures, 1)
+        self.assertGreater(endpoint.next_attempt_at, timezone.now() + timedelta(seconds=25))
+        self.assertIn('HTTP 500', endpoint.last_error)
+
+        # Новое событие не обгоняет недоставленное: адрес на паузе
+        course.delete()
+        self.assertEqual(self.deliver(batch_size=1), (1, 0))
+        self.assertEqual(partner.received, [])
+
+        WebhookEndpoint.objects.filter(pk=endpoint.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(self.deliver(batch_size=1), (2, 0))
+        self.assertEqual([event['type'] for event in partner.events()], ['course.created', 'course.deleted'])
+        endpoint.refresh_from_db()
+        self.assertEqual((endpoint.failures, endpoint.next_attempt_at), (0, None))
+
+    def test_slow_endpoints_are_served_concurrently(self):
+        """Медленные адреса обслуживаются параллельно, а не по очереди"""
+        partners = [self.partner(delay=0.3) for _ in range(4)]
+        WebhookEndpoint.objects.bulk_create([WebhookEndpoint(url=partner.url) for partner in partners])
+        Course.objects.create(title='Курс', price=1000, owner=self.user)
+
+        self.assertEqual(self.deliver(), (4, 0))
+        # Каждый адрес получил запрос до того, как ответил первый из них
+        timings = [timing for partner in partners for timing in partner.timings]
+        self.assertEqual(len(timings), 4)
+        self.assertLess(max(started for started, _ in timings), min(finished for _, finished in timings))
+
+
+executed_jobs = []
+
+
+@jobs.task('tests.record')
+def record_job(value):
+    executed_jobs.append(value)
+
+
+@jobs.task('tests.fail', max_attempts=2)
+def failing_job():
+    raise RuntimeError('Партнер недоступен')
+
+
+@jobs.task('tests.exclusive', exclusive=True)
+def exclusive_job():
+    pass
+
+
+class JobQueueTestCase(TestCase):
+    """
+    Тесты очереди фоновых задач.
+    """
+
+    def setUp(self):
+        executed_jobs.clear()
+
+    def test_enqueue_joins_transaction_and_deduplicates_by_key(self):
+        """Задача появляется только с коммитом, ключ не дает дублей в очереди"""
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                jobs.enqueue('tests.record', ['откат'])
+                raise RuntimeError
+        self.assertFalse(Job.objects.exists())
+
+        jobs.enqueue('tests.record', ['первая'], key='report')
+        jobs.enqueue('tests.record', ['вторая'], key='report')
+        jobs.enqueue('tests.exclusive')
+        jobs.enqueue('tests.exclusive')
+        self.assertEqual(Job.objects.count(), 2)
+        with self.assertRaises(LookupError):
+            jobs.enqueue('tests.unknown')
+
+        self.assertEqual(jobs.run_ready(), (2, 0))
+        self.assertEqual(executed_jobs, ['первая'])
+        # Выполненная задача не мешает поставить новую с тем же ключом
+        jobs.enqueue('tests.record', ['третья'], key='report')
+        self.assertEqual(Job.objects.filter(status=Job.Status.QUEUED).count(), 1)
+
+    def test_ready_jobs_run_by_priority_and_delayed_jobs_wait(self):
+        """Сначала больший приоритет, отложенные задачи ждут своего времени"""
+        jobs.enqueue('tests.record', ['обычная'])
+        jobs.enqueue('tests.record', ['позже'], delay=60)
+        jobs.enqueue('tests.record', ['срочная'], priority=10)
+
+        self.assertEqual(jobs.run_ready(), (2, 0))
+        self.assertEqual(executed_jobs, ['срочная', 'обычная'])
+        self.assertEqual(jobs.stats()['scheduled'], 1)
+
+    def test_failed_job_is_retried_with_backoff_then_marked_failed(self):
+        """Ошибка — повтор с паузой, после последней попытки задача остается с ошибкой"""
+        jobs.enqueue('tests.fail')
+        self.assertEqual(jobs.run_ready(), (0, 1))
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.Status.QUEUED, 1))
+        self.assertGreater(job.run_at, timezone.now() + timedelta(seconds=1))
+        self.assertIn('Партнер недоступен', job.last_error)
+
+        Job.objects.update(run_at=timezone.now())
+        self.assertEqual(jobs.run_ready(), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.Status.FAILED, 2))
+        self.assertEqual(jobs.stats()['statuses'][Job.Status.FAILED], 1)
+
+    def test_exclusive_job_waits_and_stale_job_is_requeued(self):
+        """Exclusive-задача не берется, пока такая же выполняется; брошенная возвращается в очередь"""
+        jobs.enqueue('tests.exclusive')
+        [running] = jobs.claim('worker-1')
+        jobs.enqueue('tests.exclusive')
+        self.assertEqual(jobs.claim('worker-2'), [])
+
+        self.assertEqual(jobs.requeue_stale(timezone.now() + timedelta(seconds=settings.JOBS['LEASE'] + 1)), 1)
+        # Повтор брошенной задачи вернулся в очередь без ключа: там уже ждала новая
+        self.assertEqual(Job.objects.filter(status=Job.Status.QUEUED).count(), 2)
+        # Опоздавший воркер не затирает состояние перехваченной задачи
+        self.assertTrue(jobs.run(running))
+        self.assertEqual(Job.objects.get(pk=running.pk).status, Job.Status.QUEUED)
+
+    def test_exclusive_job_is_postponed_while_lock_is_held(self):
+        """Пока блокировку задачи держит команда, задача откладывается без траты попытки"""
+        jobs.enqueue('tests.exclusive')
+        with jobs.lock('tests.exclusive'):
+            with self.assertRaises(jobs.LockHeld):
+                with jobs.lock('tests.exclusive'):
+                    pass
+            self.assertEqual(jobs.run_ready(), (0, 0))
+        with jobs.lock('api.process_stripe_events'):
+            with self.assertRaises(CommandError):
+                call_command('process_stripe_events', stdout=io.StringIO())
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.Status.QUEUED, 0))
+        self.assertGreater(job.run_at, timezone.now())
+
+        Job.objects.update(run_at=timezone.now())
+        self.assertEqual(jobs.run_ready(), (1, 0))
+        self.assertFalse(JobLock.objects.exists())
+
+    @override_settings(STRIPE_EVENTS={**settings.STRIPE_EVENTS, 'BATCH_SIZE': 2})
+    def test_stripe_events_job_processes_one_batch_per_run(self):
+        """Задача обрабатывает одну пачку событий и ставит себя в очередь, пока события есть"""
+        for index in range(3):
+            webhooks.store_event({'id': f'evt_{index}', 'type': 'customer.created', 'created': index})
+        [job] = jobs.claim('worker-1')
+        self.assertTrue(jobs.run(job))
+        self.assertEqual(StripeEvent.objects.filter(processed_at__isnull=True).count(), 1)
+        self.assertEqual(Job.objects.filter(status=Job.Status.QUEUED).count(), 1)
+
+        jobs.run_ready()
+        self.assertFalse(StripeEvent.objects.filter(processed_at__isnull=True).exists())
+        self.assertFalse(Job.objects.filter(status=Job.Status.QUEUED).exists())
+
+    def test_stats_endpoint_is_for_admins(self):
+        """Статистика очереди доступна только администраторам"""
+        jobs.enqueue('tests.record', ['a'])
+        client = APIClient()
+        user = User.objects.create_user(email='user@test.com', password='testpass123')
+        client.force_authenticate(user=user)
+        self.assertEqual(client.get('/api/jobs/stats/').status_code, status.HTTP_403_FORBIDDEN)
+
+        admin = User.objects.create_user(email='admin@test.com', password='testpass123', is_staff=True)
+        client.force_authenticate(user=admin)
+        response = client.get('/api/jobs/stats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['ready'], 1)
+        self.assertEqual(response.data['tasks']['tests.record'][Job.Status.QUEUED], 1)
+
+    def test_model_changes_enqueue_processing_jobs(self):
+        """Прием события Stripe и запись исходящего вебхука ставят по одной задаче обработки"""
+        WebhookEndpoint.objects.create(url='http://crm.test/hooks')
+        user = User.objects.create_user(email='owner@test.com', password='testpass123')
+        Course.objects.create(title='Курс 1', owner=user)
+        Course.objects.create(title='Курс 2', owner=user)
+        webhooks.store_event({'id': 'evt_1', 'type': 'checkout.session.completed', 'created': 1})
+
+        self.assertEqual(
+            sorted(Job.objects.values_list('name', flat=True)), ['api.deliver_webhooks', 'api.process_stripe_events']
+        )
+
+
+class JobWorkerTestCase(TransactionTestCase):
+    """
+    Тест воркера: потоки не выполняют одну задачу дважды.
+    """
+
+    def test_threads_run_each_job_once(self):
+        executed_jobs.clear()
+        for index in range(200):
+            jobs.enqueue('tests.record', [index])
+
+        out = io.StringIO()
+        call_command('run_worker', threads=4, burst=True, stdout=out)
+
+        self.assertIn('Выполнено задач: 200, с ошибкой: 0', out.getvalue())
+        self.assertEqual(sorted(executed_jobs), list(range(200)))
+        self.assertEqual(Job.objects.filter(status=Job.Status.DONE).count(), 200)
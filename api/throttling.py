@@ -0,0 +1,202 @@
+"""
+Ограничение частоты запросов (throttling) по алгоритму GCRA.
+
+GCRA (Generic Cell Rate Algorithm) — это скользящее окно без хранения истории запросов:
+на каждый ключ хранится одно число — теоретическое время прибытия следующего запроса (TAT).
+Проверка сводится к паре арифметических операций и одному обращению к хранилищу.
+
+Хранилища:
+- local: словарь в памяти процесса (по умолчанию, микросекунды на запрос)
+- cache: кеш Django (например, Redis) — лимиты общие для всех воркеров
+"""
+import heapq
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+# Допуск на погрешность вычислений с плавающей точкой
+EPSILON = 1e-6
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """Разбирает строку вида '10/min' в пару (количество запросов, длительность окна в секундах)"""
+    num, period = rate.split('/')
+    return int(num), PERIODS[period[0]]
+
+
+class LocalRateStore:
+    """
+    Хранилище TAT в памяти процесса. Ключи с закончившимся окном удаляются по куче сроков:
+    на каждый ключ в ней одна запись, и запрос разбирает только истекшие записи с ее начала,
+    а не весь словарь.
+    """
+
+    def __init__(self):
+        self._data = {}
+        # (TAT, ключ) в порядке истечения; TAT записи может отставать от продленного ключа
+        self._expiry = []
+        self._lock = threading.Lock()
+
+    def consume(self, key, now, interval, period):
+        """
+        Пытается пропустить запрос.
+        Возвращает 0, если запрос разрешен, иначе время ожидания в секундах.
+        """
+        with self._lock:
+            self._prune(now)
+            tat = max(self._data.get(key, now), now)
+            new_tat = tat + interval
+            if new_tat - now > period + EPSILON:
+                return new_tat - period - now
+            if key not in self._data:
+                heapq.heappush(self._expiry, (new_tat, key))
+            self._data[key] = new_tat
+            return 0
+
+    def _prune(self, now):
+        """Удаляет ключи, чье окно уже закончилось"""
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            _, key = heapq.heappop(expiry)
+            tat = self._data[key]
+            if tat > now:
+                # Ключ продлевали: запись возвращается в кучу с его текущим TAT
+                heapq.heappush(expiry, (tat, key))
+            else:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._expiry.clear()
+
+
+class CacheRateStore:
+    """
+    Хранилище TAT в кеше Django, общее для всех воркеров.
+    Чтение и запись не атомарны: при одновременных запросах с одним ключом
+    лимит может быть превышен на единицы запросов, что для троттлинга допустимо.
+    """
+
+    key_prefix = 'throttle:gcra:'
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def consume(self, key, now, interval, period):
+        cache_key = self.key_prefix + key
+        tat = max(self.cache.get(cache_key, now), now)
+        new_tat = tat + interval
+        if new_tat - now > period + EPSILON:
+            return new_tat - period - now
+        self.cache.set(cache_key, new_tat, timeout=int(period) + 1)
+        return 0
+
+
+_local_store = LocalRateStore()
+
+
+def get_store():
+    """Возвращает хранилище, выбранное в настройках API_THROTTLE_STORE"""
+    if getattr(settings, 'API_THROTTLE_STORE', 'local') == 'cache':
+        return CacheRateStore(getattr(settings, 'API_THROTTLE_CACHE', 'default'))
+    return _local_store
+
+
+class RateLimiter:
+    """
+    Лимит частоты исходящих запросов (например, к Stripe), общий для потоков процесса:
+    не больше num запросов за period секунд. wait() блокирует, пока запрос не разрешен.
+    """
+
+    def __init__(self, rate, key='default'):
+        self.num_requests, self.duration = parse_rate(rate)
+        self.key = key
+        self._store = LocalRateStore()
+
+    def wait(self):
+        """Ждет, пока лимит разрешит очередной запрос"""
+        interval = self.duration / self.num_requests
+        while True:
+            delay = self._store.consume(self.key, time.time(), interval, self.duration)
+            if not delay:
+                return
+            time.sleep(delay)
+
+
+class GCRAThrottle(BaseThrottle):
+    """
+    Базовый троттлинг с лимитами по scope из REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'].
+    Лимит '10/min' означает не более 10 запросов в любом скользящем окне длиной в минуту.
+    """
+
+    scope = None
+    # Считаем только эти методы (None — все)
+    methods = None
+
+    def __init__(self):
+        self.wait_time = 0
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+        if rate:
+            self.num_requests, self.duration = parse_rate(rate)
+        else:
+            self.num_requests, self.duration = None, None
+
+    def get_cache_key(self, request, view):
+        """Ключ по пользователю, для анонимных — по IP"""
+        if request.user and request.user.is_authenticated:
+            ident = f'user:{request.user.pk}'
+        else:
+            ident = f'ip:{self.get_ident(request)}'
+        return f'{self.scope}:{ident}'
+
+    def allow_request(self, request, view):
+        if not self.num_requests:
+            return True
+        if self.methods is not None and request.method not in self.methods:
+            return True
+
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+
+        interval = self.duration / self.num_requests
+        self.wait_time = get_store().consume(key, time.time(), interval, self.duration)
+        return self.wait_time == 0
+
+    def wait(self):
+        return self.wait_time or None
+
+
+class TokenRateThrottle(GCRAThrottle):
+    """Получение JWT-токена: ограничиваем по IP, чтобы перебор паролей не нагружал CPU хешированием"""
+    scope = 'token'
+
+    def get_cache_key(self, request, view):
+        return f'{self.scope}:ip:{self.get_ident(request)}'
+
+
+class RegisterRateThrottle(TokenRateThrottle):
+    """Регистрация новых пользователей (по IP)"""
+    scope = 'register'
+
+
+class CheckoutRateThrottle(GCRAThrottle):
+    """Создание сессий оплаты Stripe"""
+    scope = 'checkout'
+
+
+class CatalogRateThrottle(GCRAThrottle):
+    """Чтение каталога курсов и уроков"""
+    scope = 'catalog'
+    methods = ('GET', 'HEAD', 'OPTIONS')
@@ -1,11 +1,14 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import api_root, PaymentViewSet
+from .views import api_root, admission_stats, job_stats, stripe_webhook, PaymentViewSet
 
 router = DefaultRouter()
 router.register(r'stripe-payments', PaymentViewSet, basename='stripe-payment')  # ⭐️ Изменили имя
 
 urlpatterns = [
     path('', api_root, name='api-root'),
+    path('admission-stats/', admission_stats, name='admission-stats'),
+    path('jobs/stats/', job_stats, name='job-stats'),
+    path('stripe/webhook/', stripe_webhook, name='stripe-webhook'),
     path('', include(router.urls)),
 ]
@@ -1,11 +1,21 @@
-from rest_framework.decorators import api_view, action
+from rest_framework.decorators import api_view, action, permission_classes
 from rest_framework.response import Response
 from rest_framework import viewsets, status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from django.conf import settings
+from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+import stripe
 
+from api import jobs
+from api.deadlines import DeadlineExceeded
+from api.middleware import get_admission_controller
 from api.serializers import StripeCheckoutSerializer
-from api.services import stripe_service
+from api.throttling import CheckoutRateThrottle
+from api.services import StripeUnavailable, stripe_service
+from api.webhooks import construct_event, store_event
 from materials.models import Course
 
 
@@ -19,10 +29,51 @@ def api_root(request):
             'materials/lessons/': 'Lesson CRUD',
             'users/users/': 'User management',
             'api/payments/create-checkout/': 'Create Stripe checkout',
+            'materials/cart/checkout/': 'Checkout several courses in one Stripe session',
+            'api/admission-stats/': 'Admission control stats (admin)',
+            'api/jobs/stats/': 'Background job queue stats (admin)',
+            'api/stripe/webhook/': 'Stripe webhooks',
         }
     })
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def admission_stats(request):
+    """Статистика контроля допуска по классам эндпоинтов (для настройки лимитов)"""
+    return Response(get_admission_controller().stats())
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def job_stats(request):
+    """Состояние очереди фоновых задач: по статусам и задачам, готовые, отложенные, брошенные"""
+    return Response(jobs.stats())
+
+
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    """
+    Прием вебхуков Stripe: проверка подписи и запись события в очередь StripeEvent.
+    POST /api/stripe/webhook/
+
+    Без DRF и без обработки события: ответ уходит сразу, платежи создает
+    команда process_stripe_events (api.webhooks).
+    """
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        return JsonResponse({'error': 'Вебхуки Stripe не настроены'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    try:
+        event = construct_event(request.body.decode('utf-8'), request.headers.get('Stripe-Signature', ''))
+    except (stripe.SignatureVerificationError, ValueError) as e:
+        return JsonResponse(
+            {'error': 'Некорректная подпись или событие', 'detail': str(e)},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    store_event(event)
+    return JsonResponse({'received': True})
+
+
 class PaymentViewSet(viewsets.ViewSet):
     """ViewSet для работы с оплатой через Stripe"""
     permission_classes = [IsAuthenticated]
@@ -30,7 +81,7 @@ class PaymentViewSet(viewsets.ViewSet):
     # Явно указываем basename для Swagger
     swagger_tags = ['Stripe API']
 
-    @action(detail=False, methods=['post'], url_path='create-checkout')
+    @action(detail=False, methods=['post'], url_path='create-checkout', throttle_classes=[CheckoutRateThrottle])
     def create_checkout(self, request):
         """
         Создает Stripe Checkout сессию для оплаты курса.
@@ -85,6 +136,8 @@ class PaymentViewSet(viewsets.ViewSet):
                     }
                 })
 
+            except (DeadlineExceeded, StripeUnavailable):
+                raise
             except Exception as e:
                 return Response(
                     {"error": str(e)},
@@ -0,0 +1,273 @@
+"""
+Вебхуки Stripe: быстрый прием событий и их обработка пачками.
+
+Прием (stripe_webhook) только проверяет подпись и сохраняет событие в очередь StripeEvent
+одним INSERT ... ON CONFLICT DO NOTHING по event_id — повторная доставка того же события
+ничего не добавляет, а ответ 200 уходит за несколько миллисекунд.
+
+Обработка (process_events: фоновая задача api.process_stripe_events, которую ставит
+store_event, или команда process_stripe_events) забирает необработанные события пачками. Оплаченные сессии Checkout превращаются в платежи (Payment) по метаданным
+course_id и user_id, которые кладет в сессию create_checkout_session. Сессия корзины
+(create_cart_checkout_session) вместо course_id несет course_ids и course_amounts
+и дает по платежу на каждый курс — все платежи сессии вставляются одним bulk_create.
+Платежи ищутся по stripe_id (ID сессии) во всех базах и в архиве, поэтому:
+- повтор события не создает второй платеж
+- порядок событий не важен: платеж только переходит из неподтвержденного
+  в подтвержденный, но не обратно (например, если checkout.session.completed
+  с payment_status=unpaid пришел после async_payment_succeeded)
+
+Одновременно должен работать один обработчик: события одной сессии из разных пачек,
+обработанные параллельно, могли бы создать два платежа. Задача api.process_stripe_events
+exclusive и сама с собой не пересекается; команду не стоит запускать вместе с воркерами.
+"""
+import json
+import logging
+from collections import defaultdict
+from decimal import Decimal
+
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from materials import checkout_cache
+from materials.models import Course
+from users.batch import insert_payments
+from users.models import ArchivedPayment, Payment, User
+from users.sharding import shard_for
+
+from . import jobs
+from .models import StripeEvent
+
+logger = logging.getLogger(__name__)
+
+# Тип события -> подтверждает ли оно оплату (None — только по payment_status сессии)
+SESSION_EVENTS = {
+    'checkout.session.completed': None,
+    'checkout.session.async_payment_succeeded': True,
+    'checkout.session.async_payment_failed': False,
+    'checkout.session.expired': False,
+}
+
+PAID_STATUSES = ('paid', 'no_payment_required')
+
+
+def construct_event(payload, signature):
+    """
+    Проверяет подпись Stripe-Signature и разбирает событие.
+    Выбрасывает stripe.SignatureVerificationError или ValueError.
+    """
+    stripe.WebhookSignature.verify_header(
+        payload, signature, settings.STRIPE_WEBHOOK_SECRET, settings.STRIPE_WEBHOOK_TOLERANCE
+    )
+    event = json.loads(payload)
+    if not isinstance(event, dict) or not event.get('id') or not event.get('type'):
+        raise ValueError('Некорректное событие Stripe')
+    return event
+
+
+def store_event(event):
+    """Кладет событие в очередь; событие с уже известным ID игнорируется"""
+    StripeEvent.objects.bulk_create(
+        [StripeEvent(
+            event_id=event['id'],
+            type=event['type'],
+            payload=event,
+            stripe_created=event.get('created') or 0,
+        )],
+        ignore_conflicts=True
+    )
+    # Одна задача обработки на все события, пока она ждет в очереди (api.tasks)
+    jobs.enqueue('api.process_stripe_events')
+
+
+class SessionOutcome:
+    """Что известно о сессии Checkout по всем ее событиям в пачке"""
+
+    def __init__(self, session, user_id, course_ids, course_amounts=None):
+        self.session_id = session['id']
+        self.user_id = user_id
+        self.course_ids = course_ids
+        # Суммы по курсам корзины (None — сессия одного курса, сумма — amount_total)
+        self.course_amounts = course_amounts
+        amount_total = session.get('amount_total')
+        self.amount = Decimal(amount_total) / 100 if amount_total is not None else None
+        self.completed = False
+        self.confirmed = False
+
+    def add(self, event_type, session):
+        confirms = SESSION_EVENTS[event_type]
+        if event_type == 'checkout.session.completed':
+            self.completed = True
+            confirms = session.get('payment_status') in PAID_STATUSES
+        if event_type == 'checkout.session.async_payment_succeeded':
+            self.completed = True
+        self.confirmed = self.confirmed or confirms
+        if self.amount is None and session.get('amount_total') is not None:
+            self.amount = Decimal(session['amount_total']) / 100
+
+
+def _session_courses(session):
+    """
+    (user_id, [course_id], суммы курсов корзины или None) из метаданных сессии
+    или None, если сессию создали не мы
+    """
+    metadata = session.get('metadata') or {}
+    try:
+        user_id = int(metadata['user_id'])
+        if 'course_ids' not in metadata:
+            return user_id, [int(metadata['course_id'])], None
+        course_ids = [int(course_id) for course_id in metadata['course_ids'].split(',')]
+        amounts = [Decimal(amount) for amount in metadata['course_amounts'].split(',')]
+    except (KeyError, TypeError, ValueError, ArithmeticError):
+        return None
+    if len(amounts) != len(course_ids):
+        return None
+    return user_id, course_ids, amounts
+
+
+def _cache_key(outcome):
+    """Под каким ключом сессия лежит в кеше открытых сессий (materials.checkout_cache)"""
+    if outcome.course_amounts is None:
+        return outcome.course_ids[0]
+    return checkout_cache.cart_key(outcome.course_ids)
+
+
+def _collect(events):
+    """Сводит события пачки по сессиям: {session_id: SessionOutcome}"""
+    outcomes = {}
+    for event in sorted(events, key=lambda item: (item.stripe_created, item.pk)):
+        if event.type not in SESSION_EVENTS:
+            continue
+        session = (event.payload.get('data') or {}).get('object') or {}
+        courses = _session_courses(session)
+        if not session.get('id') or courses is None:
+            continue
+        outcome = outcomes.get(session['id'])
+        if outcome is None:
+            outcome = outcomes[session['id']] = SessionOutcome(session, *courses)
+        outcome.add(event.type, session)
+    return outcomes
+
+
+def _existing_payments(outcomes):
+    """
+    Платежи и архивные платежи, уже созданные по этим сессиям: {stripe_id: [платежи]}.
+    Платежи сессии вставляются вместе, поэтому сессия либо записана целиком, либо нет.
+    """
+    by_shard = defaultdict(list)
+    for outcome in outcomes.values():
+        by_shard[shard_for(outcome.user_id)].append(outcome.session_id)
+
+    existing = defaultdict(list)
+    for alias, session_ids in by_shard.items():
+        for payment in Payment.objects.using(alias).filter(stripe_id__in=session_ids):
+            existing[payment.stripe_id].append(payment)
+    for payment in ArchivedPayment.objects.filter(stripe_id__in=list(outcomes)):
+        existing[payment.stripe_id].append(payment)
+    return existing
+
+
+def apply_outcomes(outcomes):
+    """
+    Создает недостающие платежи одним bulk_create и подтверждает существующие.
+    Возвращает (создано, подтверждено).
+    """
+    existing = _existing_payments(outcomes)
+    pending = [outcome for outcome in outcomes.values() if outcome.completed and outcome.session_id not in existing]
+    users = set(User.objects.filter(pk__in={outcome.user_id for outcome in pending}).values_list('pk', flat=True))
+    course_ids = {course_id for outcome in pending for course_id in outcome.course_ids}
+    courses = {course.pk: course.price for course in Course.objects.filter(pk__in=course_ids).only('price')}
+
+    new_payments = []
+    for outcome in pending:
+        if outcome.user_id not in users:
+            logger.warning('Сессия %s: пользователь %s не найден', outcome.session_id, outcome.user_id)
+            continue
+        if outcome.course_amounts is not None:
+            amounts = outcome.course_amounts
+        else:
+            amounts = [outcome.amount if outcome.amount is not None else courses.get(outcome.course_ids[0], 0)]
+        for course_id, amount in zip(outcome.course_ids, amounts):
+            new_payments.append(Payment(
+                user_id=outcome.user_id,
+                paid_course_id=course_id if course_id in courses else None,
+                amount=amount,
+                payment_method=Payment.PaymentMethod.TRANSFER,
+                stripe_id=outcome.session_id,
+                is_confirmed=outcome.confirmed,
+            ))
+    if new_payments:
+        insert_payments(new_payments)
+
+    confirmed = 0
+    for outcome in outcomes.values():
+        if not outcome.confirmed:
+            continue
+        for payment in existing.get(outcome.session_id, ()):
+            if isinstance(payment, Payment) and not payment.is_confirmed:
+                # Через save: сигналы обновят итоги, сводки трат и доступ к курсу
+                payment.is_confirmed = True
+                payment.save(update_fields=['is_confirmed'])
+                confirmed += 1
+
+    # Завершенная или истекшая сессия больше не подходит для повторной оплаты
+    for outcome in outcomes.values():
+        checkout_cache.forget(outcome.user_id, _cache_key(outcome))
+    return len(new_payments), confirmed
+
+
+def _pending_events():
+    """Необработанные события, у которых еще остались попытки"""
+    return StripeEvent.objects.filter(
+        processed_at__isnull=True, attempts__lt=settings.STRIPE_EVENTS['MAX_ATTEMPTS']
+    ).order_by('id')
+
+
+def _process(events):
+    with transaction.atomic():
+        created, confirmed = apply_outcomes(_collect(events))
+        StripeEvent.objects.filter(pk__in=[event.pk for event in events]).update(
+            processed_at=timezone.now(), attempts=F('attempts') + 1, last_error=''
+        )
+    return created, confirmed
+
+
+def process_batch(batch_size=None):
+    """
+    Обрабатывает одну пачку событий. Если пачка целиком завершилась ошибкой, события
+    обрабатываются по одному: ошибочное событие получает attempts + 1 и last_error,
+    остальные обрабатываются. Возвращает (событий, создано платежей, подтверждено).
+    """
+    events = list(_pending_events()[:batch_size or settings.STRIPE_EVENTS['BATCH_SIZE']])
+    if not events:
+        return 0, 0, 0
+    try:
+        created, confirmed = _process(events)
+    except Exception:
+        logger.exception('Ошибка обработки пачки событий Stripe, обрабатываем по одному')
+        created = confirmed = 0
+        for event in events:
+            try:
+                event_created, event_confirmed = _process([event])
+            except Exception as e:
+                StripeEvent.objects.filter(pk=event.pk).update(
+                    attempts=F('attempts') + 1, last_error=f'{type(e).__name__}: {e}'
+                )
+            else:
+                created += event_created
+                confirmed += event_confirmed
+    return len(events), created, confirmed
+
+
+def process_events(batch_size=None, on_batch=None):
+    """Обрабатывает очередь до конца. Возвращает (событий, создано платежей, подтверждено)"""
+    totals = [0, 0, 0]
+    while True:
+        counts = process_batch(batch_size)
+        if not counts[0]:
+            return tuple(totals)
+        totals = [total + count for total, count in zip(totals, counts)]
+        if on_batch is not None:
+            on_batch(*totals)
@@ -0,0 +1,194 @@
+"""
+Кеш открытых сессий Stripe Checkout по паре (пользователь, курс).
+
+Повторный POST /api/materials/courses/<id>/checkout/ (двойной клик, повтор после обрыва
+связи) возвращает уже созданную сессию без обращения к Stripe. Запись помнит price_id,
+по которому создана сессия: если цена курса сменилась, запись не подходит и создается
+новая сессия. Запись живет, пока не истечет сессия в Stripe (expires_at, с запасом),
+и удаляется, когда курс оплачен (подтвержденный платеж, materials.signals) или
+сессия завершилась (forget).
+
+Одновременные одинаковые запросы не создают несколько сессий: первый берет короткую
+блокировку в кеше (cache.add), остальные ждут его результат. Блокировка общая для всех
+процессов, только если кеш общий (REDIS_URL); с кешем в памяти процесса дубли между
+процессами отсекает Stripe: запрос на создание сессии идет с ключом идемпотентности
+idempotency_key() из пользователя, курсов, цены, окна времени и последнего платежа за эти
+курсы (после оплаты Stripe не должен вернуть по ключу оплаченную сессию), а expires_at
+отсчитывается от начала окна, чтобы параметры повторного запроса совпадали.
+Для async-view есть aget_or_create: те же ключи и блокировка, ожидание через asyncio.sleep.
+Сессия корзины (несколько курсов) хранится под ключом cart_key(course_ids) вместо ID курса.
+"""
+import asyncio
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+
+from api import deadlines
+
+CACHE_KEY = 'checkout:{user_id}:{course_id}'
+LOCK_KEY = 'checkout:{user_id}:{course_id}:lock'
+
+# Сессия не отдается из кеша, если до ее истечения осталось меньше, секунды
+EXPIRY_MARGIN = 60
+
+# Сколько ждать сессию, которую создает параллельный запрос, и как часто проверять, секунды
+LOCK_TIMEOUT = 10
+POLL_INTERVAL = 0.05
+
+
+# Окно ключа идемпотентности Stripe, секунды: запросы одного окна получают одну сессию.
+# CHECKOUT_SESSION_TTL должен быть больше 30 минут (минимум Stripe) плюс окно
+IDEMPOTENCY_WINDOW = 10 * 60
+
+
+def idempotency_window():
+    """Начало текущего окна ключа идемпотентности (unix time)"""
+    now = int(time.time())
+    return now - now % IDEMPOTENCY_WINDOW
+
+
+def session_expires_at(window):
+    """Момент истечения новой сессии (unix time) — передается в Stripe как expires_at"""
+    return window + settings.CHECKOUT_SESSION_TTL
+
+
+def _payments(user_id, course_ids):
+    from users.models import Payment
+    from users.sharding import shard_for
+
+    return Payment.objects.using(shard_for(user_id)).filter(user_id=user_id, paid_course_id__in=course_ids)
+
+
+def _idempotency_key(user_id, course_ids, price_id, window, last_payment_id):
+    raw = f'{user_id}:{cart_key(course_ids)}:{price_id}:{window}:{last_payment_id}'
+    return 'checkout:' + hashlib.sha256(raw.encode()).hexdigest()
+
+
+def idempotency_key(user_id, course_ids, price_id, window):
+    """Ключ идемпотентности Stripe для сессии оплаты курсов course_ids по цене (ценам) price_id"""
+    last_payment_id = _payments(user_id, course_ids).aggregate(last=Max('id'))['last']
+    return _idempotency_key(user_id, course_ids, price_id, window, last_payment_id)
+
+
+async def aidempotency_key(user_id, course_ids, price_id, window):
+    """Асинхронная версия idempotency_key"""
+    last_payment_id = (await _payments(user_id, course_ids).aaggregate(last=Max('id')))['last']
+    return _idempotency_key(user_id, course_ids, price_id, window, last_payment_id)
+
+
+def cart_key(course_ids):
+    """Ключ корзины вместо ID курса: один набор курсов в любом порядке — одна сессия"""
+    return 'cart-' + '-'.join(str(course_id) for course_id in sorted(set(course_ids)))
+
+
+def _valid(entry, price_id):
+    return (
+        entry is not None
+        and entry['price_id'] == price_id
+        and entry['expires_at'] - EXPIRY_MARGIN > time.time()
+    )
+
+
+def _wait_timeout():
+    left = deadlines.remaining()
+    return LOCK_TIMEOUT if left is None else min(LOCK_TIMEOUT, left)
+
+
+def _entry(session, price_id):
+    return {
+        'session_id': session['id'],
+        'url': session['url'],
+        'payment_status': session['payment_status'],
+        'amount_total': session['amount_total'],
+        'currency': session['currency'],
+        'expires_at': session['expires_at'],
+        'price_id': price_id,
+    }
+
+
+def _entry_timeout(entry):
+    return max(1, int(entry['expires_at'] - EXPIRY_MARGIN - time.time()))
+
+
+def _wait_for_entry(key, lock, price_id):
+    """Ждет, пока параллельный запрос сохранит сессию; None — не дождались"""
+    stop = time.monotonic() + _wait_timeout()
+    while time.monotonic() < stop:
+        time.sleep(POLL_INTERVAL)
+        entry = cache.get(key)
+        if _valid(entry, price_id):
+            return entry
+        if cache.get(lock) is None:
+            return None
+    return None
+
+
+def get_or_create(user_id, course_id, price_id, create):
+    """
+    Открытая сессия оплаты курса course_id по цене price_id для пользователя user_id:
+    из кеша или новая, созданная вызовом create() (возвращает сессию Stripe).
+    Возвращает (запись, взята ли она из кеша).
+    """
+    key = CACHE_KEY.format(user_id=user_id, course_id=course_id)
+    entry = cache.get(key)
+    if _valid(entry, price_id):
+        return entry, True
+
+    lock = LOCK_KEY.format(user_id=user_id, course_id=course_id)
+    locked = cache.add(lock, True, LOCK_TIMEOUT)
+    if not locked:
+        entry = _wait_for_entry(key, lock, price_id)
+        if entry is not None:
+            return entry, True
+        # Параллельный запрос не создал сессию — создаем сами
+
+    try:
+        entry = _entry(create(), price_id)
+        cache.set(key, entry, _entry_timeout(entry))
+    finally:
+        if locked:
+            cache.delete(lock)
+    return entry, False
+
+
+async def _await_entry(key, lock, price_id):
+    stop = time.monotonic() + _wait_timeout()
+    while time.monotonic() < stop:
+        await asyncio.sleep(POLL_INTERVAL)
+        entry = await cache.aget(key)
+        if _valid(entry, price_id):
+            return entry
+        if await cache.aget(lock) is None:
+            return None
+    return None
+
+
+async def aget_or_create(user_id, course_id, price_id, create):
+    """Асинхронная версия get_or_create: create() — корутина, создающая сессию Stripe"""
+    key = CACHE_KEY.format(user_id=user_id, course_id=course_id)
+    entry = await cache.aget(key)
+    if _valid(entry, price_id):
+        return entry, True
+
+    lock = LOCK_KEY.format(user_id=user_id, course_id=course_id)
+    locked = await cache.aadd(lock, True, LOCK_TIMEOUT)
+    if not locked:
+        entry = await _await_entry(key, lock, price_id)
+        if entry is not None:
+            return entry, True
+
+    try:
+        entry = _entry(await create(), price_id)
+        await cache.aset(key, entry, _entry_timeout(entry))
+    finally:
+        if locked:
+            await cache.adelete(lock)
+    return entry, False
+
+
+def forget(user_id, course_id):
+    """Убирает сессию из кеша (курс оплачен или сессия завершилась)"""
+    cache.delete(CACHE_KEY.format(user_id=user_id, course_id=course_id))
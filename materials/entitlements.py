@@ -0,0 +1,103 @@
+"""
+Индекс доступа пользователя к курсам и урокам.
+
+Доступ складывается из нескольких источников:
+- владелец курса или урока (Course.owner, Lesson.owner)
+- подтвержденные платежи за курс или урок (Payment.paid_course, Payment.paid_lesson)
+- модераторы и администраторы видят всё
+
+Для каждого пользователя индекс строится один раз (три небольших запроса) и хранится в кеше
+в виде множеств id доступных курсов и уроков: размер записи зависит от числа доступов
+пользователя, а не от наибольшего id. Проверка доступа после этого — поиск в множестве
+в памяти, без запросов к базе.
+
+Индекс сбрасывается после коммита транзакции, которая изменила доступ: сброс до коммита
+позволил бы параллельному запросу снова закешировать старое состояние. Чтобы сброс видели
+все воркеры, кеш должен быть общим (REDIS_URL); иначе индекс живет ENTITLEMENTS_CACHE_TIMEOUT.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .models import Course, Lesson
+
+CACHE_KEY = 'entitlements:{user_id}'
+
+
+def _ids(ids):
+    """Множество id без пустых значений"""
+    return frozenset(pk for pk in ids if pk is not None)
+
+
+class Entitlements:
+    """Множества доступных пользователю курсов и уроков"""
+
+    __slots__ = ('is_moderator', 'course_ids', 'lesson_ids')
+
+    def __init__(self, is_moderator=False, course_ids=frozenset(), lesson_ids=frozenset()):
+        self.is_moderator = is_moderator
+        self.course_ids = course_ids
+        self.lesson_ids = lesson_ids
+
+    def has_course(self, course_id):
+        """Есть ли доступ к курсу"""
+        return self.is_moderator or course_id in self.course_ids
+
+    def has_lesson(self, lesson_id, course_id=None):
+        """Есть ли доступ к уроку: оплачен/создан сам урок или доступен весь курс"""
+        if self.is_moderator or lesson_id in self.lesson_ids:
+            return True
+        return course_id is not None and self.has_course(course_id)
+
+
+def build_entitlements(user):
+    """Строит индекс доступа пользователя по данным из базы"""
+    from users.sharding import payment_sources
+
+    if user.is_staff or user.is_superuser or user.groups.filter(name='moderators').exists():
+        return Entitlements(is_moderator=True)
+
+    course_ids = list(Course.objects.filter(owner=user).values_list('id', flat=True))
+    lesson_ids = list(Lesson.objects.filter(owner=user).values_list('id', flat=True))
+
+    # Платежи пользователя в его шарде и в архиве: оплата дает доступ и после переноса в архив
+    for source in payment_sources(user.pk):
+        paid = source.filter(user=user, is_confirmed=True).values_list('paid_course_id', 'paid_lesson_id')
+        for paid_course_id, paid_lesson_id in paid:
+            course_ids.append(paid_course_id)
+            lesson_ids.append(paid_lesson_id)
+
+    return Entitlements(course_ids=_ids(course_ids), lesson_ids=_ids(lesson_ids))
+
+
+def get_entitlements(user):
+    """Возвращает индекс доступа пользователя (из кеша или строит заново)"""
+    if not user.is_authenticated:
+        return Entitlements()
+
+    key = CACHE_KEY.format(user_id=user.pk)
+    entitlements = cache.get(key)
+    if entitlements is None:
+        entitlements = build_entitlements(user)
+        cache.set(key, entitlements, settings.ENTITLEMENTS_CACHE_TIMEOUT)
+    return entitlements
+
+
+def entitlements_for_request(request):
+    """Индекс доступа текущего пользователя, запоминается на время запроса"""
+    entitlements = getattr(request, '_entitlements', None)
+    if entitlements is None:
+        entitlements = get_entitlements(request.user)
+        request._entitlements = entitlements
+    return entitlements
+
+
+def invalidate(*user_ids, using=DEFAULT_DB_ALIAS):
+    """
+    Сбрасывает индексы пользователей (после оплаты, смены владельца курса и т.п.) после
+    коммита текущей транзакции базы using (вне транзакции — сразу).
+    Новый индекс будет построен при следующем обращении.
+    """
+    keys = [CACHE_KEY.format(user_id=user_id) for user_id in user_ids if user_id is not None]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys), using=using)
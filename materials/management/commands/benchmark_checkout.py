@@ -0,0 +1,229 @@
+"""
+Сравнение синхронного и асинхронного создания сессий оплаты под нагрузкой.
+
+Оба view вызываются в процессе, как их вызвал бы сервер приложений:
+- sync — POST /api/materials/courses/<id>/checkout/ через WSGI-приложение (myproject.wsgi)
+  в пуле из --threads потоков: так работает один синхронный воркер
+- async — POST /api/materials/courses/<id>/checkout/async/ через ASGI-приложение
+  (myproject.asgi) в одном event loop: так работает один ASGI-воркер
+
+Stripe заменяет локальный api.stripe_stub с задержкой ответа --latency. Каждый запрос
+делает свой пользователь, чтобы кеш сессий не отвечал вместо Stripe. Контроль допуска
+(ADMISSION_CONTROL) на время замера выключен: он ограничивает число запросов сознательно,
+а здесь измеряется, сколько запросов выдерживает сам воркер.
+"""
+import asyncio
+import io
+import statistics
+import sys
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api.stripe_stub import StripeStub
+from materials.models import Course
+from users.models import User
+
+HOST = 'localhost'
+
+
+def _wsgi_environ(path, token):
+    return {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'CONTENT_LENGTH': '0',
+        'SERVER_NAME': HOST,
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+        'HTTP_HOST': HOST,
+        'HTTP_AUTHORIZATION': f'Bearer {token}',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(b''),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+
+def call_wsgi(application, path, token):
+    """Один запрос к WSGI-приложению: (статус, длительность)"""
+    started = time.monotonic()
+    statuses = []
+    response = application(_wsgi_environ(path, token), lambda status, headers: statuses.append(status))
+    try:
+        b''.join(response)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    return int(statuses[0].split()[0]), time.monotonic() - started
+
+
+async def call_asgi(application, path, token):
+    """Один запрос к ASGI-приложению: (статус, длительность)"""
+    started = time.monotonic()
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'POST',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'headers': [
+            (b'host', HOST.encode()),
+            (b'authorization', f'Bearer {token}'.encode()),
+            (b'content-length', b'0'),
+        ],
+        'client': ('127.0.0.1', 0),
+        'server': (HOST, 80),
+    }
+    finished = asyncio.Event()
+    received = []
+    statuses = []
+
+    async def receive():
+        if not received:
+            received.append(True)
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # Клиент "отключается" только после получения ответа
+        await finished.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+        elif message['type'] == 'http.response.body' and not message.get('more_body'):
+            finished.set()
+
+    await application(scope, receive, send)
+    return statuses[0], time.monotonic() - started
+
+
+def run_sync(application, paths, tokens, threads):
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(lambda args: call_wsgi(application, *args), zip(paths, tokens)))
+
+
+def run_async(application, paths, tokens, concurrency):
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(path, token):
+            async with semaphore:
+                return await call_asgi(application, path, token)
+
+        return await asyncio.gather(*(one(path, token) for path, token in zip(paths, tokens)))
+
+    return asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = 'Сравнение пропускной способности синхронного и асинхронного checkout при задержке Stripe'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=100,
+            help='Сколько сессий оплаты создать в каждом режиме (по умолчанию 100)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=50,
+            help='Сколько запросов async-режим держит одновременно (по умолчанию 50)'
+        )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=4,
+            help='Число потоков синхронного воркера (по умолчанию 4)'
+        )
+        parser.add_argument(
+            '--latency',
+            type=float,
+            default=0.2,
+            help='Задержка ответа заменителя Stripe, секунды (по умолчанию 0.2)'
+        )
+        parser.add_argument(
+            '--mode',
+            choices=('sync', 'async', 'both'),
+            default='both',
+            help='Какой view замерять (по умолчанию оба)'
+        )
+
+    def handle(self, *args, **options):
+        for name in ('requests', 'concurrency', 'threads'):
+            if options[name] < 1:
+                raise CommandError(f'--{name} должен быть положительным')
+        if options['latency'] < 0:
+            raise CommandError('--latency не может быть отрицательной')
+
+        # Приложения импортируются здесь: модули настраивают Django при импорте
+        from myproject.asgi import application as asgi_application
+        from myproject.wsgi import application as wsgi_application
+
+        stub = StripeStub().start()
+        stub.delay = options['latency']
+        overrides = override_settings(
+            STRIPE_API_BASE=stub.url,
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, HOST],
+            ADMISSION_CONTROL={**settings.ADMISSION_CONTROL, 'ENABLED': False},
+        )
+        modes = ('sync', 'async') if options['mode'] == 'both' else (options['mode'],)
+        count = options['requests']
+        users = User.objects.bulk_create([
+            User(email=f'checkout-bench-{uuid.uuid4().hex}@example.com') for _ in range(count * len(modes))
+        ])
+        course = Course.objects.create(title='Нагрузочный тест checkout', price=1000, owner=users[0],
+                                       stripe_price_id='price_benchmark')
+        try:
+            with overrides:
+                results = {}
+                for index, mode in enumerate(modes):
+                    tokens = [str(AccessToken.for_user(user)) for user in users[index * count:(index + 1) * count]]
+                    started = time.monotonic()
+                    if mode == 'sync':
+                        path = f'/api/materials/courses/{course.id}/checkout/'
+                        calls = run_sync(wsgi_application, [path] * count, tokens, options['threads'])
+                    else:
+                        path = f'/api/materials/courses/{course.id}/checkout/async/'
+                        calls = run_async(asgi_application, [path] * count, tokens, options['concurrency'])
+                    results[mode] = self.report(mode, calls, time.monotonic() - started, options)
+        finally:
+            stub.stop()
+            course.delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+        if len(results) == 2 and results['sync']:
+            self.stdout.write(self.style.SUCCESS(
+                f'async выдерживает в {results["async"] / results["sync"]:.1f} раза больше '
+                f'одновременных checkout, чем sync'
+            ))
+
+    def report(self, mode, calls, elapsed, options):
+        """Печатает итоги режима и возвращает среднее число одновременно обслуживаемых checkout"""
+        statuses = Counter(status for status, _ in calls)
+        durations = sorted(duration for _, duration in calls)
+        throughput = len(calls) / elapsed if elapsed else 0
+        # Закон Литтла: одновременно в обработке = пропускная способность × время ответа
+        in_flight = throughput * statistics.mean(durations)
+        p95 = durations[max(0, int(len(durations) * 0.95) - 1)]
+        workers = f'{options["threads"]} потоков' if mode == 'sync' else f'1 event loop, до {options["concurrency"]}'
+        self.stdout.write(
+            f'{mode} ({workers}): {len(calls)} запросов за {elapsed:.2f} с, {throughput:.1f} запр/с, '
+            f'медиана {statistics.median(durations) * 1000:.0f} мс, p95 {p95 * 1000:.0f} мс, '
+            f'одновременно {in_flight:.1f}, статусы {dict(sorted(statuses.items()))}'
+        )
+        return in_flight
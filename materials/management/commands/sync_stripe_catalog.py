@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.throttling import parse_rate
+from materials.models import Course
+from materials.stripe_catalog import courses_to_sync, sync_catalog
+
+
+class Command(BaseCommand):
+    help = 'Создание продуктов и цен Stripe для курсов без цены или с устаревшей ценой'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--course',
+            type=int,
+            action='append',
+            default=[],
+            help='ID курса (можно несколько раз); по умолчанию — все курсы, которым нужна синхронизация'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help=f'Число потоков (по умолчанию {settings.STRIPE_CATALOG["WORKERS"]})'
+        )
+        parser.add_argument(
+            '--rate',
+            default=None,
+            help=f'Лимит запросов к Stripe, например 10/s (по умолчанию {settings.STRIPE_CATALOG["RATE"]})'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Сколько курсов записывать в базу одним bulk_update (по умолчанию 100)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать курсы, которые будут синхронизированы'
+        )
+
+    def handle(self, *args, **options):
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers должен быть положительным')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть положительным')
+        if options['rate'] is not None:
+            try:
+                parse_rate(options['rate'])
+            except (ValueError, KeyError, IndexError):
+                raise CommandError('--rate задается как число/период, например 10/s или 600/m')
+
+        queryset = Course.objects.filter(pk__in=options['course']) if options['course'] else None
+        courses = list(courses_to_sync(queryset))
+        if options['dry_run']:
+            for course in courses:
+                reason = 'нет цены' if not course.stripe_price_id else 'цена устарела'
+                self.stdout.write(f'{course.pk}: {course.title} ({reason})')
+            self.stdout.write(self.style.SUCCESS(f'Будет синхронизировано курсов: {len(courses)}'))
+            return
+
+        def report(course, error):
+            if error is not None:
+                self.stderr.write(f'{course.pk}: {course.title} — ошибка: {error}')
+
+        synced, errors = sync_catalog(
+            courses,
+            workers=options['workers'],
+            rate=options['rate'],
+            batch_size=options['batch_size'],
+            on_course=report
+        )
+        self.stdout.write(self.style.SUCCESS(f'Синхронизировано курсов: {synced}'))
+        if errors:
+            raise CommandError(f'Не удалось синхронизировать курсов: {len(errors)}; повторный запуск безопасен')
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0004_course_price_course_stripe_price_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='course',
+            name='stripe_price_amount',
+            field=models.DecimalField(blank=True, decimal_places=2, help_text='Course price the Stripe price was created for', max_digits=10, null=True, verbose_name='Stripe price amount'),
+        ),
+    ]
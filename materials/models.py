@@ -52,6 +52,17 @@ class Course(models.Model):
         help_text=_('Price ID in Stripe system')
     )
 
+    # Сумма, на которую создана цена stripe_price_id: если она не равна price, цена устарела
+    # и команда sync_stripe_catalog создаст новую (materials.stripe_catalog)
+    stripe_price_amount = models.DecimalField(
+        _('Stripe price amount'),
+        max_digits=10,
+        decimal_places=2,
+        blank=True,
+        null=True,
+        help_text=_('Course price the Stripe price was created for')
+    )
+
     created_at = models.DateTimeField(
         _('created at'),
         auto_now_add=True
@@ -1,6 +1,16 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import Course, Lesson, Subscription
 from .validators import validate_youtube_url  # ← импортируем функцию
+from .entitlements import entitlements_for_request
+
+
+def has_access(serializer, check):
+    """Вычисляет флаг доступа по индексу доступа текущего пользователя"""
+    request = serializer.context.get('request')
+    if request is None:
+        return False
+    return check(entitlements_for_request(request))
 
 
 class LessonSerializer(serializers.ModelSerializer):
@@ -13,12 +23,35 @@ class LessonSerializer(serializers.ModelSerializer):
         required=False,
         allow_blank=True
     )
+    has_access = serializers.SerializerMethodField()
 
     class Meta:
         model = Lesson
         fields = '__all__'
         read_only_fields = ('created_at', 'updated_at')
 
+    def get_has_access(self, obj):
+        """Есть ли у текущего пользователя доступ к уроку"""
+        return has_access(self, lambda entitlements: entitlements.has_lesson(obj.id, obj.course_id))
+
+
+
+class LessonShortSerializer(serializers.ModelSerializer):
+    """Краткая информация об уроке для вложения в другие объекты (платежи и т.п.)"""
+
+    class Meta:
+        model = Lesson
+        fields = ['id', 'title', 'course']
+        read_only_fields = fields
+
+
+class CourseShortSerializer(serializers.ModelSerializer):
+    """Краткая информация о курсе без уроков и подписок, не требует дополнительных запросов"""
+
+    class Meta:
+        model = Course
+        fields = ['id', 'title', 'price']
+        read_only_fields = fields
 
 
 # Остальные сериализаторы без изменений
@@ -33,13 +66,14 @@ class CourseSerializer(serializers.ModelSerializer):
     lessons = LessonSerializer(many=True, read_only=True)
     lesson_count = serializers.IntegerField(source='lessons.count', read_only=True)
     is_subscribed = serializers.SerializerMethodField()
+    has_access = serializers.SerializerMethodField()
 
     class Meta:
         model = Course
         fields = [
             'id', 'title', 'preview', 'description',
             'created_at', 'updated_at', 'owner',
-            'lessons', 'lesson_count', 'is_subscribed'
+            'lessons', 'lesson_count', 'is_subscribed', 'has_access'
         ]
 
     def get_is_subscribed(self, obj):
@@ -54,3 +88,19 @@ class CourseSerializer(serializers.ModelSerializer):
                 course=obj
             ).exists()
         return False
+
+    def get_has_access(self, obj):
+        """Есть ли у текущего пользователя доступ к курсу (владелец, оплата или модератор)"""
+        return has_access(self, lambda entitlements: entitlements.has_course(obj.id))
+
+
+class CartCheckoutSerializer(serializers.Serializer):
+    """Корзина для оплаты одной сессией Stripe: список ID курсов (повторы игнорируются)"""
+    course_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.CHECKOUT_CART_MAX_COURSES
+    )
+
+    def validate_course_ids(self, value):
+        return list(dict.fromkeys(value))
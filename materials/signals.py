@@ -0,0 +1,102 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from api import jobs
+from users.models import Payment
+from users.signals import payment_signals_muted, payments_bulk_created
+
+from . import checkout_cache, entitlements
+from .models import Course, Lesson
+
+
+@receiver(pre_save, sender=Course)
+@receiver(pre_save, sender=Lesson)
+def remember_previous_owner(sender, instance, **kwargs):
+    """Запоминаем прежнего владельца, чтобы сбросить его индекс доступа при смене владельца"""
+    if instance.pk is None:
+        instance._previous_owner_id = None
+    else:
+        instance._previous_owner_id = sender.objects.filter(pk=instance.pk).values_list(
+            'owner_id', flat=True
+        ).first()
+
+
+@receiver(post_save, sender=Course)
+@receiver(post_save, sender=Lesson)
+def owner_changed(sender, instance, created, **kwargs):
+    """Новый курс/урок или смена владельца меняют доступ владельцев"""
+    previous_owner_id = getattr(instance, '_previous_owner_id', None)
+    if created or previous_owner_id != instance.owner_id:
+        entitlements.invalidate(previous_owner_id, instance.owner_id)
+
+
+@receiver(pre_save, sender=Course)
+def remember_previous_price(sender, instance, update_fields=None, **kwargs):
+    """Запоминаем прежнюю цену, чтобы после ее изменения пересоздать цену в Stripe"""
+    if instance.pk is None or (update_fields is not None and 'price' not in update_fields):
+        instance._previous_price = None
+    else:
+        instance._previous_price = sender.objects.filter(pk=instance.pk).values_list('price', flat=True).first()
+
+
+@receiver(post_save, sender=Course)
+def price_changed(sender, instance, created, **kwargs):
+    """
+    Новая цена уже синхронизированного курса: фоновая задача создаст цену в Stripe,
+    чтобы оплата не шла по старой сумме. Задача ставится в той же транзакции и повторяется,
+    если Stripe недоступен; кроме того, курс подхватит команда sync_stripe_catalog
+    (цена считается устаревшей).
+    """
+    previous = getattr(instance, '_previous_price', None)
+    if created or previous is None or previous == Decimal(str(instance.price)):
+        return
+    if not settings.STRIPE_CATALOG.get('SYNC_ON_PRICE_CHANGE', True):
+        return
+    if instance.stripe_product_id or instance.stripe_price_id:
+        jobs.enqueue('materials.resync_course_price', [instance.pk], key=f'course-price:{instance.pk}')
+
+
+@receiver(post_save, sender='users.Payment')
+@receiver(post_delete, sender='users.Payment')
+def payment_changed(sender, instance, using, **kwargs):
+    """Подтверждение, изменение или удаление платежа меняет доступ плательщика"""
+    if payment_signals_muted():
+        # Перенос в архив доступ не меняет
+        return
+    # Платеж может лежать в шарде: сброс после коммита транзакции его базы
+    entitlements.invalidate(instance.user_id, using=using)
+    forget_paid_checkout(instance)
+
+
+@receiver(payments_bulk_created, sender=Payment)
+def payments_created_in_bulk(sender, payments, **kwargs):
+    entitlements.invalidate(*{payment.user_id for payment in payments})
+    for payment in payments:
+        forget_paid_checkout(payment)
+
+
+def forget_paid_checkout(payment):
+    """Курс оплачен: открытая сессия оплаты из кеша больше не нужна"""
+    if payment.is_confirmed and payment.paid_course_id:
+        checkout_cache.forget(payment.user_id, payment.paid_course_id)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_saved(sender, instance, **kwargs):
+    """Могли измениться флаги is_staff/is_superuser"""
+    entitlements.invalidate(instance.pk)
+
+
+@receiver(m2m_changed, sender='users.User_groups')
+def groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Добавление в группу модераторов (или исключение из нее) меняет доступ"""
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # Изменили состав группы: instance — группа, pk_set — пользователи
+        entitlements.invalidate(*(pk_set or ()), using=kwargs['using'])
+    else:
+        entitlements.invalidate(instance.pk, using=kwargs['using'])
@@ -0,0 +1,145 @@
+"""
+Синхронизация курсов с каталогом Stripe: продукт и цена для каждого платного курса.
+
+Курс нужно синхронизировать, если у него нет продукта или цены, либо цена устарела:
+stripe_price_amount (сумма, на которую создана цена) не совпадает с Course.price.
+Цены в Stripe неизменяемы, поэтому для новой суммы создается новая цена, а прежняя
+архивируется (active=false).
+
+Запросы к Stripe идут параллельно из пула потоков (STRIPE_CATALOG['WORKERS']) под общим
+лимитом частоты (STRIPE_CATALOG['RATE'], GCRA из api.throttling). Каждый запрос несет
+детерминированный Idempotency-Key (курс, продукт, сумма), поэтому повторный запуск после
+сбоя не создаст дубликатов: Stripe вернет уже созданные объекты. Найденные ID
+записываются в базу пачками через bulk_update.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import F, Q
+
+from api.services import stripe_service
+from api.throttling import RateLimiter
+
+from .models import Course
+
+logger = logging.getLogger(__name__)
+
+# Поля курса, которые записывает синхронизация
+SYNC_FIELDS = ('stripe_product_id', 'stripe_price_id', 'stripe_price_amount')
+
+
+def unit_amount(price):
+    """Цена курса в центах"""
+    return int((Decimal(price) * 100).quantize(Decimal(1)))
+
+
+def courses_to_sync(queryset=None):
+    """Платные курсы без продукта или цены в Stripe либо с устаревшей ценой"""
+    queryset = Course.objects.all() if queryset is None else queryset
+    return queryset.filter(price__gt=0).filter(
+        Q(stripe_product_id__isnull=True) | Q(stripe_product_id='')
+        | Q(stripe_price_id__isnull=True) | Q(stripe_price_id='')
+        | Q(stripe_price_amount__isnull=True) | ~Q(stripe_price_amount=F('price'))
+    ).order_by('pk')
+
+
+def sync_course(course, limiter=None):
+    """
+    Создает недостающий продукт и актуальную цену курса в Stripe.
+    Не сохраняет курс, а возвращает словарь новых значений SYNC_FIELDS.
+    """
+    currency = settings.STRIPE_CATALOG['CURRENCY']
+    amount = unit_amount(course.price)
+    metadata = {'course_id': str(course.pk)}
+
+    def call(method, *args, **kwargs):
+        if limiter is not None:
+            limiter.wait()
+        return method(*args, **kwargs)
+
+    product_id = course.stripe_product_id
+    if not product_id:
+        product = call(
+            stripe_service.create_product, course.title, metadata=metadata,
+            idempotency_key=f'catalog-product:{course.pk}'
+        )
+        product_id = product['id']
+
+    # Ключ привязан к переходу с текущей цены: при возврате к прежней сумме (10 -> 20 -> 10)
+    # он другой, и Stripe не вернет старую, уже архивированную цену. Повтор после сбоя
+    # (ID не успели записать) идет с той же текущей ценой и получает тот же объект
+    previous_price_id = course.stripe_price_id
+    price = call(
+        stripe_service.create_price, product_id, amount, currency, metadata=metadata,
+        idempotency_key=f'catalog-price:{course.pk}:{product_id}:{previous_price_id or "-"}:{amount}:{currency}'
+    )
+    if not price.get('active', True):
+        # Stripe вернул цену, которую уже архивировали: без активной цены оплата невозможна
+        price = call(stripe_service.activate_price, price['id'])
+    if previous_price_id and previous_price_id != price['id']:
+        call(
+            stripe_service.deactivate_price, previous_price_id,
+            idempotency_key=f'catalog-deactivate:{previous_price_id}'
+        )
+    return {
+        'stripe_product_id': product_id,
+        'stripe_price_id': price['id'],
+        'stripe_price_amount': Decimal(course.price),
+    }
+
+
+def sync_catalog(courses, workers=None, rate=None, batch_size=100, on_course=None):
+    """
+    Синхронизирует курсы параллельно и записывает ID в базу пачками по batch_size.
+    on_course(course, error) вызывается после каждого курса (error — исключение или None).
+    Возвращает (число синхронизированных курсов, {course_id: исключение}).
+    """
+    config = settings.STRIPE_CATALOG
+    limiter = RateLimiter(rate or config['RATE'], key='stripe-catalog')
+    synced = 0
+    errors = {}
+    pending = []
+
+    def flush():
+        nonlocal synced
+        if pending:
+            Course.objects.bulk_update(pending, SYNC_FIELDS, batch_size=batch_size)
+            synced += len(pending)
+            pending.clear()
+
+    with ThreadPoolExecutor(max_workers=workers or config['WORKERS']) as pool:
+        futures = {pool.submit(sync_course, course, limiter): course for course in courses}
+        for future in as_completed(futures):
+            course = futures[future]
+            try:
+                values = future.result()
+            except Exception as e:
+                errors[course.pk] = e
+                error = e
+            else:
+                for name, value in values.items():
+                    setattr(course, name, value)
+                pending.append(course)
+                error = None
+                if len(pending) >= batch_size:
+                    flush()
+            if on_course is not None:
+                on_course(course, error)
+    flush()
+    return synced, errors
+
+
+def resync_course(course_id):
+    """
+    Пересоздает цену курса после изменения его цены (задача materials.resync_course_price).
+    Ошибку Stripe выбрасывает, чтобы задачу повторили.
+    """
+    courses = list(courses_to_sync(Course.objects.filter(pk=course_id)))
+    if not courses:
+        return
+    _, errors = sync_catalog(courses, workers=1)
+    for error in errors.values():
+        logger.warning('Не удалось обновить цену курса %s в Stripe: %s', course_id, error)
+        raise error
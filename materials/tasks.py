@@ -0,0 +1,10 @@
+"""Фоновые задачи приложения materials (api.jobs)"""
+from api import jobs
+
+from . import stripe_catalog
+
+
+@jobs.task('materials.resync_course_price', priority=5)
+def resync_course_price(course_id):
+    """Новая цена курса в Stripe после изменения Course.price; ошибка Stripe — повтор с паузой"""
+    stripe_catalog.resync_course(course_id)
@@ -1,10 +1,25 @@
-from django.test import TestCase
+import pickle
+import threading
+import time
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.contrib.auth.models import Group
+from django.core.cache import cache
 from rest_framework.test import APIClient
 from rest_framework import status
+from rest_framework_simplejwt.tokens import AccessToken
 
-from users.models import User
+from users.models import User, Payment
 from materials.models import Course, Lesson, Subscription
+from materials import checkout_cache, stripe_catalog
+from materials.entitlements import get_entitlements
+from api import jobs
+from api.stripe_stub import StripeStub
+from api.throttling import _local_store
 
 
 class LessonCRUDTestCase(TestCase):
@@ -526,3 +541,462 @@ class PaginationTestCase(TestCase):
         response = self.client.get('/api/materials/courses/?page=99')
         # DRF возвращает 404 для несуществующей страницы
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class EntitlementsTestCase(TestCase):
+    """
+    Тесты индекса доступа к курсам и урокам.
+    """
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        cache.clear()
+        self.owner = User.objects.create_user(email='owner@test.com', password='testpass123')
+        self.buyer = User.objects.create_user(email='buyer@test.com', password='testpass123')
+
+        self.course = Course.objects.create(title='Платный курс', owner=self.owner)
+        self.other_course = Course.objects.create(title='Другой курс', owner=self.owner)
+        self.lesson = Lesson.objects.create(title='Урок', course=self.other_course, owner=self.owner)
+
+        self.client = APIClient()
+
+    def test_confirmed_payment_grants_course_access(self):
+        """Подтвержденная оплата открывает доступ к курсу, неподтвержденная — нет"""
+        payment = Payment.objects.create(user=self.buyer, paid_course=self.course, amount=1000)
+        self.client.force_authenticate(user=self.buyer)
+
+        response = self.client.get(f'/api/materials/courses/{self.course.id}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            payment.is_confirmed = True
+            payment.save()
+
+        response = self.client.get(f'/api/materials/courses/{self.course.id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['has_access'])
+
+    def test_inaccessible_course_looks_like_missing_one(self):
+        """Курс без доступа отвечает 404, как несуществующий: ответ не выдает, какие id курсов есть"""
+        self.client.force_authenticate(user=self.buyer)
+        missing_id = Course.objects.order_by('-id').first().id + 1
+
+        for path in ('', 'lessons/'):
+            denied = self.client.get(f'/api/materials/courses/{self.course.id}/{path}')
+            missing = self.client.get(f'/api/materials/courses/{missing_id}/{path}')
+            self.assertEqual(denied.status_code, status.HTTP_404_NOT_FOUND)
+            self.assertEqual(denied.json(), missing.json())
+
+        self.client.force_authenticate(user=self.owner)
+        response = self.client.get(f'/api/materials/courses/{self.course.id}/lessons/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_paid_lesson_access(self):
+        """Оплата урока открывает урок, но не весь курс"""
+        Payment.objects.create(user=self.buyer, paid_lesson=self.lesson, amount=100, is_confirmed=True)
+
+        entitlements = get_entitlements(self.buyer)
+        self.assertTrue(entitlements.has_lesson(self.lesson.id, self.other_course.id))
+        self.assertFalse(entitlements.has_course(self.other_course.id))
+
+        self.client.force_authenticate(user=self.buyer)
+        response = self.client.get(f'/api/materials/lessons/{self.lesson.id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_lookups_use_cached_index(self):
+        """После построения индекса проверки доступа не обращаются к базе"""
+        get_entitlements(self.owner)
+
+        with self.assertNumQueries(0):
+            entitlements = get_entitlements(self.owner)
+            self.assertTrue(entitlements.has_course(self.course.id))
+            self.assertTrue(entitlements.has_lesson(self.lesson.id))
+
+    def test_owner_change_updates_index(self):
+        """Смена владельца курса сбрасывает индексы прежнего и нового владельца"""
+        self.assertTrue(get_entitlements(self.owner).has_course(self.course.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.course.owner = self.buyer
+            self.course.save()
+
+        self.assertFalse(get_entitlements(self.owner).has_course(self.course.id))
+        self.assertTrue(get_entitlements(self.buyer).has_course(self.course.id))
+
+    def test_moderator_has_access_to_everything(self):
+        """Модератор получает доступ ко всем курсам после добавления в группу"""
+        self.assertFalse(get_entitlements(self.buyer).has_course(self.course.id))
+
+        group, _ = Group.objects.get_or_create(name='moderators')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.buyer.groups.add(group)
+
+        self.assertTrue(get_entitlements(self.buyer).has_course(self.course.id))
+
+    def test_index_is_reset_only_after_commit(self):
+        """До коммита индекс не сбрасывается: параллельный запрос не закеширует старый доступ"""
+        self.assertFalse(get_entitlements(self.buyer).has_course(self.course.id))
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Payment.objects.create(user=self.buyer, paid_course=self.course, amount=1000, is_confirmed=True)
+            # Индекс в кеше — до коммита, сброс отложен
+            self.assertFalse(get_entitlements(self.buyer).has_course(self.course.id))
+        self.assertTrue(callbacks)
+
+        self.assertTrue(get_entitlements(self.buyer).has_course(self.course.id))
+
+    def test_index_size_does_not_depend_on_largest_id(self):
+        """Запись индекса хранит id, а не маску размером с наибольший id"""
+        far_course = Course.objects.create(id=10 ** 12, title='Далекий курс', owner=self.buyer)
+
+        entitlements = get_entitlements(self.buyer)
+
+        self.assertTrue(entitlements.has_course(far_course.id))
+        self.assertLess(len(pickle.dumps(entitlements)), 500)
+
+
+class CheckoutSessionCacheTestCase(TestCase):
+    """
+    Тесты повторного использования открытых сессий оплаты.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = StripeStub().start()
+        cls.addClassCleanup(cls.stub.stop)
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        cache.clear()
+        # ID пользователей повторяются между тестами, а лимит запросов оплаты общий
+        _local_store.clear()
+        self.stub.reset()
+        overrides = override_settings(STRIPE_API_BASE=self.stub.url)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.user = User.objects.create_user(email='buyer@test.com', password='testpass123')
+        self.course = Course.objects.create(title='Курс', price=1000, owner=self.user, stripe_price_id='price_1')
+        self.url = f'/api/materials/courses/{self.course.id}/checkout/'
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def checkout(self):
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_repeated_checkout_reuses_open_session(self):
+        """Повторный запрос возвращает ту же сессию без обращения к Stripe"""
+        first = self.checkout()
+        second = self.checkout()
+
+        self.assertEqual(second['checkout_url'], first['checkout_url'])
+        self.assertEqual((first['reused'], second['reused']), (False, True))
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertIn('expires_at', self.stub.requests[0]['params'])
+
+    def test_checkout_without_shared_cache_is_deduplicated_by_stripe(self):
+        """Процесс без записи в кеше получает у Stripe ту же сессию по ключу идемпотентности"""
+        window = checkout_cache.idempotency_window()
+        with mock.patch.object(checkout_cache, 'idempotency_window', return_value=window):
+            first = self.checkout()
+            # Кеш в памяти другого процесса пуст
+            cache.clear()
+            second = self.checkout()
+
+        self.assertEqual(second['session_id'], first['session_id'])
+        first_request, second_request = self.stub.requests
+        self.assertEqual(first_request['headers']['Idempotency-Key'], second_request['headers']['Idempotency-Key'])
+        self.assertEqual(first_request['params'], second_request['params'])
+
+    def test_concurrent_checkouts_create_one_session(self):
+        """Одновременные запросы (двойной клик) ждут сессию, которую создает первый"""
+        calls = []
+
+        def create():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'id': 'cs_1', 'url': 'https://checkout/cs_1', 'payment_status': 'unpaid',
+                    'amount_total': None, 'currency': None, 'expires_at': time.time() + 3600}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                checkout_cache.get_or_create(self.user.id, self.course.id, 'price_1', create)
+            ))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual({entry['session_id'] for entry, _ in results}, {'cs_1'})
+        self.assertEqual(sorted(reused for _, reused in results), [False, True, True])
+
+    def test_price_change_and_payment_invalidate_session(self):
+        """Новая цена курса и оплата курса требуют новой сессии"""
+        first = self.checkout()
+
+        self.course.stripe_price_id = 'price_2'
+        self.course.save()
+        second = self.checkout()
+        self.assertNotEqual(second['session_id'], first['session_id'])
+        self.assertEqual(self.stub.requests[-1]['params']['line_items'][0]['price'], 'price_2')
+
+        Payment.objects.create(
+            user=self.user, paid_course=self.course, amount=1000,
+            stripe_id=second['session_id'], is_confirmed=True
+        )
+        third = self.checkout()
+        self.assertFalse(third['reused'])
+        self.assertEqual(len(self.stub.requests), 3)
+
+
+class AsyncCheckoutTestCase(TestCase):
+    """
+    Тесты асинхронного создания сессии оплаты (ASGI).
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = StripeStub().start()
+        cls.addClassCleanup(cls.stub.stop)
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        cache.clear()
+        self.stub.reset()
+        overrides = override_settings(STRIPE_API_BASE=self.stub.url)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.user = User.objects.create_user(email='buyer@test.com', password='testpass123')
+        self.course = Course.objects.create(title='Курс', price=1000, owner=self.user, stripe_price_id='price_1')
+        self.url = f'/api/materials/courses/{self.course.id}/checkout/async/'
+        self.headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    async def test_async_checkout_matches_sync_view(self):
+        """Асинхронный view создает сессию и отдает ее из кеша, как синхронный"""
+        first = await self.async_client.post(self.url, headers=self.headers)
+        second = await self.async_client.post(self.url, headers=self.headers)
+
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.json()['course']['stripe_price_id'], 'price_1')
+        self.assertEqual(second.json()['session_id'], first.json()['session_id'])
+        self.assertEqual((first.json()['reused'], second.json()['reused']), (False, True))
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(self.stub.requests[0]['params']['customer_email'], 'buyer@test.com')
+
+    async def test_async_checkout_errors(self):
+        """Без токена — 401, неизвестный курс — 404, разомкнутый автомат Stripe — 503"""
+        response = await self.async_client.post(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = await self.async_client.post('/api/materials/courses/999999/checkout/async/', headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = await self.async_client.get(self.url, headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+        self.stub.fail(503, times=10)
+        with override_settings(STRIPE_CLIENT={**settings.STRIPE_CLIENT, 'MAX_RETRIES': 0, 'BREAKER_FAILURES': 1}):
+            response = await self.async_client.post(self.url, headers=self.headers)
+            self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+            response = await self.async_client.post(self.url, headers=self.headers)
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertIn('detail', response.json())
+
+
+class CheckoutBenchmarkTestCase(TransactionTestCase):
+    """
+    Тест команды сравнения синхронного и асинхронного checkout.
+    """
+
+    def test_benchmark_reports_both_modes_and_cleans_up(self):
+        out = StringIO()
+        call_command('benchmark_checkout', requests=4, concurrency=4, threads=1, latency=0.05, stdout=out)
+
+        output = out.getvalue()
+        self.assertIn('sync (1 потоков): 4 запросов', output)
+        self.assertIn('async (1 event loop, до 4): 4 запросов', output)
+        self.assertEqual(output.count('статусы {200: 4}'), 2)
+        self.assertFalse(User.objects.filter(email__startswith='checkout-bench-').exists())
+        self.assertFalse(Course.objects.exists())
+
+
+class StripeCatalogTestCase(TestCase):
+    """
+    Тесты синхронизации курсов с каталогом Stripe.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = StripeStub().start()
+        cls.addClassCleanup(cls.stub.stop)
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        self.stub.reset()
+        overrides = override_settings(STRIPE_API_BASE=self.stub.url)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.owner = User.objects.create_user(email='owner@test.com', password='testpass123')
+        self.courses = [
+            Course.objects.create(title=f'Курс {number}', price=100 * number, owner=self.owner)
+            for number in range(1, 6)
+        ]
+        self.free_course = Course.objects.create(title='Бесплатный', price=0, owner=self.owner)
+
+    def sync(self, *args):
+        out = StringIO()
+        call_command('sync_stripe_catalog', *args, stdout=out)
+        return out.getvalue()
+
+    def test_sync_creates_products_and_prices_once(self):
+        """Платные курсы получают продукт и цену, повторный запуск ничего не создает"""
+        self.assertIn('Синхронизировано курсов: 5', self.sync('--workers', '3'))
+
+        for course in self.courses:
+            course.refresh_from_db()
+            price = self.stub.objects[course.stripe_price_id]
+            self.assertEqual(price['product'], course.stripe_product_id)
+            self.assertEqual(price['unit_amount'], int(course.price * 100))
+            self.assertEqual(course.stripe_price_amount, course.price)
+        self.free_course.refresh_from_db()
+        self.assertIsNone(self.free_course.stripe_price_id)
+
+        requests_made = len(self.stub.requests)
+        self.assertIn('Синхронизировано курсов: 0', self.sync())
+        self.assertEqual(len(self.stub.requests), requests_made)
+
+    def test_rerun_after_lost_write_reuses_stripe_objects(self):
+        """Если ID не успели записать в базу, повторный запуск получает те же объекты Stripe"""
+        lost = stripe_catalog.sync_course(self.courses[0])
+        self.sync('--course', str(self.courses[0].pk))
+
+        self.courses[0].refresh_from_db()
+        self.assertEqual(self.courses[0].stripe_price_id, lost['stripe_price_id'])
+        self.assertEqual(len([obj for obj in self.stub.objects.values() if obj['object'] == 'price']), 1)
+
+    def test_price_change_creates_new_price_and_archives_old(self):
+        """Изменение цены синхронизированного курса ставит задачу, которая пересоздает цену в Stripe"""
+        self.sync()
+        course = Course.objects.get(pk=self.courses[0].pk)
+        old_price_id = course.stripe_price_id
+
+        course.price = 250
+        course.save()
+        self.assertEqual(self.stub.objects[course.stripe_price_id]['unit_amount'], 10000)
+        self.assertEqual(jobs.run_ready(), (1, 0))
+
+        course.refresh_from_db()
+        self.assertNotEqual(course.stripe_price_id, old_price_id)
+        self.assertEqual(self.stub.objects[course.stripe_price_id]['unit_amount'], 25000)
+        self.assertFalse(self.stub.objects[old_price_id]['active'])
+        self.assertFalse(stripe_catalog.courses_to_sync().exists())
+
+    def test_price_returning_to_earlier_amount_gets_active_price(self):
+        """Цена 100 -> 200 -> 100: курс получает активную цену, а не архивированную первую"""
+        course = self.courses[0]
+        price_ids = []
+        for price in (100, 200, 100):
+            Course.objects.filter(pk=course.pk).update(price=price)
+            self.sync('--course', str(course.pk))
+            course.refresh_from_db()
+            price_ids.append(course.stripe_price_id)
+
+        self.assertEqual(len(set(price_ids)), 3)
+        current = self.stub.objects[course.stripe_price_id]
+        self.assertTrue(current['active'])
+        self.assertEqual(current['unit_amount'], 10000)
+        self.assertFalse(any(self.stub.objects[price_id]['active'] for price_id in price_ids[:2]))
+
+    def test_archived_price_returned_by_stripe_is_reactivated(self):
+        """Если Stripe вернул по ключу уже архивированную цену, она возвращается в работу"""
+        values = stripe_catalog.sync_course(self.courses[0])
+        self.stub.objects[values['stripe_price_id']]['active'] = False
+
+        self.assertEqual(stripe_catalog.sync_course(self.courses[0]), values)
+        self.assertTrue(self.stub.objects[values['stripe_price_id']]['active'])
+
+    def test_rate_limit_spaces_requests(self):
+        """Общий лимит частоты соблюдается всеми потоками"""
+        started = time.monotonic()
+        self.sync('--workers', '5', '--rate', '4/s')
+        # 10 запросов (продукт и цена на курс): 4 сразу, остальные 6 — с интервалом 0.25 с
+        self.assertGreaterEqual(time.monotonic() - started, 1.4)
+        self.assertEqual(len(self.stub.requests), 10)
+
+
+class CartCheckoutTestCase(TestCase):
+    """
+    Тесты оплаты нескольких курсов одной сессией (корзина).
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = StripeStub().start()
+        cls.addClassCleanup(cls.stub.stop)
+
+    def setUp(self):
+        cache.clear()
+        self.stub.reset()
+        overrides = override_settings(STRIPE_API_BASE=self.stub.url)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.user = User.objects.create_user(email='buyer@test.com', password='testpass123')
+        self.courses = [
+            Course.objects.create(title=f'Курс {index}', price=100 * index, owner=self.user,
+                                  stripe_price_id=f'price_{index}')
+            for index in range(1, 4)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def cart(self, course_ids):
+        return self.client.post('/api/materials/cart/checkout/', {'course_ids': course_ids}, format='json')
+
+    def test_cart_creates_one_session_with_line_item_per_course(self):
+        """Одна сессия на всю корзину, курсы читаются одним запросом, повтор берется из кеша"""
+        ids = [course.id for course in self.courses]
+        # Курсы одним запросом и последний платеж за них для ключа идемпотентности Stripe
+        with self.assertNumQueries(2):
+            response = self.cart(ids + [ids[0]])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([course['id'] for course in response.data['courses']], ids)
+        params, = [request['params'] for request in self.stub.requests]
+        self.assertEqual([item['price'] for item in params['line_items']], ['price_1', 'price_2', 'price_3'])
+        self.assertEqual(params['metadata']['course_ids'], ','.join(map(str, ids)))
+        self.assertEqual(params['metadata']['course_amounts'], '100.00,200.00,300.00')
+
+        # Тот же набор курсов в другом порядке — та же открытая сессия
+        again = self.cart(list(reversed(ids)))
+        self.assertTrue(again.data['reused'])
+        self.assertEqual(again.data['session_id'], response.data['session_id'])
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_cart_rejects_unknown_courses_and_courses_without_price(self):
+        """Неизвестные курсы — 404, курсы без цены в Stripe — 400, пустая корзина — 400"""
+        self.courses[1].stripe_price_id = None
+        self.courses[1].save()
+
+        response = self.cart([self.courses[0].id, 999999])
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data['course_ids'], [999999])
+
+        response = self.cart([course.id for course in self.courses])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['course_ids'], [self.courses[1].id])
+
+        self.assertEqual(self.cart([]).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.stub.requests, [])
@@ -1,6 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import CourseViewSet, LessonListCreateView, LessonRetrieveUpdateDestroyView, create_checkout_session
+from .views import (CourseViewSet, LessonListCreateView, LessonRetrieveUpdateDestroyView, create_cart_checkout_session,
+                    create_checkout_session, create_checkout_session_async)
 
 router = DefaultRouter()
 router.register(r'courses', CourseViewSet, basename='course')
@@ -10,4 +11,7 @@ urlpatterns = [
     path('lessons/', LessonListCreateView.as_view(), name='lesson-list'),
     path('lessons/<int:pk>/', LessonRetrieveUpdateDestroyView.as_view(), name='lesson-detail'),
     path('courses/<int:course_id>/checkout/', create_checkout_session, name='create-checkout-session'),
+    path('courses/<int:course_id>/checkout/async/', create_checkout_session_async,
+         name='create-checkout-session-async'),
+    path('cart/checkout/', create_cart_checkout_session, name='create-cart-checkout-session'),
 ]
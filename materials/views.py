@@ -1,27 +1,43 @@
 from rest_framework import viewsets, generics, permissions
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from django.db.models import Q
 from django.shortcuts import get_object_or_404
-from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.exceptions import APIException, NotAuthenticated, PermissionDenied, Throttled, ValidationError
 
+from .entitlements import entitlements_for_request
 from .models import Course, Lesson
 from .serializers import CourseSerializer, LessonSerializer
 
 from rest_framework.permissions import IsAuthenticated
-from users.permissions import IsOwnerOrModerator, IsOwner, IsNotModerator
+from users.permissions import IsOwnerOrModerator, IsOwner, IsNotModerator, HasCourseAccess
 
 from rest_framework.views import APIView
 
 from rest_framework import status
 from .models import Subscription
-from .serializers import SubscriptionSerializer
+from .serializers import CartCheckoutSerializer, SubscriptionSerializer
 from .paginators import MaterialsPagination
+from . import checkout_cache
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
-from rest_framework.decorators import api_view, permission_classes
-from django.conf import settings
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
+from rest_framework_simplejwt.authentication import JWTAuthentication
 import stripe
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from users.analytics import PERIODS, ROLLUPS, revenue_series
+from users.filters import PaymentRollupFilter
+from users.models import PaymentDailyRollup
+
+from api import deadlines
+from api.deadlines import DeadlineExceeded, deadline_budget
+from api.services import StripeUnavailable, stripe_service
+from api.throttling import CatalogRateThrottle, CheckoutRateThrottle
 
 
 
@@ -32,7 +48,7 @@ class CourseViewSet(viewsets.ModelViewSet):
         ### Права доступа:
         - **Создание**: только авторизованные пользователи (становятся владельцами), НЕ модераторы
         - **Просмотр списка**: все авторизованные пользователи
-        - **Просмотр деталей**: владелец или модератор
+        - **Просмотр деталей и уроков**: владелец, оплативший курс или модератор; для остальных курс не найден (404)
         - **Обновление**: владелец или модератор
         - **Удаление**: только владелец (НЕ модератор)
 
@@ -45,6 +61,7 @@ class CourseViewSet(viewsets.ModelViewSet):
     serializer_class = CourseSerializer
     # Убрал permission_classes по умолчанию, будем определять в get_permissions
     pagination_class = MaterialsPagination
+    throttle_classes = [CatalogRateThrottle]
 
     def get_permissions(self):
         if self.action == 'create':
@@ -56,8 +73,11 @@ class CourseViewSet(viewsets.ModelViewSet):
         elif self.action in ['update', 'partial_update']:
             # Обновление: (владелец И не модератор) ИЛИ модератор
             permission_classes = [IsAuthenticated, IsOwnerOrModerator]
-        elif self.action == 'retrieve':
-            # Просмотр деталей: (владелец И не модератор) ИЛИ модератор
+        elif self.action in ['retrieve', 'lessons']:
+            # Просмотр деталей и уроков: владелец, оплативший курс, модератор или администратор
+            permission_classes = [IsAuthenticated, HasCourseAccess]
+        elif self.action == 'revenue':
+            # Выручка курса: владелец, модератор или администратор
             permission_classes = [IsAuthenticated, IsOwnerOrModerator]
         else:  # list
             # Просмотр списка: все авторизованные
@@ -110,14 +130,14 @@ class CourseViewSet(viewsets.ModelViewSet):
 
             ### Права доступа:
             - Владелец курса
+            - Пользователь, оплативший курс
             - Модератор
             - Администратор
             """,
         responses={
             200: CourseSerializer,
             401: "Пользователь не аутентифицирован",
-            403: "Нет прав для просмотра этого курса",
-            404: "Курс не найден"
+            404: "Курс не найден или нет прав для его просмотра"
         }
     )
     def retrieve(self, request, *args, **kwargs):
@@ -194,24 +214,66 @@ class CourseViewSet(viewsets.ModelViewSet):
 
             ### Права доступа:
             - Владелец курса
+            - Пользователь, оплативший курс
             - Модератор
             - Администратор
             """,
         responses={
             200: LessonSerializer(many=True),
             401: "Пользователь не аутентифицирован",
-            403: "Нет прав для просмотра уроков этого курса",
-            404: "Курс не найден"
+            404: "Курс не найден или нет прав для просмотра его уроков"
         }
     )
-    @action(detail=True, methods=['get'], permission_classes=[permissions.IsAuthenticated, IsOwnerOrModerator])
+    @action(detail=True, methods=['get'], permission_classes=[permissions.IsAuthenticated, HasCourseAccess])
     def lessons(self, request, pk=None):
         """Получить все уроки курса"""
-        course = get_object_or_404(Course, pk=pk)
+        course = self.get_object()
         lessons = course.lessons.all()
-        serializer = LessonSerializer(lessons, many=True)
+        serializer = LessonSerializer(lessons, many=True, context=self.get_serializer_context())
         return Response(serializer.data)
 
+    @swagger_auto_schema(
+        operation_summary="Выручка курса по дням",
+        operation_description="""
+            Выручка курса и его уроков по дням, неделям или месяцам.
+            Считается по дневным итогам платежей, без сканирования самих платежей.
+
+            ### Права доступа:
+            - Владелец курса
+            - Модератор
+            - Администратор
+
+            ### Параметры:
+            - period: day (по умолчанию), week или month
+            - payment_date_from / payment_date_to: период (формат: YYYY-MM-DD)
+            """,
+        manual_parameters=[
+            openapi.Parameter('period', openapi.IN_QUERY, type=openapi.TYPE_STRING, enum=['day', 'week', 'month']),
+            openapi.Parameter('payment_date_from', openapi.IN_QUERY, type=openapi.TYPE_STRING, format='date'),
+            openapi.Parameter('payment_date_to', openapi.IN_QUERY, type=openapi.TYPE_STRING, format='date'),
+        ],
+        responses={
+            200: "Серии выручки по периодам",
+            400: "Неверные параметры",
+            404: "Курс не найден"
+        }
+    )
+    @action(detail=True, methods=['get'])
+    def revenue(self, request, pk=None):
+        """Выручка курса и его уроков по дневным итогам"""
+        course = self.get_object()
+        period = request.query_params.get('period', 'day')
+        if period not in PERIODS:
+            raise ValidationError({'period': f'Неизвестный период: {period}'})
+
+        filterset = PaymentRollupFilter(
+            request.query_params,
+            queryset=PaymentDailyRollup.objects.filter(Q(paid_course=course) | Q(paid_lesson__course=course))
+        )
+        if not filterset.is_valid():
+            raise ValidationError(filterset.errors)
+        return Response(revenue_series(filterset.qs, period, ['is_confirmed'], source=ROLLUPS))
+
     def get_queryset(self):
         """Модераторы видят все курсы, обычные пользователи - только свои"""
         user = self.request.user
@@ -219,6 +281,13 @@ class CourseViewSet(viewsets.ModelViewSet):
         if not user.is_authenticated:
             return Course.objects.none()
 
+        if self.action in ['retrieve', 'lessons']:
+            # Недоступный курс отвечает 404, как несуществующий: 403 выдавал бы, какие id курсов есть
+            entitlements = entitlements_for_request(self.request)
+            if entitlements.is_moderator:
+                return Course.objects.all()
+            return Course.objects.filter(pk__in=entitlements.course_ids)
+
         if user.is_staff or user.is_superuser or user.groups.filter(name='moderators').exists():
             # Администраторы и модераторы видят все курсы
             return Course.objects.all()
@@ -230,12 +299,12 @@ class CourseViewSet(viewsets.ModelViewSet):
         """При создании курса автоматически устанавливаем текущего пользователя как владельца"""
         serializer.save(owner=self.request.user)
 
-    @action(detail=True, methods=['get'], permission_classes=[permissions.IsAuthenticated, IsOwnerOrModerator])
+    @action(detail=True, methods=['get'], permission_classes=[permissions.IsAuthenticated, HasCourseAccess])
     def lessons(self, request, pk=None):
         """Получить все уроки курса"""
-        course = get_object_or_404(Course, pk=pk)
+        course = self.get_object()
         lessons = course.lessons.all()
-        serializer = LessonSerializer(lessons, many=True)
+        serializer = LessonSerializer(lessons, many=True, context=self.get_serializer_context())
         return Response(serializer.data)
 
 class LessonListCreateView(generics.ListCreateAPIView):
@@ -258,6 +327,7 @@ class LessonListCreateView(generics.ListCreateAPIView):
 
     serializer_class = LessonSerializer
     pagination_class = MaterialsPagination
+    throttle_classes = [CatalogRateThrottle]
 
     def get_permissions(self):
         if self.request.method == 'POST':
@@ -403,12 +473,13 @@ class LessonRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
     """
     Generic View для получения, обновления и удаления урока.
     Права доступа:
-    - Просмотр: владелец или модератор
+    - Просмотр: владелец, оплативший урок или курс, модератор
     - Обновление: владелец или модератор
     - Удаление: только владелец (НЕ модератор)
     """
     queryset = Lesson.objects.all()
     serializer_class = LessonSerializer
+    throttle_classes = [CatalogRateThrottle]
 
     def get_permissions(self):
         if self.request.method == 'DELETE':
@@ -418,8 +489,8 @@ class LessonRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
             # Обновление: (владелец И не модератор) ИЛИ модератор
             return [IsAuthenticated(), IsOwnerOrModerator()]
         elif self.request.method == 'GET':
-            # Просмотр: (владелец И не модератор) ИЛИ модератор
-            return [IsAuthenticated(), IsOwnerOrModerator()]
+            # Просмотр: владелец, оплативший урок или курс, модератор
+            return [IsAuthenticated(), HasCourseAccess()]
 
         return [IsAuthenticated()]
 
@@ -430,8 +501,11 @@ class LessonRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
         if not user.is_authenticated:
             return Lesson.objects.none()
 
-        # Для GET запросов мы уже проверили права через permissions
-        # Но для безопасности все равно фильтруем
+        if self.request.method == 'GET':
+            # Доступ к уроку проверяет HasCourseAccess
+            return Lesson.objects.all()
+
+        # Для изменения и удаления дополнительно фильтруем
         if user.is_staff or user.is_superuser or user.groups.filter(name='moderators').exists():
             return Lesson.objects.all()
         else:
@@ -504,8 +578,111 @@ class SubscriptionAPIView(APIView):
         })
 
 
+def _course_name(course):
+    # Проверяем разные варианты названий полей
+    return getattr(course, 'name', None) or getattr(course, 'title', None) or f"Курс {course.id}"
+
+
+CHECKOUT_SUCCESS_URL = 'http://localhost:8000/api/materials/payment/success/?session_id={CHECKOUT_SESSION_ID}'
+CHECKOUT_CANCEL_URL = 'http://localhost:8000/api/materials/payment/cancel/'
+
+
+def _checkout_options(course, user, window):
+    """Параметры сессии оплаты курса для stripe_service (кроме цены)"""
+    return {
+        'success_url': CHECKOUT_SUCCESS_URL,
+        'cancel_url': CHECKOUT_CANCEL_URL,
+        'client_reference_id': str(user.id),
+        'metadata': {
+            'course_id': str(course.id),
+            'user_id': str(user.id),
+            'course_name': str(_course_name(course)),
+            'course_price': str(getattr(course, 'price', 0))
+        },
+        'customer_email': user.email,
+        'expires_at': checkout_cache.session_expires_at(window)
+    }
+
+
+def _cart_options(courses, user, window):
+    """
+    Параметры сессии оплаты корзины. ID курсов и суммы, на которые созданы их цены в Stripe,
+    идут в метаданные: по ним вебхук создает платеж на каждый курс (api.webhooks)
+    """
+    return {
+        'success_url': CHECKOUT_SUCCESS_URL,
+        'cancel_url': CHECKOUT_CANCEL_URL,
+        'client_reference_id': str(user.id),
+        'metadata': {
+            'user_id': str(user.id),
+            'course_ids': ','.join(str(course.id) for course in courses),
+            'course_amounts': ','.join(
+                str(course.stripe_price_amount if course.stripe_price_amount is not None else course.price)
+                for course in courses
+            ),
+        },
+        'customer_email': user.email,
+        'expires_at': checkout_cache.session_expires_at(window)
+    }
+
+
+def _course_data(course):
+    return {
+        'id': course.id,
+        'name': str(_course_name(course)),
+        'price': str(getattr(course, 'price', 0)),
+        'stripe_price_id': course.stripe_price_id
+    }
+
+
+def _session_data(checkout, reused):
+    """Общая часть ответа с сессией оплаты"""
+    return {
+        'checkout_url': checkout['url'],
+        'session_id': checkout['session_id'],
+        'reused': reused,
+        'session': {
+            'id': checkout['session_id'],
+            'payment_status': checkout['payment_status'],
+            'amount_total': checkout['amount_total'],
+            'currency': checkout['currency'],
+            'expires_at': checkout['expires_at']
+        },
+    }
+
+
+def _checkout_data(course, checkout, reused):
+    """Тело ответа с сессией оплаты курса"""
+    return {**_session_data(checkout, reused), 'course': _course_data(course)}
+
+
+def _no_price_data(course_id):
+    return {
+        "error": "Для этого курса не настроена цена в Stripe",
+        "detail": "Обратитесь к администратору",
+        "course_id": course_id,
+    }
+
+
+def _not_found_data(course_id):
+    return {
+        "error": "Курс не найден",
+        "detail": f"Курс с ID {course_id} не существует"
+    }
+
+
+def _stripe_error_data(error):
+    return {
+        "error": "Ошибка платежной системы",
+        "detail": str(error),
+        "stripe_error": error.code if hasattr(error, 'code') else None
+    }
+
+
+@deadline_budget(15.0)
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@throttle_classes([CheckoutRateThrottle])
 def create_checkout_session(request, course_id):
     """
     Создание Stripe Checkout сессии для покупки курса
@@ -517,80 +694,180 @@ def create_checkout_session(request, course_id):
 
         # Проверяем, что у курса есть stripe_price_id
         if not course.stripe_price_id:
-            return Response(
-                {
-                    "error": "Для этого курса не настроена цена в Stripe",
-                    "detail": "Обратитесь к администратору",
-                    "course_id": course_id,
-                },
-                status=status.HTTP_400_BAD_REQUEST
+            return Response(_no_price_data(course_id), status=status.HTTP_400_BAD_REQUEST)
+
+        # Создаем сессию Checkout через общий клиент Stripe
+        # (пул соединений, таймауты, повторы и автомат отключения — api.services)
+        def create_session():
+            window = checkout_cache.idempotency_window()
+            return stripe_service.create_checkout_session(
+                price_id=course.stripe_price_id,
+                idempotency_key=checkout_cache.idempotency_key(
+                    request.user.id, [course.id], course.stripe_price_id, window
+                ),
+                **_checkout_options(course, request.user, window)
             )
 
-        # Получаем название курса (проверяем разные варианты названий полей)
-        course_name = getattr(course, 'name', None) or getattr(course, 'title', None) or f"Курс {course_id}"
-        course_price = getattr(course, 'price', 0)
-        course_description = getattr(course, 'description', '')
-
-        # Инициализируем Stripe
-        stripe.api_key = settings.STRIPE_API_KEY
-
-        # Создаем сессию Checkout
-        checkout_session = stripe.checkout.Session.create(
-            line_items=[
-                {
-                    'price': course.stripe_price_id,
-                    'quantity': 1,
-                },
-            ],
-            mode='payment',
-            success_url='http://localhost:8000/api/materials/payment/success/?session_id={CHECKOUT_SESSION_ID}',
-            cancel_url='http://localhost:8000/api/materials/payment/cancel/',
-            client_reference_id=str(request.user.id),
-            metadata={
-                'course_id': str(course_id),
-                'user_id': str(request.user.id),
-                'course_name': str(course_name),
-                'course_price': str(course_price)
-            },
-            customer_email=request.user.email
+        # Повторный запрос (двойной клик) получает уже открытую сессию без обращения к Stripe
+        checkout, reused = checkout_cache.get_or_create(
+            request.user.id, course.id, course.stripe_price_id, create_session
         )
 
-        return Response({
-            'checkout_url': checkout_session.url,
-            'session_id': checkout_session.id,
-            'session': {
-                'id': checkout_session.id,
-                'payment_status': checkout_session.payment_status,
-                'amount_total': checkout_session.amount_total,
-                'currency': checkout_session.currency
-            },
-            'course': {
-                'id': course.id,
-                'name': str(course_name),
-                'price': str(course_price),
-                'stripe_price_id': course.stripe_price_id
-            }
-        }, status=status.HTTP_200_OK)
+        return Response(_checkout_data(course, checkout, reused), status=status.HTTP_200_OK)
 
     except Course.DoesNotExist:
+        return Response(_not_found_data(course_id), status=status.HTTP_404_NOT_FOUND)
+    except (DeadlineExceeded, StripeUnavailable):
+        raise
+    except stripe.error.StripeError as e:
+        if deadlines.expired():
+            # Stripe не ответил за оставшийся бюджет времени запроса
+            raise DeadlineExceeded()
+        return Response(_stripe_error_data(e), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except Exception as e:
         return Response(
             {
-                "error": "Курс не найден",
-                "detail": f"Курс с ID {course_id} не существует"
+                "error": "Внутренняя ошибка сервера",
+                "detail": str(e)
             },
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@deadline_budget(15.0)
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@throttle_classes([CheckoutRateThrottle])
+def create_cart_checkout_session(request):
+    """
+    Создание одной Stripe Checkout сессии на несколько курсов (корзина)
+    POST /api/materials/cart/checkout/  {"course_ids": [1, 2, 3]}
+
+    Курсы читаются одним запросом, у каждого должна быть цена в Stripe. Сессия получает
+    по позиции на курс, а после оплаты вебхук создает по платежу на каждый курс.
+    Повторный запрос с тем же набором курсов получает уже открытую сессию.
+    """
+    serializer = CartCheckoutSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    course_ids = serializer.validated_data['course_ids']
+
+    found = Course.objects.in_bulk(course_ids)
+    missing = [course_id for course_id in course_ids if course_id not in found]
+    if missing:
+        return Response(
+            {"error": "Курсы не найдены", "course_ids": missing},
             status=status.HTTP_404_NOT_FOUND
         )
-    except stripe.error.StripeError as e:
+    courses = [found[course_id] for course_id in course_ids]
+    without_price = [course.id for course in courses if not course.stripe_price_id]
+    if without_price:
         return Response(
             {
-                "error": "Ошибка платежной системы",
-                "detail": str(e),
-                "stripe_error": e.code if hasattr(e, 'code') else None
+                "error": "Для некоторых курсов не настроена цена в Stripe",
+                "detail": "Обратитесь к администратору",
+                "course_ids": without_price,
             },
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            status=status.HTTP_400_BAD_REQUEST
         )
+
+    # Порядок курсов не важен: сессия строится по курсам в порядке ID, чтобы повтор запроса
+    # с тем же ключом идемпотентности шел в Stripe с теми же параметрами
+    ordered = sorted(courses, key=lambda course: course.id)
+    price_ids = [course.stripe_price_id for course in ordered]
+    # Сессия из кеша подходит, пока не сменилась цена ни одного курса
+    prices_key = ','.join(price_ids)
+
+    def create_session():
+        window = checkout_cache.idempotency_window()
+        return stripe_service.create_checkout_session(
+            price_id=price_ids,
+            idempotency_key=checkout_cache.idempotency_key(request.user.id, course_ids, prices_key, window),
+            **_cart_options(ordered, request.user, window)
+        )
+
+    try:
+        checkout, reused = checkout_cache.get_or_create(
+            request.user.id, checkout_cache.cart_key(course_ids), prices_key, create_session
+        )
+    except stripe.error.StripeError as e:
+        if deadlines.expired():
+            raise DeadlineExceeded()
+        return Response(_stripe_error_data(e), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    return Response(
+        {**_session_data(checkout, reused), 'courses': [_course_data(course) for course in courses]},
+        status=status.HTTP_200_OK
+    )
+
+
+def _error_response(exc):
+    """Ответ в формате DRF ({"detail": ...}) для APIException вне DRF view"""
+    response = JsonResponse({'detail': str(exc.detail)}, status=exc.status_code)
+    wait = getattr(exc, 'wait', None)
+    if wait is not None:
+        response['Retry-After'] = str(int(wait) + 1)
+    return response
+
+
+def _authenticate_and_throttle(request):
+    """
+    JWT-аутентификация и троттлинг, как у create_checkout_session.
+    Возвращает пользователя или выбрасывает APIException.
+    """
+    result = JWTAuthentication().authenticate(request)
+    if result is None:
+        raise NotAuthenticated()
+    request.user = result[0]
+    throttle = CheckoutRateThrottle()
+    if not throttle.allow_request(request, None):
+        raise Throttled(throttle.wait())
+    return request.user
+
+
+@deadline_budget(15.0)
+@csrf_exempt
+@require_POST
+async def create_checkout_session_async(request, course_id):
+    """
+    Асинхронная версия create_checkout_session для запуска под ASGI (myproject.asgi)
+    POST /api/materials/courses/{id}/checkout/async/
+
+    Пока Stripe отвечает, view не занимает поток: курс читается через async ORM,
+    сессия создается через stripe_service.create_checkout_session_async.
+    Ответы и ошибки те же, что у синхронной версии.
+    """
+    try:
+        user = await sync_to_async(_authenticate_and_throttle)(request)
+        course = await Course.objects.aget(id=course_id)
+        if not course.stripe_price_id:
+            return JsonResponse(_no_price_data(course_id), status=status.HTTP_400_BAD_REQUEST)
+
+        async def create_session():
+            window = checkout_cache.idempotency_window()
+            return await stripe_service.create_checkout_session_async(
+                price_id=course.stripe_price_id,
+                idempotency_key=await checkout_cache.aidempotency_key(
+                    user.id, [course.id], course.stripe_price_id, window
+                ),
+                **_checkout_options(course, user, window)
+            )
+
+        checkout, reused = await checkout_cache.aget_or_create(
+            user.id, course.id, course.stripe_price_id, create_session
+        )
+        return JsonResponse(_checkout_data(course, checkout, reused), status=status.HTTP_200_OK)
+
+    except Course.DoesNotExist:
+        return JsonResponse(_not_found_data(course_id), status=status.HTTP_404_NOT_FOUND)
+    except APIException as e:
+        # Аутентификация, троттлинг, бюджет времени и автомат отключения Stripe
+        return _error_response(e)
+    except stripe.error.StripeError as e:
+        if deadlines.expired():
+            return _error_response(DeadlineExceeded())
+        return JsonResponse(_stripe_error_data(e), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     except Exception as e:
-        return Response(
+        return JsonResponse(
             {
                 "error": "Внутренняя ошибка сервера",
                 "detail": str(e)
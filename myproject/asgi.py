@@ -5,6 +5,10 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
+
+Под ASGI (например, uvicorn myproject.asgi:application) асинхронный
+POST /api/materials/courses/<id>/checkout/async/ не занимает поток, пока ждет Stripe;
+сравнение с синхронным view — python manage.py benchmark_checkout.
 """
 
 import os
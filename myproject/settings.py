@@ -48,6 +48,9 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.idempotency.IdempotencyMiddleware',
+    'api.middleware.AdmissionControlMiddleware',
+    'api.deadlines.RequestDeadlineMiddleware',
 ]
 
 ROOT_URLCONF = 'myproject.urls'
@@ -80,6 +83,43 @@ DATABASES = {
     }
 }
 
+# Шардирование платежей по user_id (users.sharding). Базы шардов payments_0, payments_1, ...
+# описаны всегда (файлы создаются только при обращении), а маршрутизация включается,
+# только если PAYMENT_SHARD_COUNT > 0. После изменения числа шардов —
+# migrate --database для новых баз и команда reshard_payments. При уменьшении числа
+# шардов PAYMENT_SHARD_SLOTS оставляет старые базы доступными для reshard_payments --source.
+PAYMENT_SHARD_COUNT = int(os.getenv('PAYMENT_SHARD_COUNT', '0'))
+PAYMENT_SHARD_SLOTS = max(PAYMENT_SHARD_COUNT, int(os.getenv('PAYMENT_SHARD_SLOTS', '2')))
+PAYMENT_SHARD_DATABASES = [f'payments_{index}' for index in range(PAYMENT_SHARD_SLOTS)]
+for _alias in PAYMENT_SHARD_DATABASES:
+    DATABASES[_alias] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'{_alias}.sqlite3',
+    }
+PAYMENT_SHARDS = PAYMENT_SHARD_DATABASES[:PAYMENT_SHARD_COUNT]
+
+DATABASE_ROUTERS = ['users.routers.PaymentShardRouter']
+
+# Кеш. Индексы доступа, открытые сессии оплаты и их блокировки должны быть общими для всех
+# воркеров, иначе сброс после оплаты или отзыва прав виден только одному процессу:
+# в production задайте REDIS_URL (нужен пакет redis). Без него кеш — память процесса,
+# и время жизни индексов доступа сокращено (ENTITLEMENTS_CACHE_TIMEOUT)
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+SHARED_CACHE = bool(REDIS_URL)
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -136,8 +176,19 @@ REST_FRAMEWORK = {
         'rest_framework.filters.OrderingFilter',
         'rest_framework.filters.SearchFilter',
     ],
+    # Лимиты для троттлинга (api.throttling): скользящее окно по алгоритму GCRA
+    'DEFAULT_THROTTLE_RATES': {
+        'token': '10/min',
+        'register': '5/min',
+        'checkout': '20/min',
+        'catalog': '300/min',
+    },
 }
 
+# Хранилище для троттлинга: 'local' — память процесса, 'cache' — кеш Django (общий для воркеров)
+API_THROTTLE_STORE = os.getenv('API_THROTTLE_STORE', 'local')
+API_THROTTLE_CACHE = 'default'
+
 
 # Custom user model
 AUTH_USER_MODEL = 'users.User'
@@ -157,6 +208,174 @@ load_dotenv()
 STRIPE_API_KEY = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_PUBLISHABLE_KEY = os.getenv('STRIPE_PUBLISHABLE_KEY')
 
+# Таймауты HTTP-запросов к Stripe: (connect, read), секунды
+STRIPE_TIMEOUT = (3.05, 20)
+
+# Адрес API Stripe (для тестов и локальной разработки — api.stripe_stub)
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+
+# Клиент Stripe (api.services.stripe_service)
+STRIPE_CLIENT = {
+    # Сколько keep-alive соединений держать в пуле
+    'POOL_SIZE': 10,
+    # Повторы после сбоев сети, 5xx и 429; пауза — случайная в окне BACKOFF_BASE * 2^n, не больше BACKOFF_MAX
+    'MAX_RETRIES': 2,
+    'BACKOFF_BASE': 0.25,
+    'BACKOFF_MAX': 2.0,
+    # Автомат отключения: сбоев подряд до размыкания и пауза до пробного запроса, секунды
+    'BREAKER_FAILURES': 5,
+    'BREAKER_RESET': 30,
+}
+
+# Срок действия сессии Stripe Checkout, секунды (Stripe допускает от 30 минут до 24 часов).
+# Пока сессия действует, повторный запрос оплаты курса получает ее из кеша (materials.checkout_cache).
+# Отсчитывается от начала окна ключа идемпотентности, поэтому должен быть больше 30 минут плюс окно
+CHECKOUT_SESSION_TTL = 60 * 60
+
+# Сколько курсов можно оплатить одной сессией (корзина): ID и цены курсов хранятся
+# в метаданных сессии, а значение метаданных в Stripe ограничено 500 символами
+CHECKOUT_CART_MAX_COURSES = 20
+
+# Вебхуки Stripe (api.webhooks): секрет подписи (whsec_...) и допустимое расхождение времени подписи, секунды
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+STRIPE_WEBHOOK_TOLERANCE = 300
+
+# Обработка событий Stripe (команда process_stripe_events): размер пачки и число попыток
+# для события, обработка которого завершается ошибкой
+STRIPE_EVENTS = {
+    'BATCH_SIZE': 100,
+    'MAX_ATTEMPTS': 5,
+}
+
+# Сверка платежей со Stripe (api.reconciliation, команда reconcile_stripe)
+STRIPE_RECONCILE = {
+    # Сколько интервалов времени листать параллельно и во сколько потоков
+    'SLICES': 32,
+    'WORKERS': 8,
+    # Общий лимит запросов к Stripe на время сверки
+    'RATE': '50/s',
+    # Запас по краям периода, секунды: платеж в базе создается позже, чем объект в Stripe
+    'MARGIN': 60 * 60,
+}
+
+# Исходящие вебхуки партнерам (api.outbox, команда deliver_webhooks)
+OUTBOUND_WEBHOOKS = {
+    # Сколько событий одного адреса отправлять одним запросом
+    'BATCH_SIZE': 100,
+    # Сколько адресов обслуживать одновременно
+    'WORKERS': 8,
+    # Таймаут запроса к партнеру, секунды
+    'TIMEOUT': 10,
+    # Пауза после ошибки: BACKOFF_BASE * 2^(ошибок подряд - 1), не больше BACKOFF_MAX, секунды
+    'BACKOFF_BASE': 5,
+    'BACKOFF_MAX': 60 * 60,
+    # Сколько дней хранить доставленные события
+    'RETENTION_DAYS': 7,
+}
+
+# Заголовок Idempotency-Key у мутирующих запросов (api.idempotency)
+IDEMPOTENCY = {
+    'METHODS': ['POST'],
+    # Сколько хранится ответ для повторов, секунды
+    'TTL': 24 * 60 * 60,
+    # Через сколько секунд блокировку незавершенного запроса (упавший воркер) можно перехватить
+    'LOCK_TIMEOUT': 60,
+    # Пути, ответы которых нельзя хранить и воспроизводить: они содержат токены
+    'EXCLUDED_PATHS': [
+        r'^/api/users/token/', r'^/api/users/register/', r'^/api/users/users/registration/',
+    ],
+}
+
+# Фоновые задачи в базе данных (api.jobs, команда run_worker)
+JOBS = {
+    # Потоков в одном воркере и пауза между проверками пустой очереди, секунды
+    'THREADS': 4,
+    'POLL_INTERVAL': 1.0,
+    # Сколько секунд задача считается захваченной: потом ее вернут в очередь как брошенную.
+    # Столько же действует блокировка exclusive-задачи, поэтому они работают пачками
+    'LEASE': 5 * 60,
+    'MAX_ATTEMPTS': 5,
+    # Пауза перед повтором: BACKOFF_BASE * 2^(попытка - 1), не больше BACKOFF_MAX, секунды
+    'BACKOFF_BASE': 5,
+    'BACKOFF_MAX': 60 * 60,
+    # Как часто воркер возвращает брошенные задачи и удаляет старые выполненные, секунды
+    'MAINTENANCE_INTERVAL': 60,
+    # Сколько дней хранить выполненные задачи
+    'RETENTION_DAYS': 7,
+}
+
+# Каталог Stripe: продукты и цены курсов (materials.stripe_catalog, команда sync_stripe_catalog)
+STRIPE_CATALOG = {
+    # Валюта цен (Course.price — в долларах)
+    'CURRENCY': 'usd',
+    # Сколько потоков одновременно создают продукты и цены
+    'WORKERS': 4,
+    # Общий лимит запросов к Stripe на все потоки (лимит Stripe в live-режиме — 100/s)
+    'RATE': '25/s',
+    # Пересоздавать цену после изменения цены уже синхронизированного курса (фоновой задачей)
+    'SYNC_ON_PRICE_CHANGE': True,
+}
+
 # Проверка, что ключ загружен
 if not STRIPE_API_KEY:
-    raise ValueError("STRIPE_SECRET_KEY не найден в переменных окружения")
\ No newline at end of file
+    raise ValueError("STRIPE_SECRET_KEY не найден в переменных окружения")
+
+# Контроль допуска (api.middleware.AdmissionControlMiddleware):
+# лимит одновременных запросов и короткая очередь для каждого класса эндпоинтов.
+# Классы проверяются по порядку, запрос относится к первому подходящему.
+ADMISSION_CONTROL = {
+    'ENABLED': True,
+    'MAX_IN_FLIGHT': 64,
+    # Сколько слотов из MAX_IN_FLIGHT доступно только самым приоритетным классам
+    'RESERVED': 8,
+    # Значение заголовка Retry-After при отказе, секунды
+    'RETRY_AFTER': 1,
+    'CLASSES': {
+        'checkout': {
+            'paths': [r'^/api/materials/courses/\d+/checkout/', r'^/api/materials/cart/checkout/',
+                      r'^/api/stripe-payments/'],
+            'limit': 16, 'queue': 32, 'timeout': 2.0, 'priority': 2,
+        },
+        'payments': {
+            'paths': [r'^/api/users/payments/'],
+            'limit': 16, 'queue': 32, 'timeout': 2.0, 'priority': 2,
+        },
+        'auth': {
+            'paths': [r'^/api/users/token/', r'^/api/users/register/', r'^/api/users/users/registration/'],
+            'limit': 8, 'queue': 16, 'timeout': 1.0, 'priority': 1,
+        },
+        'catalog': {
+            'paths': [r'^/api/materials/'],
+            'limit': 32, 'queue': 32, 'timeout': 0.5, 'priority': 0,
+        },
+    },
+}
+
+# Бюджет времени на запрос (api.deadlines): по умолчанию, секунды.
+# Для отдельных view задается атрибутом deadline_budget или декоратором @deadline_budget
+# (административные выгрузки, пакетный ввод и импорт — свой бюджет или без срока)
+REQUEST_DEADLINE = {
+    'DEFAULT': 10.0,
+    # Как часто (в шагах виртуальной машины SQLite) проверять, не истек ли срок
+    'SQLITE_PROGRESS_STEPS': 1000,
+}
+
+# Индекс доступа к курсам (materials.entitlements): время жизни в кеше, секунды.
+# С кешем в памяти процесса сброс не доходит до других воркеров: отозванный доступ
+# действует в них не дольше этого срока, поэтому он короткий
+ENTITLEMENTS_CACHE_TIMEOUT = 60 * 60 if SHARED_CACHE else 60
+
+# Импорт пользователей: число процессов для хеширования паролей (None — по числу CPU)
+USER_IMPORT_WORKERS = None
+
+# Размер порции строк при потоковой выгрузке платежей
+PAYMENT_EXPORT_CHUNK_SIZE = 2000
+
+# Пакетный ввод платежей: максимум строк в одном запросе
+PAYMENT_BATCH_MAX_ROWS = 1000
+
+# Архив платежей: платежи старше этого числа дней переносятся командой archive_payments
+PAYMENT_ARCHIVE_AFTER_DAYS = 365
+
+# Размер блока ID платежей, который процесс резервирует за раз при шардировании
+PAYMENT_ID_BLOCK_SIZE = 100
@@ -0,0 +1,134 @@
+"""
+Аналитика выручки по платежам.
+
+Все агрегаты считаются в базе одним запросом GROUP BY (TruncDate/TruncWeek/TruncMonth,
+Sum, Count), в Python только раскладываются по сериям. Источник — либо сырые платежи
+(по индексу payment_date), либо дневные итоги PaymentDailyRollup, если запрошенные
+фильтры по ним считаются.
+"""
+from decimal import Decimal
+from operator import itemgetter
+
+from django.db.models import Count, DateField, F, Sum
+from django.db.models.functions import TruncDate, TruncMonth, TruncWeek
+
+PERIODS = {
+    'day': lambda field: TruncDate(field),
+    'week': lambda field: TruncWeek(field, output_field=DateField()),
+    'month': lambda field: TruncMonth(field, output_field=DateField()),
+}
+
+# Для дневных итогов дата уже без времени
+ROLLUP_PERIODS = {
+    'day': lambda field: F(field),
+    'week': lambda field: TruncWeek(field),
+    'month': lambda field: TruncMonth(field),
+}
+
+
+class SeriesSource:
+    """Откуда брать дату, сумму и число платежей при агрегации"""
+
+    def __init__(self, periods, date_field, count):
+        self.periods = periods
+        self.date_field = date_field
+        self.count = count
+
+
+PAYMENTS = SeriesSource(PERIODS, 'payment_date', Count('id'))
+ROLLUPS = SeriesSource(ROLLUP_PERIODS, 'date', Sum('count'))
+
+# Название группировки в API -> поле модели Payment
+GROUP_FIELDS = {
+    'course': 'paid_course',
+    'lesson': 'paid_lesson',
+    'payment_method': 'payment_method',
+    'is_confirmed': 'is_confirmed',
+}
+
+CENTS = Decimal('0.01')
+
+
+def _money(value):
+    return str(Decimal(value).quantize(CENTS))
+
+
+def parse_group_by(value):
+    """Разбирает ?group_by=course,payment_method. Возвращает список или выбрасывает ValueError"""
+    groups = [name.strip() for name in (value or '').split(',') if name.strip()]
+    unknown = [name for name in groups if name not in GROUP_FIELDS]
+    if unknown:
+        raise ValueError(f'Неизвестная группировка: {", ".join(unknown)}')
+    return list(dict.fromkeys(groups))
+
+
+def revenue_series(queryset, period='day', group_by=(), source=PAYMENTS):
+    """
+    Выручка и число платежей по периодам в компактном виде для графиков:
+
+        {
+            "period": "day",
+            "buckets": ["2024-01-01", "2024-01-02"],
+            "series": [
+                {"group": {"course": 1}, "revenue": ["100.00", null], "count": [1, 0]}
+            ],
+            "totals": {"revenue": "100.00", "count": 1}
+        }
+
+    Значения revenue/count в каждой серии выровнены по списку buckets.
+    Вместо одного queryset можно передать список (горячая таблица и архив) —
+    агрегаты частей складываются.
+    """
+    fields = [GROUP_FIELDS[name] for name in group_by]
+    querysets = queryset if isinstance(queryset, (list, tuple)) else [queryset]
+    rows = []
+    for part in querysets:
+        rows.extend(
+            part
+            .order_by()
+            .annotate(bucket=source.periods[period](source.date_field))
+            .values('bucket', *fields)
+            .annotate(revenue=Sum('amount'), count=source.count)
+            .order_by('bucket', *fields)
+        )
+    if len(querysets) > 1:
+        rows.sort(key=itemgetter('bucket'))
+
+    buckets = []
+    positions = {}
+    series = {}
+    total_revenue = Decimal(0)
+    total_count = 0
+
+    for row in rows:
+        bucket = row['bucket']
+        if bucket not in positions:
+            positions[bucket] = len(buckets)
+            buckets.append(bucket)
+        key = tuple(row[field] for field in fields)
+        points = series.setdefault(key, {})
+        revenue, count = points.get(positions[bucket], (0, 0))
+        points[positions[bucket]] = (revenue + row['revenue'], count + row['count'])
+        total_revenue += row['revenue']
+        total_count += row['count']
+
+    result = []
+    for key, points in series.items():
+        revenue = [None] * len(buckets)
+        count = [0] * len(buckets)
+        for position, (amount, number) in points.items():
+            revenue[position] = _money(amount)
+            count[position] = number
+        result.append({
+            'group': dict(zip(group_by, key)),
+            'revenue': revenue,
+            'count': count,
+        })
+
+    return {
+        'period': period,
+        'group_by': list(group_by),
+        'buckets': [bucket.isoformat() for bucket in buckets],
+        'series': result,
+        'totals': {'revenue': _money(total_revenue), 'count': total_count},
+    }
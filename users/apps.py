@@ -6,3 +6,5 @@ class UsersConfig(AppConfig):
     name = "users"
     verbose_name = "Пользователи"
 
+    def ready(self):
+        from . import signals  # noqa: F401
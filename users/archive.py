@@ -0,0 +1,168 @@
+"""
+Архивирование старых платежей и прозрачное чтение горячей и архивной таблиц.
+
+Команда archive_payments переносит платежи старше порога из Payment в ArchivedPayment
+пачками. Сигналы платежей на время переноса отключены: платеж не исчезает, а переезжает,
+поэтому дневные итоги, сводки трат и доступы к курсам не меняются.
+
+Списки и выгрузки читают только горячую таблицу, пока фильтр payment_date_from
+не уходит в архивный период. Тогда обе выборки объединяются MergedQuerySet:
+каждая часть сортируется в базе, а слияние идет в Python через heapq.merge.
+"""
+import datetime
+import heapq
+import itertools
+from operator import attrgetter, itemgetter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import ArchivedPayment
+from .sharding import payment_querysets
+from .signals import muted_payment_signals
+
+# Поля, которые переносятся в архив (ID сохраняется)
+ARCHIVE_FIELDS = (
+    'id', 'user_id', 'payment_date', 'paid_course_id', 'paid_lesson_id',
+    'amount', 'payment_method', 'stripe_id', 'is_confirmed',
+)
+
+
+def archive_cutoff(days=None):
+    """Момент, старше которого платежи переносятся в архив"""
+    if days is None:
+        days = settings.PAYMENT_ARCHIVE_AFTER_DAYS
+    return timezone.now() - datetime.timedelta(days=days)
+
+
+def archive_payments(cutoff, batch_size=1000, on_batch=None):
+    """
+    Переносит платежи с payment_date < cutoff в архив пачками по batch_size,
+    каждая пачка — в своей транзакции. Платежи в шардах переносятся по очереди
+    в архив в default. Возвращает число перенесенных платежей.
+    """
+    moved = 0
+    for payments in payment_querysets():
+        while True:
+            # Архив вставляется до удаления и с ignore_conflicts: после сбоя между
+            # двумя транзакциями повторный запуск ничего не задвоит
+            with transaction.atomic(using=payments.db), transaction.atomic(), muted_payment_signals():
+                rows = list(
+                    payments
+                    .filter(payment_date__lt=cutoff)
+                    .order_by('pk')
+                    .values(*ARCHIVE_FIELDS)[:batch_size]
+                )
+                if not rows:
+                    break
+                ArchivedPayment.objects.bulk_create(
+                    [ArchivedPayment(**row) for row in rows],
+                    ignore_conflicts=True
+                )
+                payments.filter(pk__in=[row['id'] for row in rows]).delete()
+            moved += len(rows)
+            if on_batch is not None:
+                on_batch(moved)
+    return moved
+
+
+def archive_horizon():
+    """Дата и время самого свежего архивного платежа (None — архив пуст)"""
+    return ArchivedPayment.objects.aggregate(latest=Max('payment_date'))['latest']
+
+
+def reaches_archive(date_from):
+    """Попадает ли период, начинающийся с date_from (date или None), в архив"""
+    if date_from is None:
+        return False
+    horizon = archive_horizon()
+    if horizon is None:
+        return False
+    start = timezone.make_aware(datetime.datetime.combine(date_from, datetime.time.min))
+    return start <= horizon
+
+
+class _OrderKey:
+    """Ключ сортировки с направлением для каждого поля"""
+
+    __slots__ = ('parts',)
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __lt__(self, other):
+        for (mine, descending), (theirs, _) in zip(self.parts, other.parts):
+            if mine == theirs:
+                continue
+            return mine > theirs if descending else mine < theirs
+        return False
+
+
+class MergedQuerySet:
+    """
+    Объединение нескольких одинаково отсортированных выборок (горячая таблица и архив).
+    Поддерживает то, что нужно пагинации, сериализаторам и выгрузке:
+    count(), срезы, итерацию, values_list(...) и iterator(chunk_size=...).
+    Срез [a:b] читает из каждой части не больше b строк.
+    """
+
+    ordered = True
+
+    def __init__(self, parts, ordering=None, fields=None):
+        self.parts = list(parts)
+        self.ordering = list(ordering or self._ordering_of(self.parts[0]))
+        self.fields = fields
+        self.model = self.parts[0].model
+
+    @staticmethod
+    def _ordering_of(queryset):
+        return queryset.query.order_by or queryset.model._meta.ordering or ['pk']
+
+    def _key(self):
+        getters = []
+        for name in self.ordering:
+            descending = name.startswith('-')
+            field = name.lstrip('-')
+            if self.fields is not None:
+                field = 'id' if field == 'pk' else field
+                getter = itemgetter(self.fields.index(field))
+            else:
+                getter = attrgetter(field)
+            getters.append((getter, descending))
+        return lambda row: _OrderKey([(getter(row), descending) for getter, descending in getters])
+
+    def _merge(self, iterables):
+        return heapq.merge(*iterables, key=self._key())
+
+    def count(self):
+        return sum(part.count() for part in self.parts)
+
+    def __len__(self):
+        return self.count()
+
+    def exists(self):
+        return any(part.exists() for part in self.parts)
+
+    def __iter__(self):
+        return iter(self._merge(self.parts))
+
+    def __getitem__(self, item):
+        if isinstance(item, int):
+            return self[item:item + 1][0]
+        start = item.start or 0
+        stop = item.stop
+        if stop is None:
+            return list(itertools.islice(iter(self), start, None))
+        return list(itertools.islice(self._merge(part[:stop] for part in self.parts), start, stop))
+
+    def values_list(self, *fields):
+        return MergedQuerySet(
+            [part.values_list(*fields) for part in self.parts],
+            ordering=self.ordering,
+            fields=list(fields)
+        )
+
+    def iterator(self, chunk_size=None):
+        return self._merge(part.iterator(chunk_size=chunk_size) for part in self.parts)
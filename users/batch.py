@@ -0,0 +1,110 @@
+"""
+Пакетный ввод платежей (например, наличных, принятых сотрудниками).
+
+Каждая строка проверяется сериализатором без запросов к базе, существование
+пользователей, курсов и уроков — одним запросом IN на модель, затем все платежи
+вставляются одним bulk_create в транзакции. Если хотя бы одна строка некорректна,
+ничего не сохраняется, а ошибки возвращаются по номерам строк.
+"""
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from materials.models import Course, Lesson
+
+from .models import Payment, User
+from .serializers import PaymentBatchRowSerializer
+from .sharding import assign_ids, shard_for
+from .signals import payments_bulk_created
+
+# Поле строки -> модель, существование которой проверяем
+REFERENCES = {
+    'user': User,
+    'paid_course': Course,
+    'paid_lesson': Lesson,
+}
+
+
+def _existing_ids(model, ids):
+    if not ids:
+        return set()
+    return set(model.objects.filter(pk__in=ids).values_list('pk', flat=True))
+
+
+def validate_rows(rows):
+    """Возвращает (данные корректных строк, ошибки по строкам [{'row': i, 'errors': {...}}])"""
+    cleaned = []
+    errors = {}
+
+    for index, row in enumerate(rows):
+        serializer = PaymentBatchRowSerializer(data=row)
+        if serializer.is_valid():
+            cleaned.append((index, serializer.validated_data))
+        else:
+            errors[index] = dict(serializer.errors)
+
+    existing = {
+        field: _existing_ids(model, {data[field] for _, data in cleaned if data.get(field)})
+        for field, model in REFERENCES.items()
+    }
+
+    valid = []
+    for index, data in cleaned:
+        row_errors = {
+            field: [f'Объект с ID {data[field]} не найден']
+            for field in REFERENCES
+            if data.get(field) and data[field] not in existing[field]
+        }
+        if row_errors:
+            errors[index] = row_errors
+        else:
+            valid.append(data)
+
+    return valid, [{'row': index, 'errors': errors[index]} for index in sorted(errors)]
+
+
+def create_payments(rows):
+    """
+    Проверяет и сохраняет платежи. Возвращает (созданные платежи, ошибки);
+    при ошибках платежи не создаются.
+    """
+    valid, errors = validate_rows(rows)
+    if errors:
+        return [], errors
+
+    payments = [
+        Payment(
+            user_id=data['user'],
+            paid_course_id=data.get('paid_course'),
+            paid_lesson_id=data.get('paid_lesson'),
+            amount=data['amount'],
+            payment_method=data['payment_method'],
+            is_confirmed=data['is_confirmed'],
+        )
+        for data in valid
+    ]
+    insert_payments(payments)
+    return payments, []
+
+
+def insert_payments(payments):
+    """
+    Сохраняет новые платежи: bulk_create в шард каждого пользователя, транзакция в каждой
+    затронутой базе и один сигнал payments_bulk_created для итогов, сводок и доступов
+    """
+    # bulk_create не вызывает роутер для каждого объекта: раскладываем платежи по шардам сами
+    assign_ids(payments)
+    by_shard = defaultdict(list)
+    for payment in payments:
+        by_shard[shard_for(payment.user_id)].append(payment)
+
+    with ExitStack() as stack:
+        # Транзакция в каждой затронутой базе: исключение до фиксации откатывает вставки во всех
+        for alias in {DEFAULT_DB_ALIAS, *by_shard}:
+            stack.enter_context(transaction.atomic(using=alias))
+        for alias, shard_payments in by_shard.items():
+            Payment.objects.using(alias).bulk_create(shard_payments)
+        # bulk_create не отправляет post_save: итоги, сводки и доступы обновляем одним сигналом
+        payments_bulk_created.send(sender=Payment, payments=payments)
+    return payments
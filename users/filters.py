@@ -1,20 +1,29 @@
+import datetime
+
 import django_filters
-from .models import Payment
+from django.utils import timezone
+from rest_framework import filters
+
+from .models import Payment, PaymentDailyRollup
+from .search import normalize_term, payment_search_q
+
+
+def day_start(day):
+    """Начало дня в текущем часовом поясе"""
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
 
 
 class PaymentFilter(django_filters.FilterSet):
     """Кастомный фильтр для платежей"""
 
-    # Фильтр по дате (от и до)
+    # Фильтр по дате (от и до, оба дня включительно)
     payment_date_from = django_filters.DateFilter(
-        field_name='payment_date',
-        lookup_expr='gte',
+        method='filter_date_from',
         label='Дата оплаты с'
     )
 
     payment_date_to = django_filters.DateFilter(
-        field_name='payment_date',
-        lookup_expr='lte',
+        method='filter_date_to',
         label='Дата оплаты по'
     )
 
@@ -42,4 +51,43 @@ class PaymentFilter(django_filters.FilterSet):
             'payment_date_to',
             'amount_min',
             'amount_max',
-        ]
\ No newline at end of file
+        ]
+
+    # Сравниваем с границами дней, чтобы фильтр использовал индекс по payment_date
+    def filter_date_from(self, queryset, name, value):
+        return queryset.filter(payment_date__gte=day_start(value))
+
+    def filter_date_to(self, queryset, name, value):
+        return queryset.filter(payment_date__lt=day_start(value + datetime.timedelta(days=1)))
+
+
+class PaymentRollupFilter(django_filters.FilterSet):
+    """Те же параметры, что у PaymentFilter, но для дневных итогов"""
+
+    # Параметры запроса, которые можно посчитать по итогам без сырых платежей
+    SUPPORTED_PARAMS = {
+        'paid_course', 'paid_lesson', 'payment_method',
+        'payment_date_from', 'payment_date_to',
+    }
+
+    payment_date_from = django_filters.DateFilter(field_name='date', lookup_expr='gte')
+    payment_date_to = django_filters.DateFilter(field_name='date', lookup_expr='lte')
+
+    class Meta:
+        model = PaymentDailyRollup
+        fields = ['paid_course', 'paid_lesson', 'payment_method', 'payment_date_from', 'payment_date_to']
+
+
+class PaymentSearchFilter(filters.SearchFilter):
+    """
+    Параметр search для платежей через индекс слов (users.search) вместо icontains по JOIN.
+    Каждый термин ищется как префикс слова в email, названии курса или урока;
+    несколько терминов должны найтись все.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        for term in self.get_search_terms(request):
+            term = normalize_term(term)
+            if term:
+                queryset = queryset.filter(payment_search_q(term, using=queryset.db))
+        return queryset
@@ -0,0 +1,232 @@
+import csv
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+
+from . import search
+from .models import User
+
+# Поля, которые можно передать при импорте
+IMPORT_FIELDS = ('email', 'password', 'first_name', 'last_name', 'phone', 'city')
+
+# Форматы входных данных
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+FORMATS = (FORMAT_CSV, FORMAT_NDJSON)
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Меньше этого числа паролей пул процессов не запускаем — накладные расходы больше выигрыша
+POOL_THRESHOLD = 32
+
+
+class ImportReport:
+    """Итоги импорта: сколько создано, какие email уже заняты и какие строки с ошибками"""
+
+    def __init__(self):
+        self.created = 0
+        self.duplicates = []
+        self.errors = []
+
+    def add_duplicate(self, line, email):
+        self.duplicates.append({'line': line, 'email': email})
+
+    def add_error(self, line, error, email=None):
+        self.errors.append({'line': line, 'email': email, 'error': error})
+
+    def as_dict(self):
+        return {
+            'created': self.created,
+            'duplicates_count': len(self.duplicates),
+            'errors_count': len(self.errors),
+            'duplicates': self.duplicates,
+            'errors': self.errors,
+        }
+
+
+def detect_format(filename, default=FORMAT_CSV):
+    """Определяет формат по расширению файла"""
+    name = (filename or '').lower()
+    if name.endswith(('.ndjson', '.jsonl')):
+        return FORMAT_NDJSON
+    if name.endswith('.csv'):
+        return FORMAT_CSV
+    return default
+
+
+def read_rows(stream, file_format):
+    """
+    Читает строки из текстового потока.
+    Возвращает пары (номер строки, dict | None, ошибка | None).
+    """
+    if file_format == FORMAT_CSV:
+        reader = csv.DictReader(stream)
+        # Номер строки считаем с учетом заголовка
+        for line, row in enumerate(reader, start=2):
+            yield line, {key.strip(): (value or '').strip() for key, value in row.items() if key}, None
+    elif file_format == FORMAT_NDJSON:
+        for line, raw in enumerate(stream, start=1):
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                row = json.loads(raw)
+            except ValueError as e:
+                yield line, None, f'Некорректный JSON: {e}'
+                continue
+            if not isinstance(row, dict):
+                yield line, None, 'Ожидается JSON-объект'
+                continue
+            yield line, row, None
+    else:
+        raise ValueError(f'Неизвестный формат: {file_format}')
+
+
+def open_text(fileobj):
+    """Оборачивает бинарный файл (например, загруженный через API) в текстовый поток"""
+    if isinstance(fileobj, io.TextIOBase):
+        return fileobj
+    return io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+
+
+def _init_worker():
+    """Инициализация дочернего процесса: при spawn настройки Django нужно загрузить заново"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
+    if not settings.configured:
+        django.setup()
+
+
+def _hash_password(raw_password):
+    """Хеширование одного пароля (выполняется в дочернем процессе)"""
+    return make_password(raw_password or None)
+
+
+class PasswordHasherPool:
+    """
+    Хеширует пароли параллельно в пуле процессов.
+    Хеширование упирается в CPU, поэтому потоки здесь не помогают из-за GIL.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def hash_many(self, passwords):
+        if self.workers <= 1 or len(passwords) < POOL_THRESHOLD:
+            return [_hash_password(password) for password in passwords]
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+        chunksize = max(1, len(passwords) // (self.workers * 4))
+        return list(self._executor.map(_hash_password, passwords, chunksize=chunksize))
+
+
+def _clean_row(row):
+    """Проверяет строку и возвращает нормализованные поля пользователя"""
+    email, password = row.get('email'), row.get('password')
+    # В NDJSON значения могут быть любого типа JSON
+    if email is not None and not isinstance(email, str):
+        raise ValidationError('email должен быть строкой')
+    if password is not None and not isinstance(password, str):
+        raise ValidationError('password должен быть строкой')
+
+    email = User.objects.normalize_email((email or '').strip())
+    if not email:
+        raise ValidationError('Не указан email')
+    validate_email(email)
+
+    data = {'email': email}
+    for field in IMPORT_FIELDS[2:]:
+        value = row.get(field)
+        data[field] = str(value).strip() if value is not None else ''
+    return data, password or None
+
+
+def _insert_batch(batch, hasher, report):
+    """Сохраняет пачку строк: отсеивает занятые email, хеширует пароли и делает bulk_create"""
+    emails = [data['email'] for _, data, _ in batch]
+    existing = set(User.objects.filter(email__in=emails).values_list('email', flat=True))
+
+    pending = []
+    for line, data, password in batch:
+        if data['email'] in existing:
+            report.add_duplicate(line, data['email'])
+        else:
+            pending.append((line, data, password))
+
+    if not pending:
+        return
+
+    hashes = hasher.hash_many([password for _, _, password in pending])
+    users = [User(password=hashed, **data) for (_, data, _), hashed in zip(pending, hashes)]
+
+    try:
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+            # bulk_create не отправляет post_save, поэтому поисковый индекс обновляем сами
+            search.index_objects('user', User.objects.filter(email__in=[user.email for user in users]).only('email'))
+        report.created += len(users)
+    except IntegrityError:
+        # Кто-то успел создать пользователя с тем же email между проверкой и вставкой —
+        # сохраняем пачку построчно, чтобы не терять остальные строки
+        for (line, data, _), user in zip(pending, users):
+            try:
+                with transaction.atomic():
+                    user.save()
+                report.created += 1
+            except IntegrityError:
+                report.add_duplicate(line, data['email'])
+
+
+def import_users(rows, batch_size=DEFAULT_BATCH_SIZE, workers=None):
+    """
+    Импортирует пользователей из последовательности (номер строки, dict, ошибка).
+    Дубликаты email (в базе или внутри файла) не прерывают импорт, а попадают в отчет.
+    """
+    report = ImportReport()
+    seen = set()
+    batch = []
+
+    with PasswordHasherPool(workers) as hasher:
+        for line, row, error in rows:
+            if error:
+                report.add_error(line, error)
+                continue
+
+            try:
+                data, password = _clean_row(row)
+            except ValidationError as e:
+                report.add_error(line, ' '.join(e.messages), email=row.get('email'))
+                continue
+
+            if data['email'] in seen:
+                report.add_duplicate(line, data['email'])
+                continue
+            seen.add(data['email'])
+
+            batch.append((line, data, password))
+            if len(batch) >= batch_size:
+                _insert_batch(batch, hasher, report)
+                batch = []
+
+        if batch:
+            _insert_batch(batch, hasher, report)
+
+    return report
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users.archive import archive_cutoff, archive_payments
+from users.sharding import payment_querysets
+
+
+class Command(BaseCommand):
+    help = 'Перенос старых платежей в архивную таблицу пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days',
+            type=int,
+            default=None,
+            help='Переносить платежи старше N дней (по умолчанию PAYMENT_ARCHIVE_AFTER_DAYS)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Сколько платежей переносить в одной транзакции (по умолчанию 1000)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только посчитать, сколько платежей будет перенесено'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть положительным')
+        cutoff = archive_cutoff(options['older_than_days'])
+
+        if options['dry_run']:
+            count = sum(payments.filter(payment_date__lt=cutoff).count() for payments in payment_querysets())
+            self.stdout.write(f'Будет перенесено платежей старше {cutoff:%Y-%m-%d %H:%M}: {count}')
+            return
+
+        moved = archive_payments(
+            cutoff,
+            batch_size=options['batch_size'],
+            on_batch=lambda total: self.stdout.write(f'Перенесено: {total}')
+        )
+        self.stdout.write(self.style.SUCCESS(f'Перенесено в архив платежей: {moved}'))
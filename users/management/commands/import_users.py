@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users.importers import (
+    DEFAULT_BATCH_SIZE, FORMATS, detect_format, import_users, read_rows,
+)
+
+
+class Command(BaseCommand):
+    help = 'Массовый импорт пользователей из CSV или NDJSON файла'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к файлу с пользователями')
+        parser.add_argument(
+            '--format',
+            choices=FORMATS,
+            help='Формат файла (по умолчанию определяется по расширению)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help=f'Размер пачки для bulk_create (по умолчанию {DEFAULT_BATCH_SIZE})'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Количество процессов для хеширования паролей (по умолчанию число CPU)'
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or detect_format(path)
+
+        try:
+            with open(path, encoding='utf-8-sig', newline='') as stream:
+                report = import_users(
+                    read_rows(stream, file_format),
+                    batch_size=options['batch_size'],
+                    workers=options['workers'],
+                )
+        except OSError as e:
+            raise CommandError(f'Не удалось открыть файл {path}: {e}')
+
+        for duplicate in report.duplicates:
+            self.stdout.write(f'Строка {duplicate["line"]}: email {duplicate["email"]} уже существует')
+        for error in report.errors:
+            self.stdout.write(self.style.ERROR(f'Строка {error["line"]}: {error["error"]}'))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Создано пользователей: {report.created}, '
+            f'дубликатов: {len(report.duplicates)}, ошибок: {len(report.errors)}'
+        ))
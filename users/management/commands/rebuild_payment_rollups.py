@@ -0,0 +1,48 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.rollups import rebuild
+
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'Неверная дата {value}, ожидается формат YYYY-MM-DD')
+
+
+class Command(BaseCommand):
+    help = 'Пересчет дневных итогов по платежам (PaymentDailyRollup) по сырым платежам'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from',
+            dest='start',
+            help='Первый день периода, YYYY-MM-DD (по умолчанию дата первого платежа)'
+        )
+        parser.add_argument(
+            '--to',
+            dest='end',
+            help='Последний день периода, YYYY-MM-DD (по умолчанию дата последнего платежа)'
+        )
+        parser.add_argument(
+            '--chunk-days',
+            type=int,
+            default=31,
+            help='Сколько дней пересчитывать в одной транзакции (по умолчанию 31)'
+        )
+
+    def handle(self, *args, **options):
+        start = parse_date(options['start']) if options['start'] else None
+        end = parse_date(options['end']) if options['end'] else None
+        if start and end and start > end:
+            raise CommandError('Начало периода позже его конца')
+        if options['chunk_days'] < 1:
+            raise CommandError('--chunk-days должен быть положительным')
+
+        def report(chunk_start, chunk_end, count):
+            self.stdout.write(f'{chunk_start} — {chunk_end - datetime.timedelta(days=1)}: строк итогов {count}')
+
+        created = rebuild(start, end, chunk_days=options['chunk_days'], on_chunk=report)
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано строк итогов: {created}'))
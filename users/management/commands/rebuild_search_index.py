@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from users.search import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Пересчет поискового индекса платежей (email пользователей, названия курсов и уроков)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=2000,
+            help='Сколько объектов индексировать за одну транзакцию (по умолчанию 2000)'
+        )
+
+    def handle(self, *args, **options):
+        count = rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Слов в поисковом индексе: {count}'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from users.spending import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Пересчет сводок трат пользователей (UserSpendingSummary) по подтвержденным платежам'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            type=int,
+            action='append',
+            dest='user_ids',
+            help='ID пользователя (можно указать несколько раз, по умолчанию все пользователи)'
+        )
+
+    def handle(self, *args, **options):
+        count = rebuild(options['user_ids'])
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано сводок: {count}'))
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from users.sharding import reshard
+
+
+class Command(BaseCommand):
+    help = 'Перенос платежей в шарды их пользователей после изменения PAYMENT_SHARDS'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            action='append',
+            default=[],
+            help='Дополнительная база, из которой забрать платежи (например, убранный шард); '
+                 'default и текущие шарды просматриваются всегда'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Сколько платежей просматривать в одной транзакции (по умолчанию 1000)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только посчитать, сколько платежей будет перенесено'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть положительным')
+        unknown = [alias for alias in options['source'] if alias not in settings.DATABASES]
+        if unknown:
+            raise CommandError(f'Неизвестные базы: {", ".join(unknown)}')
+
+        moved = reshard(
+            options['source'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+            on_batch=None if options['dry_run'] else (
+                lambda source, count: self.stdout.write(f'{source}: перенесено {count}')
+            )
+        )
+        for (source, target), count in sorted(moved.items()):
+            self.stdout.write(f'{source} -> {target}: {count}')
+        verb = 'Будет перенесено' if options['dry_run'] else 'Перенесено'
+        self.stdout.write(self.style.SUCCESS(f'{verb} платежей: {sum(moved.values())}'))
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:41
+
+import django.db.models.deletion
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+def build_rollups(apps, schema_editor):
+    from users.rollups import rebuild
+
+    rebuild(get_model=apps.get_model)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0004_course_price_course_stripe_price_id_and_more'),
+        ('users', '0003_payment_is_confirmed_payment_stripe_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='дата')),
+                ('payment_method', models.CharField(choices=[('cash', 'Наличные'), ('transfer', 'Перевод на счет')], max_length=10, verbose_name='способ оплаты')),
+                ('is_confirmed', models.BooleanField(verbose_name='подтвержден')),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='сумма')),
+                ('count', models.IntegerField(default=0, verbose_name='число платежей')),
+                ('paid_course', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payment_rollups', to='materials.course', verbose_name='курс')),
+                ('paid_lesson', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payment_rollups', to='materials.lesson', verbose_name='урок')),
+            ],
+            options={
+                'verbose_name': 'дневной итог по платежам',
+                'verbose_name_plural': 'дневные итоги по платежам',
+                'ordering': ['date'],
+                'constraints': [models.UniqueConstraint(models.F('date'), django.db.models.functions.comparison.Coalesce('paid_course', 0), django.db.models.functions.comparison.Coalesce('paid_lesson', 0), models.F('payment_method'), models.F('is_confirmed'), name='unique_payment_daily_rollup')],
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
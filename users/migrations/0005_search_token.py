@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:45
+
+from django.db import migrations, models
+
+
+def build_search_index(apps, schema_editor):
+    from users.search import rebuild
+
+    rebuild(get_model=apps.get_model)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_payment_daily_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('user', 'email пользователя'), ('course', 'название курса'), ('lesson', 'название урока')], max_length=10, verbose_name='источник')),
+                ('object_id', models.BigIntegerField(verbose_name='ID объекта')),
+                ('token', models.CharField(max_length=100, verbose_name='слово')),
+            ],
+            options={
+                'verbose_name': 'поисковое слово',
+                'verbose_name_plural': 'поисковые слова',
+                'indexes': [models.Index(fields=['kind', 'token'], name='users_searc_kind_1ebaa4_idx'), models.Index(fields=['kind', 'object_id'], name='users_searc_kind_6c2abb_idx')],
+            },
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
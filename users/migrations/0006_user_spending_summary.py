@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:47
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_spending_summaries(apps, schema_editor):
+    from users.spending import rebuild
+
+    rebuild(get_model=apps.get_model)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_search_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSpendingSummary',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='spending_summary', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='пользователь')),
+                ('confirmed_total', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='сумма подтвержденных платежей')),
+                ('confirmed_count', models.IntegerField(default=0, verbose_name='число подтвержденных платежей')),
+                ('last_payment_date', models.DateTimeField(blank=True, null=True, verbose_name='дата последнего платежа')),
+                ('by_method', models.JSONField(blank=True, default=dict, help_text='Способ оплаты -> сумма строкой, например {"cash": "1500.00"}', verbose_name='сумма по способам оплаты')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='обновлено')),
+            ],
+            options={
+                'verbose_name': 'сводка трат пользователя',
+                'verbose_name_plural': 'сводки трат пользователей',
+            },
+        ),
+        migrations.RunPython(build_spending_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:53
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0004_course_price_course_stripe_price_id_and_more'),
+        ('users', '0006_user_spending_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPayment',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('payment_date', models.DateTimeField(verbose_name='дата оплаты')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='сумма оплаты')),
+                ('payment_method', models.CharField(choices=[('cash', 'Наличные'), ('transfer', 'Перевод на счет')], max_length=10, verbose_name='способ оплаты')),
+                ('stripe_id', models.CharField(blank=True, max_length=255, null=True, verbose_name='ID платежа в Stripe')),
+                ('is_confirmed', models.BooleanField(default=False, verbose_name='подтвержден')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, verbose_name='перенесен в архив')),
+                ('paid_course', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_payments', to='materials.course', verbose_name='оплаченный курс')),
+                ('paid_lesson', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_payments', to='materials.lesson', verbose_name='оплаченный урок')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_payments', to=settings.AUTH_USER_MODEL, verbose_name='пользователь')),
+            ],
+            options={
+                'verbose_name': 'архивный платеж',
+                'verbose_name_plural': 'архивные платежи',
+                'ordering': ['-payment_date'],
+                'indexes': [models.Index(fields=['payment_date'], name='users_archi_payment_594ac3_idx'), models.Index(fields=['user', 'payment_date'], name='users_archi_user_id_b3d134_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0004_course_price_course_stripe_price_id_and_more'),
+        ('users', '0007_archived_payment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentIdSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('next_id', models.BigIntegerField(verbose_name='следующий свободный ID')),
+            ],
+            options={
+                'verbose_name': 'счетчик ID платежей',
+                'verbose_name_plural': 'счетчики ID платежей',
+            },
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='paid_course',
+            field=models.ForeignKey(blank=True, db_constraint=False, help_text='Курс, за который произведена оплата', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payments', to='materials.course', verbose_name='оплаченный курс'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='paid_lesson',
+            field=models.ForeignKey(blank=True, db_constraint=False, help_text='Урок, за который произведена оплата', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payments', to='materials.lesson', verbose_name='оплаченный урок'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, help_text='Пользователь, совершивший платеж', on_delete=django.db.models.deletion.CASCADE, related_name='payments', to=settings.AUTH_USER_MODEL, verbose_name='пользователь'),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
 
@@ -88,6 +89,21 @@ class User(AbstractUser):
         return f"{self.first_name} {self.last_name}".strip()
 
 
+class PaymentQuerySet(models.QuerySet):
+    """Выборка платежей"""
+
+    def create(self, **kwargs):
+        """
+        Без явной базы (using) базу нового платежа выбирает роутер по самому объекту:
+        при шардировании это шард пользователя (users.routers), без него — default
+        """
+        if self._db is not None:
+            return super().create(**kwargs)
+        payment = self.model(**kwargs)
+        payment.save(force_insert=True)
+        return payment
+
+
 class Payment(models.Model):
     """Модель платежей"""
 
@@ -100,6 +116,8 @@ class Payment(models.Model):
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
         related_name='payments',
+        # Платеж может храниться в базе шарда, где нет таблицы пользователей (users.sharding)
+        db_constraint=False,
         verbose_name=_('пользователь'),
         help_text=_('Пользователь, совершивший платеж')
     )
@@ -117,6 +135,7 @@ class Payment(models.Model):
         null=True,
         blank=True,
         related_name='payments',
+        db_constraint=False,
         verbose_name=_('оплаченный курс'),
         help_text=_('Курс, за который произведена оплата')
     )
@@ -128,6 +147,7 @@ class Payment(models.Model):
         null=True,
         blank=True,
         related_name='payments',
+        db_constraint=False,
         verbose_name=_('оплаченный урок'),
         help_text=_('Урок, за который произведена оплата')
     )
@@ -162,6 +182,8 @@ class Payment(models.Model):
         help_text=_('Статус подтверждения платежа')
     )
 
+    objects = PaymentQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('платеж')
         verbose_name_plural = _('платежи')
@@ -187,3 +209,227 @@ class Payment(models.Model):
 
         if not self.paid_course and not self.paid_lesson:
             raise ValidationError(_('Укажите либо курс, либо урок за который произведена оплата.'))
+
+
+class PaymentDailyRollup(models.Model):
+    """
+    Дневные итоги по платежам: сумма и число платежей за день в разрезе
+    курса, урока, способа оплаты и статуса подтверждения.
+
+    Обновляется инкрементально сигналами при создании, изменении и удалении платежей
+    (users.signals), полностью пересчитывается командой rebuild_payment_rollups.
+    """
+
+    date = models.DateField(_('дата'))
+
+    paid_course = models.ForeignKey(
+        'materials.Course',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='payment_rollups',
+        verbose_name=_('курс')
+    )
+
+    paid_lesson = models.ForeignKey(
+        'materials.Lesson',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='payment_rollups',
+        verbose_name=_('урок')
+    )
+
+    payment_method = models.CharField(
+        _('способ оплаты'),
+        max_length=10,
+        choices=Payment.PaymentMethod.choices
+    )
+
+    is_confirmed = models.BooleanField(_('подтвержден'))
+
+    amount = models.DecimalField(
+        _('сумма'),
+        max_digits=14,
+        decimal_places=2,
+        default=0
+    )
+
+    count = models.IntegerField(_('число платежей'), default=0)
+
+    class Meta:
+        verbose_name = _('дневной итог по платежам')
+        verbose_name_plural = _('дневные итоги по платежам')
+        ordering = ['date']
+        constraints = [
+            # NULL в курсе/уроке не нарушает обычный UNIQUE, поэтому сравниваем через COALESCE
+            models.UniqueConstraint(
+                'date',
+                Coalesce('paid_course', 0),
+                Coalesce('paid_lesson', 0),
+                'payment_method',
+                'is_confirmed',
+                name='unique_payment_daily_rollup'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.date}: {self.count} платежей на {self.amount} руб."
+
+
+class SearchToken(models.Model):
+    """
+    Поисковый индекс для платежей: нормализованные слова из email пользователей
+    и названий курсов и уроков. Поиск по префиксу слова идет диапазонным запросом
+    по индексу (kind, token) вместо icontains по трем JOIN.
+
+    Обновляется сигналами при сохранении пользователей, курсов и уроков (users.signals),
+    полностью пересчитывается командой rebuild_search_index.
+    """
+
+    class Kind(models.TextChoices):
+        USER = 'user', _('email пользователя')
+        COURSE = 'course', _('название курса')
+        LESSON = 'lesson', _('название урока')
+
+    kind = models.CharField(_('источник'), max_length=10, choices=Kind.choices)
+    object_id = models.BigIntegerField(_('ID объекта'))
+    token = models.CharField(_('слово'), max_length=100)
+
+    class Meta:
+        verbose_name = _('поисковое слово')
+        verbose_name_plural = _('поисковые слова')
+        indexes = [
+            models.Index(fields=['kind', 'token']),
+            models.Index(fields=['kind', 'object_id']),
+        ]
+
+    def __str__(self):
+        return f"{self.kind}:{self.object_id} {self.token}"
+
+
+class UserSpendingSummary(models.Model):
+    """
+    Сводка трат пользователя по подтвержденным платежам: сумма, число платежей,
+    дата последнего платежа и разбивка суммы по способам оплаты.
+
+    Обновляется инкрементально сигналами платежей (users.signals), так что профиль
+    читает одну строку независимо от длины истории платежей.
+    """
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='spending_summary',
+        verbose_name=_('пользователь')
+    )
+
+    confirmed_total = models.DecimalField(
+        _('сумма подтвержденных платежей'),
+        max_digits=14,
+        decimal_places=2,
+        default=0
+    )
+
+    confirmed_count = models.IntegerField(_('число подтвержденных платежей'), default=0)
+
+    last_payment_date = models.DateTimeField(_('дата последнего платежа'), null=True, blank=True)
+
+    by_method = models.JSONField(
+        _('сумма по способам оплаты'),
+        default=dict,
+        blank=True,
+        help_text=_('Способ оплаты -> сумма строкой, например {"cash": "1500.00"}')
+    )
+
+    updated_at = models.DateTimeField(_('обновлено'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('сводка трат пользователя')
+        verbose_name_plural = _('сводки трат пользователей')
+
+    def __str__(self):
+        return f"{self.user_id}: {self.confirmed_count} платежей на {self.confirmed_total} руб."
+
+
+class ArchivedPayment(models.Model):
+    """
+    Архив старых платежей (холодные данные).
+
+    Платежи старше порога переносятся сюда командой archive_payments с сохранением ID,
+    чтобы основная таблица Payment и ее индексы оставались небольшими. Списки и выгрузки
+    платежей подмешивают архив, только если фильтр по дате уходит в архивный период
+    (users.archive).
+    """
+
+    id = models.BigIntegerField(primary_key=True, verbose_name='ID')
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='archived_payments',
+        verbose_name=_('пользователь')
+    )
+
+    payment_date = models.DateTimeField(_('дата оплаты'))
+
+    paid_course = models.ForeignKey(
+        'materials.Course',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='archived_payments',
+        verbose_name=_('оплаченный курс')
+    )
+
+    paid_lesson = models.ForeignKey(
+        'materials.Lesson',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='archived_payments',
+        verbose_name=_('оплаченный урок')
+    )
+
+    amount = models.DecimalField(_('сумма оплаты'), max_digits=10, decimal_places=2)
+
+    payment_method = models.CharField(
+        _('способ оплаты'),
+        max_length=10,
+        choices=Payment.PaymentMethod.choices
+    )
+
+    stripe_id = models.CharField(_('ID платежа в Stripe'), max_length=255, blank=True, null=True)
+
+    is_confirmed = models.BooleanField(_('подтвержден'), default=False)
+
+    archived_at = models.DateTimeField(_('перенесен в архив'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('архивный платеж')
+        verbose_name_plural = _('архивные платежи')
+        ordering = ['-payment_date']
+        indexes = [
+            models.Index(fields=['payment_date']),
+            models.Index(fields=['user', 'payment_date']),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.amount} руб. ({self.payment_date:%Y-%m-%d}, архив)"
+
+
+class PaymentIdSequence(models.Model):
+    """
+    Счетчик ID платежей при шардировании (users.sharding).
+    Процессы резервируют у него блоки ID, чтобы платежи в разных базах не получали одинаковые ID.
+    """
+
+    next_id = models.BigIntegerField(_('следующий свободный ID'))
+
+    class Meta:
+        verbose_name = _('счетчик ID платежей')
+        verbose_name_plural = _('счетчики ID платежей')
+
+    def __str__(self):
+        return f"next_id={self.next_id}"
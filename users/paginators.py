@@ -0,0 +1,20 @@
+from rest_framework.pagination import CursorPagination
+
+
+class PaymentCursorPagination(CursorPagination):
+    """
+    Курсорный пагинатор для истории платежей пользователя.
+    Страница выбирается условием по payment_date (индекс user, payment_date), а не OFFSET,
+    поэтому размер и время ответа не зависят от длины истории.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 50
+    ordering = ('-payment_date', '-id')
+    ordering_param = 'ordering'
+
+    def get_ordering(self, request, queryset, view):
+        """?ordering=payment_date — от старых платежей к новым; другие поля курсор не поддерживает"""
+        if request.query_params.get(self.ordering_param) == 'payment_date':
+            return ('payment_date', 'id')
+        return self.ordering
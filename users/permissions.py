@@ -50,3 +50,18 @@ class IsNotModerator(permissions.BasePermission):
 
         # Проверяем, что пользователь НЕ в группе модераторов
         return not request.user.groups.filter(name='moderators').exists()
+
+
+class HasCourseAccess(permissions.BasePermission):
+    """
+    Проверяет доступ к курсу или уроку: владелец, оплативший пользователь, модератор или администратор.
+    Проверка идет по индексу доступа (materials.entitlements) без запросов к базе.
+    """
+
+    def has_object_permission(self, request, view, obj):
+        from materials.entitlements import entitlements_for_request
+
+        entitlements = entitlements_for_request(request)
+        if hasattr(obj, 'course_id'):
+            return entitlements.has_lesson(obj.id, obj.course_id)
+        return entitlements.has_course(obj.id)
@@ -0,0 +1,159 @@
+"""
+Дневные итоги по платежам (PaymentDailyRollup).
+
+Итоги хранятся по ключу (дата, курс, урок, способ оплаты, подтвержден) и меняются
+дельтами: при создании платежа строка ключа увеличивается, при удалении — уменьшается,
+при изменении платежа старый ключ уменьшается, а новый увеличивается.
+Массовые операции, которые обходят сигналы модели, должны либо отправить сигнал
+payments_bulk_created (users.signals), либо пересчитать итоги функцией rebuild().
+"""
+import datetime
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import PaymentDailyRollup
+from .sharding import payment_sources
+
+# Поля платежа, от которых зависит его вклад в итоги
+SOURCE_FIELDS = ('payment_date', 'paid_course_id', 'paid_lesson_id', 'payment_method', 'is_confirmed', 'amount')
+
+KEY_FIELDS = ('date', 'paid_course_id', 'paid_lesson_id', 'payment_method', 'is_confirmed')
+
+
+def payment_key(values):
+    """Ключ итогов для платежа (объекта модели или словаря со значениями SOURCE_FIELDS)"""
+    get = values.get if isinstance(values, dict) else lambda name: getattr(values, name)
+    return (
+        timezone.localtime(get('payment_date')).date(),
+        get('paid_course_id'),
+        get('paid_lesson_id'),
+        get('payment_method'),
+        get('is_confirmed'),
+    )
+
+
+class Deltas:
+    """Накопитель изменений итогов: ключ -> [сумма, число платежей]"""
+
+    def __init__(self):
+        self.items = defaultdict(lambda: [Decimal(0), 0])
+
+    def add(self, key, amount, count=1):
+        item = self.items[key]
+        item[0] += Decimal(amount)
+        item[1] += count
+
+    def add_payment(self, payment, sign=1):
+        amount = payment['amount'] if isinstance(payment, dict) else payment.amount
+        self.add(payment_key(payment), sign * Decimal(amount), sign)
+
+    def __bool__(self):
+        return any(amount or count for amount, count in self.items.values())
+
+
+def apply_deltas(deltas):
+    """Применяет накопленные изменения к таблице итогов в одной транзакции"""
+    with transaction.atomic():
+        for key, (amount, count) in deltas.items.items():
+            if not amount and not count:
+                continue
+            lookup = dict(zip(KEY_FIELDS, key))
+            rows = PaymentDailyRollup.objects.filter(**lookup)
+            changes = {'amount': F('amount') + amount, 'count': F('count') + count}
+            if rows.update(**changes):
+                if count < 0:
+                    rows.filter(count__lte=0).delete()
+                continue
+            try:
+                with transaction.atomic():
+                    PaymentDailyRollup.objects.create(amount=amount, count=count, **lookup)
+            except IntegrityError:
+                # Строку успел создать параллельный запрос
+                rows.update(**changes)
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def rebuild(start=None, end=None, chunk_days=31, on_chunk=None, get_model=None):
+    """
+    Пересчитывает итоги по сырым платежам за период [start, end] кусками по chunk_days дней
+    (без границ — за все время).
+    Каждый кусок пересчитывается в своей транзакции: старые строки удаляются,
+    новые вставляются одним bulk_create. Возвращает число созданных строк итогов.
+    get_model передает миграция: итоги считаются по историческим моделям,
+    а шардов и архива на этом этапе еще нет.
+    """
+    if get_model is None:
+        Rollup = PaymentDailyRollup
+        # Итоги считаются по всем базам с платежами и по архиву
+        sources = payment_sources()
+    else:
+        Rollup = get_model('users', 'PaymentDailyRollup')
+        sources = [get_model('users', 'Payment').objects.all()]
+
+    full = start is None and end is None
+    if start is None or end is None:
+        dates = []
+        for source in sources:
+            bounds = source.order_by('payment_date').values_list('payment_date', flat=True)
+            dates.extend(date for date in (bounds.first(), bounds.last()) if date is not None)
+        if not dates:
+            # Платежей нет — итогов тоже быть не должно
+            Rollup.objects.all().delete()
+            return 0
+        start = start or timezone.localtime(min(dates)).date()
+        end = end or timezone.localtime(max(dates)).date()
+    if full:
+        # При полном пересчете убираем и итоги за дни, где платежей больше нет
+        Rollup.objects.exclude(date__gte=start, date__lte=end).delete()
+
+    created = 0
+    chunk_start = start
+    while chunk_start <= end:
+        chunk_end = min(chunk_start + datetime.timedelta(days=chunk_days), end + datetime.timedelta(days=1))
+        with transaction.atomic():
+            totals = Deltas()
+            for source in sources:
+                rows = (
+                    source
+                    .filter(payment_date__gte=_day_start(chunk_start), payment_date__lt=_day_start(chunk_end))
+                    .order_by()
+                    .annotate(date=TruncDate('payment_date'))
+                    .values(*KEY_FIELDS)
+                    .annotate(total=Sum('amount'), number=Count('id'))
+                )
+                for row in rows:
+                    totals.add(tuple(row[name] for name in KEY_FIELDS), row['total'], row['number'])
+            rollups = [
+                Rollup(amount=amount, count=count, **dict(zip(KEY_FIELDS, key)))
+                for key, (amount, count) in totals.items.items()
+            ]
+            Rollup.objects.filter(date__gte=chunk_start, date__lt=chunk_end).delete()
+            Rollup.objects.bulk_create(rollups)
+        created += len(rollups)
+        if on_chunk is not None:
+            on_chunk(chunk_start, chunk_end, len(rollups))
+        chunk_start = chunk_end
+    return created
+
+
+def move_to_unassigned(field, instance_id):
+    """
+    Перед удалением курса/урока переносит его итоги в строки без курса/урока,
+    как это делает SET_NULL с самими платежами.
+    """
+    deltas = Deltas()
+    for row in PaymentDailyRollup.objects.filter(**{field: instance_id}).values(*KEY_FIELDS, 'amount', 'count'):
+        key = tuple(row[name] for name in KEY_FIELDS)
+        deltas.add(key, -row['amount'], -row['count'])
+        moved = dict(row, **{field: None})
+        deltas.add(tuple(moved[name] for name in KEY_FIELDS), row['amount'], row['count'])
+    if deltas:
+        apply_deltas(deltas)
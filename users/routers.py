@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from .sharding import shard_for, sharding_enabled
+
+PAYMENT_LABEL = 'users.payment'
+
+
+class PaymentShardRouter:
+    """
+    Маршрутизация при шардировании платежей (users.sharding):
+    платеж читается и пишется в шард своего пользователя, остальные модели — в default.
+    Без шардирования роутер ничего не решает, и все запросы идут в default.
+    """
+
+    def _db_for(self, model, **hints):
+        if not sharding_enabled():
+            return None
+        if model._meta.label_lower != PAYMENT_LABEL:
+            return DEFAULT_DB_ALIAS
+
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        label = instance._meta.label_lower
+        if label == PAYMENT_LABEL:
+            # Сохраненный платеж остается в своей базе, новый идет в шард пользователя
+            if instance._state.db and not instance._state.adding:
+                return instance._state.db
+            return shard_for(instance.user_id)
+        if label == settings.AUTH_USER_MODEL.lower():
+            # user.payments
+            return shard_for(instance.pk)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._db_for(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Платеж в шарде ссылается на пользователя и курс из default
+        if PAYMENT_LABEL in (obj1._meta.label_lower, obj2._meta.label_lower):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # В базах шардов есть только таблица платежей
+        if db in settings.PAYMENT_SHARD_DATABASES:
+            return app_label == 'users' and model_name == 'payment'
+        return None
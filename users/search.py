@@ -0,0 +1,110 @@
+"""
+Поиск платежей по индексу слов (SearchToken).
+
+Из email пользователя и названий курсов и уроков выделяются слова в нижнем регистре
+(для email дополнительно целиком, локальная часть и домен). Термин поиска ищется как
+префикс слова: token >= term AND token < term + '\\uffff' — такой диапазон использует
+индекс (kind, token). Платежи отбираются через user_id/paid_course_id/paid_lesson_id IN (...),
+поэтому результат можно дальше фильтровать и сортировать как обычный queryset.
+"""
+import re
+import string
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Q
+
+MAX_TOKEN_LENGTH = 100
+WORD_RE = re.compile(r'\w+')
+
+# Источник слов: модель и поле
+SOURCES = {
+    'user': ('users', 'User', 'email'),
+    'course': ('materials', 'Course', 'title'),
+    'lesson': ('materials', 'Lesson', 'title'),
+}
+
+# Источник слов -> поле платежа
+PAYMENT_FIELDS = {
+    'user': 'user_id',
+    'course': 'paid_course_id',
+    'lesson': 'paid_lesson_id',
+}
+
+
+def tokenize(text):
+    """Множество слов для индекса"""
+    text = (text or '').lower().strip()
+    tokens = set(WORD_RE.findall(text))
+    if '@' in text:
+        local, _, domain = text.partition('@')
+        tokens.update((text, local, domain))
+    return {token[:MAX_TOKEN_LENGTH] for token in tokens if token}
+
+
+def normalize_term(term):
+    """Термин поиска в том же виде, что и слова индекса"""
+    return term.lower().strip(string.punctuation + string.whitespace)[:MAX_TOKEN_LENGTH]
+
+
+def index_objects(kind, objects, get_model=apps.get_model):
+    """Переиндексирует объекты одного источника: старые слова удаляются, новые вставляются пачкой"""
+    SearchToken = get_model('users', 'SearchToken')
+    field = SOURCES[kind][2]
+    tokens = []
+    ids = []
+    for obj in objects:
+        ids.append(obj.pk)
+        tokens.extend(
+            SearchToken(kind=kind, object_id=obj.pk, token=token)
+            for token in tokenize(getattr(obj, field))
+        )
+    with transaction.atomic():
+        SearchToken.objects.filter(kind=kind, object_id__in=ids).delete()
+        SearchToken.objects.bulk_create(tokens)
+
+
+def remove_object(kind, object_id):
+    apps.get_model('users', 'SearchToken').objects.filter(kind=kind, object_id=object_id).delete()
+
+
+def rebuild(batch_size=2000, get_model=apps.get_model):
+    """Пересчитывает весь индекс пачками по batch_size объектов. Возвращает число слов"""
+    SearchToken = get_model('users', 'SearchToken')
+    SearchToken.objects.all().delete()
+    for kind, (app_label, model_name, field) in SOURCES.items():
+        model = get_model(app_label, model_name)
+        batch = []
+        for obj in model.objects.only('pk', field).order_by('pk').iterator(chunk_size=batch_size):
+            batch.append(obj)
+            if len(batch) >= batch_size:
+                index_objects(kind, batch, get_model)
+                batch = []
+        if batch:
+            index_objects(kind, batch, get_model)
+    return SearchToken.objects.count()
+
+
+def matching_ids(kind, term):
+    """Подзапрос ID объектов источника, у которых есть слово с префиксом term"""
+    from .models import SearchToken
+
+    return SearchToken.objects.filter(
+        kind=kind,
+        token__gte=term,
+        token__lt=term + '\uffff',
+    ).values('object_id')
+
+
+def payment_search_q(term, using=None):
+    """
+    Условие для платежей: термин найден в email, названии курса или урока.
+    Для платежей из другой базы (шарда, using) ID вычисляются отдельными запросами.
+    """
+    condition = Q()
+    for kind, field in PAYMENT_FIELDS.items():
+        ids = matching_ids(kind, term)
+        if using is not None and using != ids.db:
+            ids = list(ids.values_list('object_id', flat=True))
+        condition |= Q(**{f'{field}__in': ids})
+    return condition
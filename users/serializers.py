@@ -1,17 +1,19 @@
+from decimal import Decimal
+
 from rest_framework import serializers
 from .models import Payment
-from materials.serializers import CourseSerializer, LessonSerializer
+from materials.serializers import CourseShortSerializer, LessonShortSerializer
 from django.contrib.auth.password_validation import validate_password
-from .models import User
+from .models import User, UserSpendingSummary
 
 
 class PaymentSerializer(serializers.ModelSerializer):
     """Сериализатор для платежей"""
 
-    # Вложенные сериализаторы для детальной информации
+    # Краткая информация о курсе и уроке: все данные приходят одним запросом через select_related
     user_email = serializers.EmailField(source='user.email', read_only=True)
-    course_detail = CourseSerializer(source='paid_course', read_only=True)
-    lesson_detail = LessonSerializer(source='paid_lesson', read_only=True)
+    course_detail = CourseShortSerializer(source='paid_course', read_only=True)
+    lesson_detail = LessonShortSerializer(source='paid_lesson', read_only=True)
 
     class Meta:
         model = Payment
@@ -23,14 +25,69 @@ class PaymentSerializer(serializers.ModelSerializer):
         read_only_fields = ('payment_date', 'user', 'stripe_id', 'is_confirmed')
 
 
+class PaymentBatchRowSerializer(serializers.Serializer):
+    """
+    Строка пакетного ввода платежей. Ссылки проверяются как числа без запросов к базе,
+    их существование проверяется сразу для всей пачки (users.batch).
+    """
+    user = serializers.IntegerField(min_value=1)
+    paid_course = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    paid_lesson = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'))
+    payment_method = serializers.ChoiceField(choices=Payment.PaymentMethod.choices, default=Payment.PaymentMethod.CASH)
+    is_confirmed = serializers.BooleanField(default=True)
+
+    def validate(self, attrs):
+        # То же правило, что в Payment.clean: либо курс, либо урок
+        has_course = bool(attrs.get('paid_course'))
+        has_lesson = bool(attrs.get('paid_lesson'))
+        if has_course and has_lesson:
+            raise serializers.ValidationError('Платеж может быть только за курс ИЛИ за урок, но не за оба одновременно.')
+        if not has_course and not has_lesson:
+            raise serializers.ValidationError('Укажите либо курс, либо урок за который произведена оплата.')
+        return attrs
+
+
+def requested_expansions(request):
+    """Дополнительные блоки, запрошенные параметром ?expand=spending,..."""
+    if request is None:
+        return set()
+    value = request.query_params.get('expand', '')
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+class UserSpendingSerializer(serializers.ModelSerializer):
+    """Сводка трат пользователя по подтвержденным платежам"""
+
+    class Meta:
+        model = UserSpendingSummary
+        fields = ['confirmed_total', 'confirmed_count', 'last_payment_date', 'by_method']
+
+
 class UserSerializer(serializers.ModelSerializer):
-    """Сериализатор для отображения и обновления пользователя"""
+    """
+    Сериализатор для отображения и обновления пользователя.
+    Сводка трат добавляется только по запросу: ?expand=spending.
+    """
 
     class Meta:
         model = User
         fields = ['id', 'email', 'first_name', 'last_name', 'phone', 'city', 'avatar', 'date_joined']
         read_only_fields = ['id', 'date_joined']
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if 'spending' in requested_expansions(self.context.get('request')):
+            self.fields['spending'] = serializers.SerializerMethodField()
+
+    def get_spending(self, user):
+        try:
+            summary = user.spending_summary
+        except UserSpendingSummary.DoesNotExist:
+            # Подтвержденных платежей еще не было
+            summary = UserSpendingSummary(user=user)
+        return UserSpendingSerializer(summary).data
+
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
     """Сериализатор для регистрации пользователя"""
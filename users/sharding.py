@@ -0,0 +1,192 @@
+"""
+Шардирование платежей по пользователю.
+
+Платежи (Payment) можно разнести по нескольким базам: шард выбирается по crc32(user_id),
+поэтому все платежи одного пользователя лежат в одной базе и запросы по пользователю
+идут ровно в один шард. Списки и выгрузки для администраторов читают все шарды
+и сливают отсортированные части (users.archive.MergedQuerySet).
+
+Включается настройкой PAYMENT_SHARD_COUNT (число шардов, переменная окружения): из нее
+строится список баз PAYMENT_SHARDS; при 0 платежи хранятся в default, как раньше. Остальные таблицы (пользователи, курсы, итоги,
+архив) всегда остаются в default, поэтому JOIN платежа с пользователем или курсом
+невозможен: вместо select_related используется prefetch_related.
+
+При шардировании ID платежей выдает не база, а счетчик PaymentIdSequence блоками:
+ID уникальны во всех шардах и не меняются при переносе командой reshard_payments.
+"""
+import threading
+import zlib
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import Max
+
+# Связанные объекты, которые выводятся вместе с платежом
+PAYMENT_RELATED = ('user', 'paid_course', 'paid_lesson')
+
+
+def sharding_enabled():
+    return bool(settings.PAYMENT_SHARDS)
+
+
+def shard_for(user_id):
+    """База, в которой хранятся платежи пользователя"""
+    shards = settings.PAYMENT_SHARDS
+    if not shards:
+        return DEFAULT_DB_ALIAS
+    return shards[zlib.crc32(str(user_id).encode()) % len(shards)]
+
+
+def payment_databases():
+    """Базы, в которых хранятся платежи"""
+    return list(settings.PAYMENT_SHARDS) or [DEFAULT_DB_ALIAS]
+
+
+def scatter(queryset, user_id=None):
+    """
+    Разбивает выборку платежей по базам: для одного пользователя — только его шард,
+    иначе все шарды. Без шардирования возвращает [queryset] как есть.
+    """
+    if not sharding_enabled():
+        return [queryset]
+    if user_id is not None:
+        return [queryset.using(shard_for(user_id))]
+    return [queryset.using(alias) for alias in settings.PAYMENT_SHARDS]
+
+
+def payment_querysets():
+    """Платежи во всех базах, по одной выборке на базу"""
+    from .models import Payment
+
+    return scatter(Payment.objects.all())
+
+
+def payment_sources(user_id=None):
+    """
+    Все выборки, которые учитываются в итогах и доступах: платежи в каждой базе
+    (или только в шарде пользователя user_id) и архив
+    """
+    from .models import ArchivedPayment, Payment
+
+    return [*scatter(Payment.objects.all(), user_id), ArchivedPayment.objects.all()]
+
+
+def with_related(queryset):
+    """Пользователь, курс и урок платежа: одним JOIN или, если платежи в шардах, отдельными запросами"""
+    if sharding_enabled():
+        return queryset.prefetch_related(*PAYMENT_RELATED)
+    return queryset.select_related(*PAYMENT_RELATED)
+
+
+def _max_payment_id():
+    from .models import ArchivedPayment, Payment
+
+    databases = {DEFAULT_DB_ALIAS, *settings.PAYMENT_SHARDS}
+    values = [Payment.objects.using(alias).aggregate(top=Max('id'))['top'] for alias in databases]
+    values.append(ArchivedPayment.objects.aggregate(top=Max('id'))['top'])
+    return max((value for value in values if value is not None), default=0)
+
+
+def _reserve_block(size):
+    """Резервирует в счетчике блок из size ID и возвращает его границы [start, stop)"""
+    from .models import PaymentIdSequence
+
+    sequences = PaymentIdSequence.objects.using(DEFAULT_DB_ALIAS)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        sequence = sequences.select_for_update().filter(pk=1).first()
+        if sequence is None:
+            try:
+                with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                    sequence = sequences.create(pk=1, next_id=1)
+            except IntegrityError:
+                # Счетчик успел создать другой процесс
+                sequence = sequences.select_for_update().get(pk=1)
+        # Платежи могли появиться и без счетчика (до включения шардирования)
+        start = max(sequence.next_id, _max_payment_id() + 1)
+        sequences.filter(pk=1).update(next_id=start + size)
+    return start, start + size
+
+
+class PaymentIdAllocator:
+    """Выдает ID платежей из блока, зарезервированного в PaymentIdSequence"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = self._stop = 0
+
+    def allocate(self, count=1):
+        with self._lock:
+            ids = []
+            while len(ids) < count:
+                if self._next >= self._stop:
+                    self._next, self._stop = _reserve_block(max(settings.PAYMENT_ID_BLOCK_SIZE, count - len(ids)))
+                taken = min(count - len(ids), self._stop - self._next)
+                ids.extend(range(self._next, self._next + taken))
+                self._next += taken
+            return ids
+
+
+allocator = PaymentIdAllocator()
+
+
+def assign_ids(payments):
+    """Выдает ID новым платежам; без шардирования ID по-прежнему выдает база"""
+    if not sharding_enabled():
+        return
+    new = [payment for payment in payments if payment.pk is None]
+    for payment, pk in zip(new, allocator.allocate(len(new))):
+        payment.pk = pk
+
+
+def reshard(sources=(), batch_size=1000, dry_run=False, on_batch=None):
+    """
+    Переносит платежи, лежащие не в своем шарде (после изменения PAYMENT_SHARDS), в нужную базу.
+    Просматриваются default, текущие шарды и базы sources (например, шарды, убранные из
+    PAYMENT_SHARDS). ID и даты платежей сохраняются, сигналы отключены: платеж переезжает,
+    не меняясь. Возвращает Counter {(откуда, куда): число платежей}.
+    """
+    from .models import Payment
+    from .signals import muted_payment_signals
+
+    fields = [field.attname for field in Payment._meta.concrete_fields]
+    moved = Counter()
+    for source in dict.fromkeys([DEFAULT_DB_ALIAS, *settings.PAYMENT_SHARDS, *sources]):
+        last_pk = 0
+        while True:
+            rows = list(
+                Payment.objects.using(source)
+                .filter(pk__gt=last_pk)
+                .order_by('pk')
+                .values(*fields)[:batch_size]
+            )
+            if not rows:
+                break
+            last_pk = rows[-1]['id']
+
+            misplaced = defaultdict(list)
+            for row in rows:
+                target = shard_for(row['user_id'])
+                if target != source:
+                    misplaced[target].append(row)
+            for target, target_rows in misplaced.items():
+                moved[source, target] += len(target_rows)
+            if dry_run or not misplaced:
+                continue
+
+            # Вставка с ignore_conflicts до удаления: повтор после сбоя ничего не задвоит
+            with transaction.atomic(using=source), muted_payment_signals():
+                for target, target_rows in misplaced.items():
+                    payments = [Payment(**row) for row in target_rows]
+                    with transaction.atomic(using=target):
+                        Payment.objects.using(target).bulk_create(payments, ignore_conflicts=True)
+                        # bulk_create заполняет payment_date (auto_now_add) текущим временем
+                        for payment, row in zip(payments, target_rows):
+                            payment.payment_date = row['payment_date']
+                        Payment.objects.using(target).bulk_update(payments, ['payment_date'])
+                Payment.objects.using(source).filter(
+                    pk__in=[row['id'] for target_rows in misplaced.values() for row in target_rows]
+                ).delete()
+            if on_batch is not None:
+                on_batch(source, sum(len(target_rows) for target_rows in misplaced.values()))
+    return moved
@@ -0,0 +1,162 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import Signal, receiver
+
+from . import rollups, search, sharding, spending
+from .models import Payment, User
+
+# Отправляется после Payment.objects.bulk_create(...), который не вызывает post_save:
+# payments_bulk_created.send(sender=Payment, payments=created_payments)
+payments_bulk_created = Signal()
+
+_muted = ContextVar('payment_signals_muted', default=False)
+
+
+@contextmanager
+def muted_payment_signals():
+    """
+    Отключает обработку изменений платежей: для операций, которые переносят платежи,
+    не меняя их смысла (архивирование), итоги и сводки пересчитывать не нужно.
+    """
+    token = _muted.set(True)
+    try:
+        yield
+    finally:
+        _muted.reset(token)
+
+
+def payment_signals_muted():
+    return _muted.get()
+
+
+# Поля платежа, от которых зависят дневные итоги и сводки трат пользователей
+PAYMENT_SNAPSHOT_FIELDS = rollups.SOURCE_FIELDS + ('user_id',)
+
+
+def _apply_payment_changes(removed=(), added=()):
+    """Переносит вклад платежей в дневные итоги и сводки трат"""
+    deltas = rollups.Deltas()
+    spending_deltas = spending.SpendingDeltas()
+    for payment in removed:
+        deltas.add_payment(payment, sign=-1)
+        spending_deltas.add(payment, sign=-1)
+    for payment in added:
+        deltas.add_payment(payment)
+        spending_deltas.add(payment)
+
+    # Изменение полей, не влияющих на итоги (например, stripe_id), дает нулевые дельты
+    if deltas:
+        rollups.apply_deltas(deltas)
+    if spending_deltas:
+        spending.apply_deltas(spending_deltas)
+
+
+@receiver(pre_save, sender=Payment)
+def assign_payment_id(sender, instance, **kwargs):
+    """При шардировании ID нового платежа выдает общий счетчик, а не база шарда"""
+    sharding.assign_ids([instance])
+
+
+@receiver(pre_save, sender=Payment)
+def remember_previous_payment(sender, instance, using, **kwargs):
+    """Запоминаем прежние значения платежа, чтобы перенести его вклад в итогах"""
+    if payment_signals_muted() or instance._state.adding:
+        instance._rollup_previous = None
+    else:
+        instance._rollup_previous = sender.objects.using(using).filter(pk=instance.pk).values(
+            *PAYMENT_SNAPSHOT_FIELDS
+        ).first()
+
+
+@receiver(post_save, sender=Payment)
+def payment_saved(sender, instance, created, **kwargs):
+    """Новый или измененный платеж меняет дневные итоги и сводку трат пользователя"""
+    if payment_signals_muted():
+        return
+    previous = getattr(instance, '_rollup_previous', None)
+    _apply_payment_changes(removed=[previous] if previous is not None else [], added=[instance])
+
+
+@receiver(post_delete, sender=Payment)
+def payment_deleted(sender, instance, **kwargs):
+    if payment_signals_muted():
+        return
+    _apply_payment_changes(removed=[instance])
+
+
+@receiver(payments_bulk_created, sender=Payment)
+def payments_created_in_bulk(sender, payments, **kwargs):
+    """Итоги для платежей, созданных через bulk_create, одним набором дельт"""
+    _apply_payment_changes(added=payments)
+
+
+@receiver(pre_delete, sender='materials.Course')
+def course_deleted(sender, instance, **kwargs):
+    rollups.move_to_unassigned('paid_course_id', instance.pk)
+    _unlink_sharded_payments('paid_course_id', instance.pk)
+
+
+@receiver(pre_delete, sender='materials.Lesson')
+def lesson_deleted(sender, instance, **kwargs):
+    rollups.move_to_unassigned('paid_lesson_id', instance.pk)
+    _unlink_sharded_payments('paid_lesson_id', instance.pk)
+
+
+# CASCADE и SET_NULL Django выполняет запросами к базе удаляемого объекта (default),
+# поэтому платежи в шардах обрабатываем сами
+
+def _unlink_sharded_payments(field, instance_id):
+    """SET_NULL для платежей в шардах (итоги уже перенесены move_to_unassigned)"""
+    if not sharding.sharding_enabled():
+        return
+    for payments in sharding.payment_querysets():
+        payments.filter(**{field: instance_id}).update(**{field: None})
+
+
+@receiver(pre_delete, sender=User)
+def user_payments_deleted(sender, instance, **kwargs):
+    """CASCADE для платежей пользователя в шардах: с сигналами, чтобы обновить итоги"""
+    if not sharding.sharding_enabled():
+        return
+    for payments in sharding.payment_querysets():
+        payments.filter(user_id=instance.pk).delete()
+
+
+def _changed(update_fields, field):
+    return update_fields is None or field in update_fields
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields, **kwargs):
+    """Email пользователя попадает в поисковый индекс платежей"""
+    if _changed(update_fields, 'email'):
+        search.index_objects('user', [instance])
+
+
+@receiver(post_save, sender='materials.Course')
+def course_saved(sender, instance, update_fields, **kwargs):
+    if _changed(update_fields, 'title'):
+        search.index_objects('course', [instance])
+
+
+@receiver(post_save, sender='materials.Lesson')
+def lesson_saved(sender, instance, update_fields, **kwargs):
+    if _changed(update_fields, 'title'):
+        search.index_objects('lesson', [instance])
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    search.remove_object('user', instance.pk)
+
+
+@receiver(post_delete, sender='materials.Course')
+def course_removed_from_search(sender, instance, **kwargs):
+    search.remove_object('course', instance.pk)
+
+
+@receiver(post_delete, sender='materials.Lesson')
+def lesson_removed_from_search(sender, instance, **kwargs):
+    search.remove_object('lesson', instance.pk)
@@ -0,0 +1,136 @@
+"""
+Сводка трат пользователей (UserSpendingSummary).
+
+Учитываются только подтвержденные платежи. Изменение платежа переводится в дельты
+по пользователям: вклад прежнего состояния вычитается, нового — прибавляется.
+Дату последнего платежа при уменьшении (удаление или отмена подтверждения самого
+свежего платежа) пересчитываем запросом по индексу (user, payment_date).
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+
+from .models import UserSpendingSummary
+from .sharding import payment_sources
+
+CENTS = Decimal('0.01')
+
+
+def contribution(payment):
+    """Вклад платежа (объекта или словаря значений) в сводку или None, если он не подтвержден"""
+    get = payment.get if isinstance(payment, dict) else lambda name: getattr(payment, name)
+    if not get('is_confirmed'):
+        return None
+    return get('user_id'), get('payment_method'), Decimal(get('amount')), get('payment_date')
+
+
+class SpendingDeltas:
+    """Накопитель изменений сводок: user_id -> изменения суммы, числа, способов и дат"""
+
+    def __init__(self):
+        self.items = defaultdict(lambda: {'total': Decimal(0), 'count': 0, 'methods': defaultdict(Decimal),
+                                          'latest': None, 'removed': False})
+
+    def add(self, payment, sign=1):
+        values = contribution(payment)
+        if values is None:
+            return
+        user_id, method, amount, payment_date = values
+        item = self.items[user_id]
+        item['total'] += sign * amount
+        item['count'] += sign
+        item['methods'][method] += sign * amount
+        if sign > 0:
+            if item['latest'] is None or payment_date > item['latest']:
+                item['latest'] = payment_date
+        else:
+            item['removed'] = True
+
+    def __bool__(self):
+        return any(
+            item['count'] or item['total'] or any(item['methods'].values())
+            for item in self.items.values()
+        )
+
+
+def _latest_confirmed(user_id):
+    dates = [
+        source.filter(user_id=user_id, is_confirmed=True).aggregate(latest=Max('payment_date'))['latest']
+        for source in payment_sources(user_id)
+    ]
+    return max((date for date in dates if date is not None), default=None)
+
+
+def apply_deltas(deltas):
+    """Применяет изменения к сводкам, блокируя строки на время обновления"""
+    with transaction.atomic():
+        for user_id, item in deltas.items.items():
+            summaries = UserSpendingSummary.objects.select_for_update()
+            if item['count'] > 0:
+                summary, _ = summaries.get_or_create(user_id=user_id)
+            else:
+                # Вычитать не из чего: сводки еще нет или пользователь удаляется вместе с платежами
+                summary = summaries.filter(user_id=user_id).first()
+                if summary is None:
+                    continue
+            summary.confirmed_total += item['total']
+            summary.confirmed_count += item['count']
+
+            by_method = dict(summary.by_method)
+            for method, amount in item['methods'].items():
+                value = Decimal(by_method.get(method, 0)) + amount
+                if value:
+                    by_method[method] = str(value.quantize(CENTS))
+                else:
+                    by_method.pop(method, None)
+            summary.by_method = by_method
+
+            if item['removed']:
+                summary.last_payment_date = _latest_confirmed(user_id)
+            elif item['latest'] is not None and (
+                summary.last_payment_date is None or item['latest'] > summary.last_payment_date
+            ):
+                summary.last_payment_date = item['latest']
+            summary.save()
+
+
+def rebuild(user_ids=None, get_model=None):
+    """
+    Пересчитывает сводки по платежам (всех пользователей или только user_ids).
+    get_model передает миграция: сводки строятся по историческим моделям, без шардов и архива.
+    """
+    if get_model is None:
+        Summary = UserSpendingSummary
+        # Сводки учитывают все базы с платежами и архив
+        sources = payment_sources()
+    else:
+        Summary = get_model('users', 'UserSpendingSummary')
+        sources = [get_model('users', 'Payment').objects.all()]
+
+    summaries = Summary.objects.all()
+    if user_ids is not None:
+        summaries = summaries.filter(user_id__in=user_ids)
+
+    rows = {}
+    for source in sources:
+        payments = source.filter(is_confirmed=True).order_by()
+        if user_ids is not None:
+            payments = payments.filter(user_id__in=user_ids)
+
+        for row in payments.values('user_id', 'payment_method').annotate(total=Sum('amount'), number=Count('id')):
+            summary = rows.setdefault(row['user_id'], Summary(user_id=row['user_id'], by_method={}))
+            summary.confirmed_total += row['total']
+            summary.confirmed_count += row['number']
+            method_total = Decimal(summary.by_method.get(row['payment_method'], 0)) + row['total']
+            summary.by_method[row['payment_method']] = str(method_total.quantize(CENTS))
+        for row in payments.values('user_id').annotate(latest=Max('payment_date')):
+            summary = rows[row['user_id']]
+            if summary.last_payment_date is None or row['latest'] > summary.last_payment_date:
+                summary.last_payment_date = row['latest']
+
+    with transaction.atomic():
+        summaries.delete()
+        Summary.objects.bulk_create(rows.values())
+    return len(rows)
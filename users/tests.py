@@ -1,3 +1,888 @@
-from django.test import TestCase
+import csv
+import io
+import json
+from importlib import import_module
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth.hashers import check_password, is_password_usable
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from materials.entitlements import build_entitlements
+from materials.models import Course, Lesson
+from users.importers import (
+    FORMAT_CSV, FORMAT_NDJSON, POOL_THRESHOLD, PasswordHasherPool, import_users, read_rows
+)
+from users.models import ArchivedPayment, Payment, PaymentDailyRollup, SearchToken, User, UserSpendingSummary
+from users.sharding import shard_for
+
+
+class UserImportTestCase(TestCase):
+    """
+    Тесты массового импорта пользователей.
+    """
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        self.admin = User.objects.create_user(
+            email='admin@test.com',
+            password='testpass123',
+            is_staff=True
+        )
+        self.regular_user = User.objects.create_user(
+            email='regular@test.com',
+            password='testpass123'
+        )
+        self.client = APIClient()
+
+    def test_import_csv_creates_users(self):
+        """Импорт CSV создает пользователей с рабочими паролями"""
+        stream = io.StringIO(
+            'email,password,first_name,city\n'
+            'student1@school.com,secret-1,Иван,Москва\n'
+            'student2@school.com,secret-2,Петр,Казань\n'
+        )
+
+        report = import_users(read_rows(stream, FORMAT_CSV), workers=1)
+
+        self.assertEqual(report.created, 2)
+        user = User.objects.get(email='student1@school.com')
+        self.assertEqual(user.city, 'Москва')
+        self.assertTrue(user.check_password('secret-1'))
+
+    def test_import_reports_duplicates_and_errors(self):
+        """Дубликаты и некорректные строки попадают в отчет и не прерывают импорт"""
+        stream = io.StringIO(
+            '{"email": "regular@test.com", "password": "x"}\n'
+            '{"email": "new@school.com", "password": "x"}\n'
+            '{"email": "new@school.com", "password": "y"}\n'
+            '{"email": "not-an-email"}\n'
+            'not json\n'
+        )
+
+        report = import_users(read_rows(stream, FORMAT_NDJSON), batch_size=2, workers=1)
+
+        self.assertEqual(report.created, 1)
+        self.assertEqual([d['line'] for d in report.duplicates], [1, 3])
+        self.assertEqual([e['line'] for e in report.errors], [4, 5])
+        self.assertTrue(User.objects.filter(email='new@school.com').exists())
+
+    def test_import_reports_non_string_email_and_password(self):
+        """Email и пароль не строкой — ошибка строки, а не всего импорта"""
+        stream = io.StringIO(
+            '{"email": 42, "password": "x"}\n'
+            '{"email": "typed@school.com", "password": 12345}\n'
+            '{"email": "ok@school.com", "password": "x"}\n'
+        )
+
+        report = import_users(read_rows(stream, FORMAT_NDJSON), workers=1)
+
+        self.assertEqual(report.created, 1)
+        self.assertEqual([e['line'] for e in report.errors], [1, 2])
+        self.assertFalse(User.objects.filter(email='typed@school.com').exists())
+
+    # Быстрый хешер для дочерних процессов; PBKDF2 — если они загрузили настройки заново (spawn)
+    @override_settings(PASSWORD_HASHERS=[
+        'django.contrib.auth.hashers.MD5PasswordHasher', 'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    ])
+    def test_password_pool_hashes_in_processes(self):
+        """Начиная с POOL_THRESHOLD паролей хеширование идет в пуле процессов"""
+        passwords = [f'secret-{index}' for index in range(POOL_THRESHOLD)] + [None]
+
+        with PasswordHasherPool(workers=2) as hasher:
+            hashes = hasher.hash_many(passwords)
+            self.assertIsNotNone(hasher._executor)
+
+        self.assertEqual(len(hashes), len(passwords))
+        self.assertTrue(check_password('secret-0', hashes[0]))
+        self.assertTrue(check_password(passwords[-2], hashes[-2]))
+        self.assertFalse(is_password_usable(hashes[-1]))
+
+    def test_admin_can_import_via_api(self):
+        """Администратор может загрузить файл через API"""
+        self.client.force_authenticate(user=self.admin)
+        upload = SimpleUploadedFile(
+            'users.csv',
+            b'email,password\napi1@school.com,pass\nregular@test.com,pass\n',
+            content_type='text/csv'
+        )
+
+        response = self.client.post('/api/users/users/import/', {'file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['duplicates_count'], 1)
+
+    @override_settings(REQUEST_DEADLINE={'DEFAULT': 0.001, 'SQLITE_PROGRESS_STEPS': 1})
+    def test_api_import_is_not_cut_by_default_deadline(self):
+        """Импорт через API не ограничен общим сроком запроса и не обрывается на середине"""
+        self.client.force_authenticate(user=self.admin)
+        lines = ''.join(f'deadline{index}@school.com,pass-{index}\n' for index in range(40))
+        upload = SimpleUploadedFile('users.csv', f'email,password\n{lines}'.encode(), content_type='text/csv')
+
+        response = self.client.post('/api/users/users/import/', {'file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 40)
+        self.assertEqual(User.objects.filter(email__startswith='deadline').count(), 40)
+
+    def test_regular_user_cannot_import(self):
+        """Обычный пользователь не может импортировать пользователей"""
+        self.client.force_authenticate(user=self.regular_user)
+        upload = SimpleUploadedFile('users.csv', b'email\nx@school.com\n', content_type='text/csv')
+
+        response = self.client.post('/api/users/users/import/', {'file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(User.objects.filter(email='x@school.com').exists())
+
+
+class PaymentListQueriesTestCase(TestCase):
+    """
+    Тесты количества запросов при выводе списка платежей.
+    """
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        self.admin = User.objects.create_user(email='admin@test.com', password='testpass123', is_staff=True)
+        self.course = Course.objects.create(title='Курс', price=1000, owner=self.admin)
+        self.lesson = Lesson.objects.create(title='Урок', course=self.course, owner=self.admin)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.admin)
+
+    def create_payments(self, count):
+        for i in range(count):
+            Payment.objects.create(
+                user=self.admin,
+                paid_course=self.course if i % 2 else None,
+                paid_lesson=None if i % 2 else self.lesson,
+                amount=100
+            )
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries), response
+
+    def test_payment_list_uses_fixed_number_of_queries(self):
+        """Число запросов на страницу платежей не зависит от количества платежей"""
+        self.create_payments(2)
+        few, _ = self.count_queries('/api/users/payments/')
+
+        self.create_payments(8)
+        many, response = self.count_queries('/api/users/payments/')
+
+        self.assertEqual(few, many)
+        for payment in response.data['results']:
+            if payment['paid_course']:
+                self.assertEqual(payment['course_detail'], {'id': self.course.id, 'title': 'Курс', 'price': '1000.00'})
+            else:
+                self.assertIsNone(payment['course_detail'])
+
+    def test_user_payments_action_uses_fixed_number_of_queries(self):
+        """Действие payments у пользователя тоже не делает запросов на каждый платеж"""
+        url = f'/api/users/users/{self.admin.id}/payments/'
+        self.create_payments(2)
+        few, _ = self.count_queries(url)
+
+        self.create_payments(8)
+        many, response = self.count_queries(url)
+
+        self.assertEqual(few, many)
+        self.assertEqual(len(response.data['results']), 10)
+        lessons = [payment['lesson_detail'] for payment in response.data['results'] if payment['paid_lesson']]
+        self.assertEqual(lessons[0], {'id': self.lesson.id, 'title': 'Урок', 'course': self.course.id})
+
+    def test_user_payments_action_pages_with_cursor(self):
+        """Платежи пользователя отдаются страницами по курсору с фильтрами и сортировкой по дате"""
+        self.create_payments(12)
+        for day, payment in enumerate(Payment.objects.order_by('id'), start=1):
+            Payment.objects.filter(pk=payment.pk).update(payment_date=f'2024-01-{day:02d}T10:00Z')
+        url = f'/api/users/users/{self.admin.id}/payments/'
+
+        seen = []
+        next_url = f'{url}?page_size=5'
+        while next_url:
+            response = self.client.get(next_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 5)
+            seen.extend(payment['id'] for payment in response.data['results'])
+            next_url = response.data['next']
+        self.assertEqual(seen, list(Payment.objects.order_by('-payment_date').values_list('id', flat=True)))
+
+        response = self.client.get(f'{url}?ordering=payment_date&paid_course={self.course.id}&payment_date_from=2024-01-05')
+        self.assertEqual(
+            [payment['payment_date'][:10] for payment in response.data['results']],
+            ['2024-01-06', '2024-01-08', '2024-01-10', '2024-01-12']
+        )
+
+        response = self.client.get(f'{url}?payment_date_from=not-a-date')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class PaymentExportTestCase(TestCase):
+    """
+    Тесты потоковой выгрузки платежей.
+    """
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        self.admin = User.objects.create_user(email='admin@test.com', password='testpass123', is_staff=True)
+        self.student = User.objects.create_user(email='student@test.com', password='testpass123')
+        self.course = Course.objects.create(title='Курс', price=1000, owner=self.admin)
+        Payment.objects.create(user=self.student, paid_course=self.course, amount=1000, payment_method='transfer')
+        Payment.objects.create(user=self.student, paid_course=self.course, amount=500, payment_method='cash')
+        Payment.objects.create(user=self.admin, paid_course=self.course, amount=700, payment_method='transfer')
+        self.client = APIClient()
+
+    def export(self, query=''):
+        response = self.client.get(f'/api/users/payments/export/{query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_export_applies_filters(self):
+        """CSV содержит заголовок и только платежи, подходящие под фильтр"""
+        self.client.force_authenticate(user=self.admin)
+
+        content = self.export('?payment_method=transfer&ordering=amount')
+
+        rows = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual([row['amount'] for row in rows], ['700.00', '1000.00'])
+        self.assertEqual(rows[1]['user_email'], 'student@test.com')
+        self.assertEqual(rows[1]['course_title'], 'Курс')
+
+    def test_ndjson_export_contains_only_own_payments(self):
+        """Обычный пользователь выгружает только свои платежи"""
+        self.client.force_authenticate(user=self.student)
+
+        content = self.export('?export_format=ndjson')
+
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(all(row['user'] == self.student.id for row in rows))
+
+    def test_unknown_format_is_rejected(self):
+        """Неизвестный формат выгрузки возвращает 400"""
+        self.client.force_authenticate(user=self.admin)
+
+        response = self.client.get('/api/users/payments/export/?export_format=xlsx')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class PaymentAnalyticsTestCase(TestCase):
+    """
+    Тесты аналитики выручки.
+    """
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        self.admin = User.objects.create_user(email='admin@test.com', password='testpass123', is_staff=True)
+        self.student = User.objects.create_user(email='student@test.com', password='testpass123')
+        self.course = Course.objects.create(title='Курс', price=1000, owner=self.admin)
+        self.lesson = Lesson.objects.create(title='Урок', course=self.course, owner=self.admin)
+        self.pay('2024-01-01T10:00Z', amount=1000, paid_course=self.course, is_confirmed=True)
+        self.pay('2024-01-01T12:00Z', amount=200, paid_lesson=self.lesson)
+        self.pay('2024-01-03T09:00Z', amount=500, paid_course=self.course, is_confirmed=True)
+        self.pay('2024-02-10T09:00Z', amount=300, paid_lesson=self.lesson, is_confirmed=True)
+        # update() обходит сигналы, поэтому дневные итоги пересчитываем целиком
+        call_command('rebuild_payment_rollups', stdout=io.StringIO())
+        self.client = APIClient()
+
+    def pay(self, date, **fields):
+        payment = Payment.objects.create(user=self.student, **fields)
+        # payment_date заполняется автоматически, поэтому дату выставляем отдельно
+        Payment.objects.filter(pk=payment.pk).update(payment_date=date)
+
+    def analytics(self, query=''):
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get(f'/api/users/payments/analytics/{query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_daily_revenue(self):
+        """Выручка по дням за выбранный период"""
+        data = self.analytics('?payment_date_from=2024-01-01&payment_date_to=2024-01-31')
+
+        self.assertEqual(data['source'], 'rollups')
+        self.assertEqual(data['buckets'], ['2024-01-01', '2024-01-03'])
+        self.assertEqual(data['series'], [{'group': {}, 'revenue': ['1200.00', '500.00'], 'count': [2, 1]}])
+        self.assertEqual(data['totals'], {'revenue': '1700.00', 'count': 3})
+
+    def test_rollups_match_raw_payments(self):
+        """Ответ по дневным итогам совпадает с агрегацией сырых платежей"""
+        query = '?period=week&group_by=course,lesson,payment_method,is_confirmed'
+        from_rollups = self.analytics(query)
+        # Поиск по итогам не посчитать, поэтому этот запрос идет по платежам
+        from_payments = self.analytics(query + '&search=student')
+
+        self.assertEqual(from_payments.pop('source'), 'payments')
+        self.assertEqual(from_rollups.pop('source'), 'rollups')
+        self.assertEqual(from_rollups, from_payments)
+
+    def test_monthly_revenue_grouped(self):
+        """Группировка по месяцам и статусу подтверждения с выравниванием по периодам"""
+        data = self.analytics('?period=month&group_by=is_confirmed')
+
+        self.assertEqual(data['buckets'], ['2024-01-01', '2024-02-01'])
+        series = {item['group']['is_confirmed']: item for item in data['series']}
+        self.assertEqual(series[True]['revenue'], ['1500.00', '300.00'])
+        self.assertEqual(series[False]['revenue'], ['200.00', None])
+        self.assertEqual(series[False]['count'], [1, 0])
+
+    def test_invalid_parameters(self):
+        """Неизвестный период или группировка возвращают 400"""
+        self.client.force_authenticate(user=self.admin)
+        for query in ('?period=year', '?group_by=user'):
+            response = self.client.get(f'/api/users/payments/analytics/{query}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_regular_user_forbidden(self):
+        """Аналитика доступна только администраторам"""
+        self.client.force_authenticate(user=self.student)
+
+        response = self.client.get('/api/users/payments/analytics/')
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class PaymentRollupTestCase(TestCase):
+    """
+    Тесты инкрементального обновления дневных итогов.
+    """
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        self.owner = User.objects.create_user(email='owner@test.com', password='testpass123')
+        self.student = User.objects.create_user(email='student@test.com', password='testpass123')
+        self.course = Course.objects.create(title='Курс', price=1000, owner=self.owner)
+        self.lesson = Lesson.objects.create(title='Урок', course=self.course, owner=self.owner)
+
+    def snapshot(self):
+        return sorted(
+            PaymentDailyRollup.objects.values_list(
+                'date', 'paid_course_id', 'paid_lesson_id', 'payment_method', 'is_confirmed', 'amount', 'count'
+            )
+        )
+
+    def assert_matches_rebuild(self):
+        incremental = self.snapshot()
+        call_command('rebuild_payment_rollups', '--chunk-days', '1', stdout=io.StringIO())
+        self.assertEqual(incremental, self.snapshot())
+
+    def test_create_confirm_and_delete(self):
+        """Создание, подтверждение и удаление платежей меняют итоги так же, как полный пересчет"""
+        first = Payment.objects.create(user=self.student, paid_course=self.course, amount=1000)
+        Payment.objects.create(user=self.student, paid_course=self.course, amount=500)
+        lesson_payment = Payment.objects.create(user=self.student, paid_lesson=self.lesson, amount=100)
+
+        rollup = PaymentDailyRollup.objects.get(paid_course=self.course, is_confirmed=False)
+        self.assertEqual((rollup.amount, rollup.count), (1500, 2))
+
+        first.is_confirmed = True
+        first.save()
+        lesson_payment.delete()
+
+        self.assertEqual(
+            [(row[2], row[4], row[5], row[6]) for row in self.snapshot()],
+            [(None, False, 500, 1), (None, True, 1000, 1)]
+        )
+        self.assert_matches_rebuild()
+
+    def test_unrelated_update_does_not_touch_rollups(self):
+        """Изменение полей, не входящих в итоги, не пишет в таблицу итогов"""
+        payment = Payment.objects.create(user=self.student, paid_course=self.course, amount=1000)
+        payment.stripe_id = 'cs_test_1'
+
+        with CaptureQueriesContext(connection) as context:
+            payment.save()
+
+        self.assertFalse(any('rollup' in query['sql'] for query in context.captured_queries))
+
+    def test_course_deletion_moves_rollups(self):
+        """После удаления курса его выручка остается в итогах без курса, как и сами платежи"""
+        Payment.objects.create(user=self.student, paid_course=self.course, amount=1000)
+        Payment.objects.create(user=self.student, paid_lesson=self.lesson, amount=100)
+
+        self.course.delete()
+
+        self.assertEqual([(row[1], row[2], row[6]) for row in self.snapshot()], [(None, None, 2)])
+        self.assert_matches_rebuild()
+
+    def test_migration_backfills_existing_payments(self):
+        """Миграция, создающая таблицу итогов, заполняет ее по уже существующим платежам"""
+        Payment.objects.create(user=self.student, paid_course=self.course, amount=1000, is_confirmed=True)
+        Payment.objects.create(user=self.student, paid_course=self.course, amount=100)
+        expected = self.snapshot()
+        PaymentDailyRollup.objects.all().delete()
+
+        import_module('users.migrations.0004_payment_daily_rollup').build_rollups(apps, None)
+
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_owner_sees_course_revenue(self):
+        """Владелец курса видит выручку курса вместе с его уроками"""
+        Payment.objects.create(user=self.student, paid_course=self.course, amount=1000, is_confirmed=True)
+        Payment.objects.create(user=self.student, paid_lesson=self.lesson, amount=100, is_confirmed=True)
+        client = APIClient()
+
+        client.force_authenticate(user=self.owner)
+        response = client.get(f'/api/materials/courses/{self.course.id}/revenue/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['totals'], {'revenue': '1100.00', 'count': 2})
+
+        client.force_authenticate(user=self.student)
+        response = client.get(f'/api/materials/courses/{self.course.id}/revenue/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class PaymentSearchTestCase(TestCase):
+    """
+    Тесты поиска платежей по индексу слов.
+    """
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        self.admin = User.objects.create_user(email='admin@test.com', password='testpass123', is_staff=True)
+        self.ivan = User.objects.create_user(email='ivan.petrov@mail.ru', password='testpass123')
+        self.anna = User.objects.create_user(email='anna@school.com', password='testpass123')
+        self.python = Course.objects.create(title='Основы Python', price=1000, owner=self.admin)
+        self.django = Course.objects.create(title='Django для профи', price=2000, owner=self.admin)
+        self.lesson = Lesson.objects.create(title='Модели и миграции', course=self.django, owner=self.admin)
+        self.ivan_python = Payment.objects.create(user=self.ivan, paid_course=self.python, amount=1000)
+        self.ivan_lesson = Payment.objects.create(user=self.ivan, paid_lesson=self.lesson, amount=100)
+        self.anna_django = Payment.objects.create(user=self.anna, paid_course=self.django, amount=2000)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.admin)
+
+    def search(self, query):
+        response = self.client.get(f'/api/users/payments/{query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [payment['id'] for payment in response.data['results']]
+
+    def test_search_by_email_and_titles(self):
+        """Поиск по префиксу слова в email, названии курса или урока без учета регистра"""
+        self.assertCountEqual(self.search('?search=petrov'), [self.ivan_python.id, self.ivan_lesson.id])
+        self.assertEqual(self.search('?search=ivan.petrov@mail.ru&paid_course=' + str(self.python.id)),
+                         [self.ivan_python.id])
+        self.assertEqual(self.search('?search=ПИТ'), [])
+        self.assertEqual(self.search('?search=pyth'), [self.ivan_python.id])
+        self.assertEqual(self.search('?search=миграц'), [self.ivan_lesson.id])
+
+    def test_search_terms_compose_with_filters_and_ordering(self):
+        """Все термины должны найтись, результат фильтруется и сортируется как обычно"""
+        self.assertEqual(self.search('?search=django anna'), [self.anna_django.id])
+        self.assertEqual(
+            self.search('?search=mail.ru&ordering=-amount'),
+            [self.ivan_python.id, self.ivan_lesson.id]
+        )
+        self.assertEqual(self.search('?search=petrov&amount_max=500'), [self.ivan_lesson.id])
+
+    def test_index_follows_renames(self):
+        """Переименование курса и смена email обновляют индекс"""
+        self.python.title = 'Продвинутый Python'
+        self.python.save()
+        self.ivan.email = 'ivan@new.org'
+        self.ivan.save()
+
+        self.assertEqual(self.search('?search=продвинут'), [self.ivan_python.id])
+        self.assertEqual(self.search('?search=основы'), [])
+        self.assertEqual(self.search('?search=petrov'), [])
+
+    def test_rebuild_command(self):
+        """Команда пересчета восстанавливает индекс с нуля"""
+        SearchToken.objects.all().delete()
+        self.assertEqual(self.search('?search=anna'), [])
+
+        call_command('rebuild_search_index', '--batch-size', '2', stdout=io.StringIO())
+
+        self.assertEqual(self.search('?search=anna'), [self.anna_django.id])
+
+
+class UserSpendingSummaryTestCase(TestCase):
+    """
+    Тесты сводки трат пользователя.
+    """
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        self.admin = User.objects.create_user(email='admin@test.com', password='testpass123', is_staff=True)
+        self.student = User.objects.create_user(email='student@test.com', password='testpass123')
+        self.course = Course.objects.create(title='Курс', price=1000, owner=self.admin)
+        self.client = APIClient()
+
+    def pay(self, amount, method='cash', confirmed=True):
+        return Payment.objects.create(
+            user=self.student, paid_course=self.course, amount=amount,
+            payment_method=method, is_confirmed=confirmed
+        )
+
+    def summary(self):
+        # Свежий объект пользователя, как при настоящем запросе
+        self.client.force_authenticate(user=User.objects.get(pk=self.student.pk))
+        response = self.client.get('/api/users/users/me/?expand=spending')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['spending']
+
+    def test_summary_follows_payment_changes(self):
+        """Сводка учитывает только подтвержденные платежи и меняется вместе с ними"""
+        self.pay(1000)
+        transfer = self.pay(300, method='transfer')
+        pending = self.pay(500, confirmed=False)
+
+        self.assertEqual(self.summary()['confirmed_total'], '1300.00')
+
+        pending.is_confirmed = True
+        pending.save()
+        transfer.delete()
+
+        spending = self.summary()
+        self.assertEqual(spending['confirmed_total'], '1500.00')
+        self.assertEqual(spending['confirmed_count'], 2)
+        self.assertEqual(spending['by_method'], {'cash': '1500.00'})
+        self.assertIsNotNone(spending['last_payment_date'])
+
+        incremental = UserSpendingSummary.objects.get(user=self.student)
+        UserSpendingSummary.objects.all().delete()
+        # Миграция, создающая таблицу сводок, заполняет ее по уже существующим платежам
+        import_module('users.migrations.0006_user_spending_summary').build_spending_summaries(apps, None)
+        self.assertEqual(UserSpendingSummary.objects.get(user=self.student).confirmed_total, 1500)
+        call_command('rebuild_spending_summaries', stdout=io.StringIO())
+        rebuilt = UserSpendingSummary.objects.get(user=self.student)
+        self.assertEqual(
+            (incremental.confirmed_total, incremental.confirmed_count, incremental.by_method,
+             incremental.last_payment_date),
+            (rebuilt.confirmed_total, rebuilt.confirmed_count, rebuilt.by_method, rebuilt.last_payment_date)
+        )
+
+    def test_spending_is_opt_in_and_defaults_to_zero(self):
+        """Без expand сводки нет, у пользователя без платежей она нулевая"""
+        self.client.force_authenticate(user=self.student)
+        response = self.client.get('/api/users/users/me/')
+        self.assertNotIn('spending', response.data)
+
+        self.assertEqual(self.summary(), {
+            'confirmed_total': '0.00', 'confirmed_count': 0, 'last_payment_date': None, 'by_method': {}
+        })
+
+    def test_user_list_reads_summaries_in_one_query(self):
+        """Список пользователей со сводками не делает запрос на каждого пользователя"""
+        self.pay(1000)
+        self.client.force_authenticate(user=self.admin)
+
+        with CaptureQueriesContext(connection) as few:
+            self.client.get('/api/users/users/?expand=spending')
+        User.objects.create_user(email='another@test.com', password='testpass123')
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get('/api/users/users/?expand=spending')
+
+        self.assertEqual(len(few.captured_queries), len(many.captured_queries))
+        spending = {user['email']: user['spending'] for user in response.data['results']}
+        self.assertEqual(spending['student@test.com']['confirmed_total'], '1000.00')
+
+    def test_deleting_user_with_payments(self):
+        """Удаление пользователя вместе с платежами не оставляет сводку"""
+        self.pay(1000)
+
+        self.student.delete()
+
+        self.assertFalse(UserSpendingSummary.objects.exists())
+
+
+class PaymentBatchTestCase(TestCase):
+    """
+    Тесты пакетного ввода платежей.
+    """
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        self.admin = User.objects.create_user(email='admin@test.com', password='testpass123', is_staff=True)
+        self.student = User.objects.create_user(email='student@test.com', password='testpass123')
+        self.course = Course.objects.create(title='Курс', price=1000, owner=self.admin)
+        self.lesson = Lesson.objects.create(title='Урок', course=self.course, owner=self.admin)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.admin)
+
+    def post(self, rows):
+        return self.client.post('/api/users/payments/batch/', {'payments': rows}, format='json')
+
+    def test_batch_creates_payments_with_fixed_queries(self):
+        """Пачка сохраняется фиксированным числом запросов и обновляет итоги"""
+        row = {'user': self.student.id, 'paid_course': self.course.id, 'amount': '1000.00'}
+        # Первая пачка создает строки итогов и сводки, дальше они только обновляются
+        self.post([row])
+
+        with CaptureQueriesContext(connection) as small:
+            self.post([row] * 2)
+        with CaptureQueriesContext(connection) as large:
+            response = self.post([row] * 50)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 50)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+        self.assertEqual(Payment.objects.filter(payment_method='cash', is_confirmed=True).count(), 53)
+        self.assertEqual(PaymentDailyRollup.objects.get().count, 53)
+        self.assertEqual(UserSpendingSummary.objects.get(user=self.student).confirmed_total, 53000)
+
+    def test_errors_are_reported_per_row(self):
+        """Ошибки возвращаются по номерам строк, и ничего не сохраняется"""
+        response = self.post([
+            {'user': self.student.id, 'paid_course': self.course.id, 'amount': '1000.00'},
+            {'user': self.student.id, 'paid_course': self.course.id, 'paid_lesson': self.lesson.id, 'amount': '1'},
+            {'user': self.student.id, 'paid_lesson': 999, 'amount': '1'},
+            {'user': 999, 'paid_course': self.course.id, 'amount': '-5'},
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = {error['row']: error['errors'] for error in response.data['errors']}
+        self.assertEqual(sorted(errors), [1, 2, 3])
+        self.assertIn('non_field_errors', errors[1])
+        self.assertIn('paid_lesson', errors[2])
+        self.assertIn('amount', errors[3])
+        self.assertFalse(Payment.objects.exists())
+
+    def test_regular_user_forbidden(self):
+        """Пакетный ввод доступен только администраторам"""
+        self.client.force_authenticate(user=self.student)
+
+        response = self.post([{'user': self.student.id, 'paid_course': self.course.id, 'amount': '1'}])
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class PaymentArchiveTestCase(TestCase):
+    """
+    Тесты архивирования платежей и прозрачного чтения архива.
+    """
+
+    def setUp(self):
+        """Создание тестовых данных"""
+        self.admin = User.objects.create_user(email='admin@test.com', password='testpass123', is_staff=True)
+        self.student = User.objects.create_user(email='student@test.com', password='testpass123')
+        self.course = Course.objects.create(title='Курс', price=1000, owner=self.admin)
+        self.old = [self.pay('2023-03-0%dT10:00Z' % day, 100 * day) for day in (1, 2, 3)]
+        self.recent = self.pay(None, 700)
+        call_command('rebuild_payment_rollups', stdout=io.StringIO())
+        call_command('rebuild_spending_summaries', stdout=io.StringIO())
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.admin)
+
+    def pay(self, date, amount):
+        payment = Payment.objects.create(
+            user=self.student, paid_course=self.course, amount=amount, is_confirmed=True
+        )
+        if date:
+            Payment.objects.filter(pk=payment.pk).update(payment_date=date)
+        return payment
+
+    def archive(self):
+        call_command('archive_payments', '--older-than-days', '30', '--batch-size', '2', stdout=io.StringIO())
+
+    def test_archiving_moves_rows_without_changing_aggregates(self):
+        """Перенос в архив не меняет итоги, сводки и доступ к оплаченному курсу"""
+        rollups_before = list(PaymentDailyRollup.objects.values_list('date', 'amount', 'count').order_by('date'))
+        summary_before = UserSpendingSummary.objects.get(user=self.student).confirmed_total
+
+        self.archive()
+
+        self.assertEqual(list(Payment.objects.values_list('id', flat=True)), [self.recent.id])
+        self.assertEqual(ArchivedPayment.objects.count(), 3)
+        self.assertEqual(
+            list(PaymentDailyRollup.objects.values_list('date', 'amount', 'count').order_by('date')),
+            rollups_before
+        )
+        self.assertEqual(UserSpendingSummary.objects.get(user=self.student).confirmed_total, summary_before)
+
+        # Пересчет по обеим таблицам дает тот же результат
+        call_command('rebuild_payment_rollups', stdout=io.StringIO())
+        call_command('rebuild_spending_summaries', stdout=io.StringIO())
+        self.assertEqual(
+            list(PaymentDailyRollup.objects.values_list('date', 'amount', 'count').order_by('date')),
+            rollups_before
+        )
+        self.assertEqual(UserSpendingSummary.objects.get(user=self.student).confirmed_total, summary_before)
+
+        Payment.objects.all().delete()
+        self.assertTrue(build_entitlements(self.student).has_course(self.course.id))
+
+    def test_list_reads_archive_only_for_archived_period(self):
+        """Без фильтра по дате — только горячая таблица, с ранней датой — обе, в общем порядке"""
+        self.archive()
+
+        response = self.client.get('/api/users/payments/')
+        self.assertEqual([payment['id'] for payment in response.data['results']], [self.recent.id])
+
+        response = self.client.get('/api/users/payments/?payment_date_from=2023-03-02&ordering=-amount')
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(
+            [payment['id'] for payment in response.data['results']],
+            [self.recent.id, self.old[2].id, self.old[1].id]
+        )
+        self.assertEqual(response.data['results'][1]['course_detail']['title'], 'Курс')
+
+    def test_export_and_retrieve_include_archive(self):
+        """Выгрузка за архивный период и просмотр архивного платежа по ID"""
+        self.archive()
+
+        response = self.client.get('/api/users/payments/export/?payment_date_from=2023-01-01&ordering=payment_date')
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([int(row['id']) for row in rows], [payment.id for payment in self.old] + [self.recent.id])
+
+        response = self.client.get(f'/api/users/payments/{self.old[0].id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['amount'], '100.00')
+
+    def test_raw_analytics_include_archive(self):
+        """Аналитика по сырым платежам за архивный период складывает обе таблицы"""
+        self.archive()
+
+        response = self.client.get('/api/users/payments/analytics/?period=month&payment_date_from=2023-01-01'
+                                   '&search=student')
+
+        self.assertEqual(response.data['source'], 'payments')
+        self.assertEqual(response.data['totals'], {'revenue': '1300.00', 'count': 4})
+
+
+PAYMENT_SHARDS = ['payments_0', 'payments_1']
+
+
+@override_settings(PAYMENT_SHARDS=PAYMENT_SHARDS)
+class PaymentShardingTestCase(TestCase):
+    """
+    Тесты шардирования платежей по пользователям.
+    """
+
+    databases = {'default', *PAYMENT_SHARDS}
+
+    def setUp(self):
+        """Создание тестовых данных: по студенту в каждом шарде"""
+        self.admin = User.objects.create_user(email='admin@test.com', password='testpass123', is_staff=True)
+        self.course = Course.objects.create(title='Python', price=1000, owner=self.admin)
+        self.students = {}
+        number = 0
+        while len(self.students) < len(PAYMENT_SHARDS):
+            number += 1
+            student = User.objects.create_user(email=f'student{number}@test.com', password='testpass123')
+            self.students.setdefault(shard_for(student.pk), student)
+        self.first, self.second = self.students[PAYMENT_SHARDS[0]], self.students[PAYMENT_SHARDS[1]]
+        self.client = APIClient()
+
+    def pay(self, user, amount, date=None):
+        payment = Payment.objects.create(user=user, paid_course=self.course, amount=amount, is_confirmed=True)
+        if date:
+            Payment.objects.using(payment._state.db).filter(pk=payment.pk).update(payment_date=date)
+        return payment
+
+    def shard_ids(self, alias):
+        return set(Payment.objects.using(alias).values_list('id', flat=True))
+
+    def test_payments_are_stored_in_user_shard(self):
+        """Платеж попадает в шард пользователя, ID уникальны во всех шардах, итоги обновляются"""
+        first = [self.pay(self.first, 100), self.pay(self.first, 200)]
+        second = self.pay(self.second, 300)
+
+        self.assertEqual(self.shard_ids(PAYMENT_SHARDS[0]), {payment.id for payment in first})
+        self.assertEqual(self.shard_ids(PAYMENT_SHARDS[1]), {second.id})
+        self.assertFalse(Payment.objects.using('default').exists())
+        self.assertEqual(len({payment.id for payment in [*first, second]}), 3)
+
+        self.assertEqual(list(self.first.payments.values_list('amount', flat=True).order_by('amount')), [100, 200])
+        self.assertEqual(PaymentDailyRollup.objects.get().count, 3)
+        self.assertEqual(UserSpendingSummary.objects.get(user=self.second).confirmed_total, 300)
+        self.assertTrue(build_entitlements(self.first).has_course(self.course.id))
+
+    def test_user_reads_only_own_shard(self):
+        """Запросы пользователя идут в один шард, администратор видит все шарды в общем порядке"""
+        payments = [self.pay(self.first, 100), self.pay(self.second, 300), self.pay(self.first, 200)]
+
+        self.client.force_authenticate(user=self.first)
+        with CaptureQueriesContext(connections[PAYMENT_SHARDS[1]]) as other_shard:
+            response = self.client.get('/api/users/payments/')
+            self.client.get(f'/api/users/users/{self.first.id}/payments/')
+        self.assertEqual(len(other_shard), 0)
+        self.assertEqual({payment['id'] for payment in response.data['results']}, {payments[0].id, payments[2].id})
+        self.assertEqual(response.data['results'][0]['course_detail']['title'], 'Python')
+
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get('/api/users/payments/?ordering=-amount')
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(
+            [payment['id'] for payment in response.data['results']],
+            [payments[1].id, payments[2].id, payments[0].id]
+        )
+        response = self.client.get(f'/api/users/payments/{payments[1].id}/')
+        self.assertEqual(response.data['amount'], '300.00')
+
+    def test_export_search_and_analytics_across_shards(self):
+        """Выгрузка, поиск и аналитика по сырым платежам собирают данные всех шардов"""
+        self.pay(self.first, 100, '2024-01-01T10:00Z')
+        self.pay(self.second, 300, '2024-01-02T10:00Z')
+        self.client.force_authenticate(user=self.admin)
+
+        response = self.client.get('/api/users/payments/export/?ordering=payment_date')
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([row['user_email'] for row in rows], [self.first.email, self.second.email])
+        self.assertEqual({row['course_title'] for row in rows}, {'Python'})
+
+        response = self.client.get(f'/api/users/payments/?search={self.second.email}')
+        self.assertEqual([payment['amount'] for payment in response.data['results']], ['300.00'])
+
+        response = self.client.get('/api/users/payments/analytics/?period=month&amount_min=1')
+        self.assertEqual(response.data['source'], 'payments')
+        self.assertEqual(response.data['totals'], {'revenue': '400.00', 'count': 2})
+
+    def test_batch_splits_payments_by_shard(self):
+        """Пакетный ввод раскладывает платежи по шардам пользователей"""
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.post('/api/users/payments/batch/', {'payments': [
+            {'user': self.first.id, 'paid_course': self.course.id, 'amount': '100.00'},
+            {'user': self.second.id, 'paid_course': self.course.id, 'amount': '300.00'},
+        ]}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        first_id, second_id = response.data['ids']
+        self.assertEqual(self.shard_ids(PAYMENT_SHARDS[0]), {first_id})
+        self.assertEqual(self.shard_ids(PAYMENT_SHARDS[1]), {second_id})
+        self.assertEqual(PaymentDailyRollup.objects.get().amount, 400)
+
+    def test_reshard_moves_payments_to_user_shards(self):
+        """Платежи, созданные без шардирования, переносятся в шарды с теми же ID и датами"""
+        with self.settings(PAYMENT_SHARDS=[]):
+            payments = [self.pay(self.first, 100, '2024-01-01T10:00Z'), self.pay(self.second, 300)]
+            call_command('rebuild_payment_rollups', stdout=io.StringIO())
+        rollups_before = list(PaymentDailyRollup.objects.values_list('date', 'amount', 'count').order_by('date'))
+        self.assertEqual(self.shard_ids('default'), {payment.id for payment in payments})
+
+        out = io.StringIO()
+        call_command('reshard_payments', '--batch-size', '1', stdout=out)
+        self.assertIn('Перенесено платежей: 2', out.getvalue())
+
+        self.assertFalse(Payment.objects.using('default').exists())
+        moved = Payment.objects.using(PAYMENT_SHARDS[0]).get()
+        self.assertEqual((moved.id, moved.payment_date.isoformat()), (payments[0].id, '2024-01-01T10:00:00+00:00'))
+        self.assertEqual(self.shard_ids(PAYMENT_SHARDS[1]), {payments[1].id})
+        self.assertEqual(
+            list(PaymentDailyRollup.objects.values_list('date', 'amount', 'count').order_by('date')),
+            rollups_before
+        )
+
+        # Новый платеж получает ID больше перенесенных
+        self.assertGreater(self.pay(self.first, 50).id, max(payment.id for payment in payments))
+
+    def test_deleting_user_and_course_reaches_shards(self):
+        """Удаление пользователя удаляет его платежи в шарде, удаление курса обнуляет ссылку"""
+        self.pay(self.first, 100)
+        kept = self.pay(self.second, 300)
+
+        self.first.delete()
+        self.assertFalse(Payment.objects.using(PAYMENT_SHARDS[0]).exists())
+        self.assertEqual(PaymentDailyRollup.objects.get().amount, 300)
+
+        self.course.delete()
+        self.assertIsNone(Payment.objects.using(PAYMENT_SHARDS[1]).get(pk=kept.pk).paid_course_id)
@@ -2,6 +2,7 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import UserViewSet, PaymentViewSet, UserRegistrationView
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from api.throttling import TokenRateThrottle
 
 router = DefaultRouter()
 router.register(r'users', UserViewSet, basename='user')
@@ -9,7 +10,7 @@ router.register(r'payments', PaymentViewSet, basename='payment')
 
 urlpatterns = [
     path('', include(router.urls)),
-    path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('token/', TokenObtainPairView.as_view(throttle_classes=[TokenRateThrottle]), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('register/', UserRegistrationView.as_view(), name='user-register'),
 ]
@@ -6,12 +6,27 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.views import APIView
-from rest_framework.permissions import AllowAny, IsAuthenticated
-
-from .models import Payment, User
-from .filters import PaymentFilter
-from .serializers import UserSerializer, UserRegistrationSerializer, PaymentSerializer
+from django import forms
+from django.conf import settings
+from django.http import Http404
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import get_object_or_404
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
+from rest_framework.parsers import MultiPartParser
+
+from .models import ArchivedPayment, Payment, PaymentDailyRollup, User
+from .filters import PaymentFilter, PaymentRollupFilter, PaymentSearchFilter
+from .analytics import PERIODS, ROLLUPS, parse_group_by, revenue_series
+from .archive import MergedQuerySet, reaches_archive
+from .batch import create_payments
+from .exports import EXPORT_FORMATS, FORMAT_CSV, export_response, iter_rows
+from .importers import DEFAULT_BATCH_SIZE, FORMATS, detect_format, import_users, open_text, read_rows
+from .paginators import PaymentCursorPagination
+from .sharding import scatter, sharding_enabled, with_related
+from .serializers import UserSerializer, UserRegistrationSerializer, PaymentSerializer, requested_expansions
 from users.permissions import IsOwnerOrModerator, IsOwner, IsNotModerator
+from api.deadlines import NO_DEADLINE, deadline_budget
+from api.throttling import RegisterRateThrottle
 
 
 
@@ -19,6 +34,7 @@ class UserRegistrationView(APIView):
     """Отдельный View для регистрации, полностью публичный"""
     permission_classes = [AllowAny]
     authentication_classes = []
+    throttle_classes = [RegisterRateThrottle]
 
     @swagger_auto_schema(
         operation_summary="Регистрация нового пользователя",
@@ -109,7 +125,7 @@ class PaymentViewSet(viewsets.ModelViewSet):
     filter_backends = [
         django_filters.DjangoFilterBackend,
         filters. OrderingFilter,
-        filters.SearchFilter,
+        PaymentSearchFilter,
     ]
 
     filterset_class = PaymentFilter
@@ -241,6 +257,210 @@ class PaymentViewSet(viewsets.ModelViewSet):
     def retrieve(self, request, *args, **kwargs):
         return super().retrieve(request, *args, **kwargs)
 
+    @swagger_auto_schema(
+        operation_summary="Выгрузить платежи в CSV или NDJSON",
+        operation_description="""
+        Потоковая выгрузка всех платежей, подходящих под фильтры, без пагинации.
+
+        ### Особенности:
+        - Применяются те же фильтры, сортировка и поиск, что и у списка платежей
+        - Права доступа те же: пользователь выгружает только свои платежи
+        - Данные отдаются по мере чтения из базы, память не зависит от объема выгрузки
+
+        ### Формат:
+        - export_format=csv (по умолчанию) — CSV с заголовком
+        - export_format=ndjson — по одному JSON-объекту на строку
+        """,
+        manual_parameters=[
+            openapi.Parameter(
+                'export_format',
+                openapi.IN_QUERY,
+                description="Формат выгрузки",
+                type=openapi.TYPE_STRING,
+                enum=['csv', 'ndjson']
+            ),
+        ],
+        responses={
+            200: "Файл выгрузки",
+            400: "Неизвестный формат выгрузки",
+            401: "Пользователь не аутентифицирован"
+        }
+    )
+    @action(detail=False, methods=['get'], url_path='export')
+    @deadline_budget(60.0)
+    def export(self, request):
+        """Потоковая выгрузка платежей с учетом фильтров"""
+        export_format = request.query_params.get('export_format', FORMAT_CSV)
+        if export_format not in EXPORT_FORMATS:
+            return Response(
+                {'error': f'Неизвестный формат выгрузки: {export_format}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        queryset = self.filter_queryset(self.get_queryset())
+        # Платежи в шардах не соединить JOIN с пользователями и курсами из default
+        rows = iter_rows(queryset, settings.PAYMENT_EXPORT_CHUNK_SIZE, joins=not sharding_enabled())
+        return export_response(rows, export_format)
+
+    @swagger_auto_schema(
+        operation_summary="Пакетный ввод платежей",
+        operation_description="""
+        Создает до PAYMENT_BATCH_MAX_ROWS платежей одним запросом (например, наличные,
+        принятые сотрудниками).
+
+        ### Права доступа:
+        - Только администраторы
+
+        ### Правила:
+        - Каждая строка: user, paid_course или paid_lesson (ровно одно из них), amount,
+          payment_method (по умолчанию cash), is_confirmed (по умолчанию true)
+        - Существование пользователей, курсов и уроков проверяется одним запросом на модель
+        - Все платежи сохраняются в одной транзакции: если есть ошибки, не сохраняется ничего
+
+        ### Пример запроса:
+               {
+            "payments": [
+                {"user": 5, "paid_course": 1, "amount": 1000.00},
+                {"user": 6, "paid_lesson": 3, "amount": 300.00, "payment_method": "transfer"}
+            ]
+        }
+                """,
+        request_body=openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            required=['payments'],
+            properties={
+                'payments': openapi.Schema(
+                    type=openapi.TYPE_ARRAY,
+                    items=openapi.Schema(type=openapi.TYPE_OBJECT)
+                ),
+            }
+        ),
+        responses={
+            201: "Платежи созданы: created и ids",
+            400: "Ошибки по строкам: errors = [{row, errors}]",
+            403: "Только для администраторов"
+        }
+    )
+    @action(detail=False, methods=['post'], permission_classes=[IsAuthenticated, IsAdminUser])
+    @deadline_budget(60.0)
+    def batch(self, request):
+        """Пакетное создание платежей"""
+        rows = request.data.get('payments') if isinstance(request.data, dict) else None
+        if not isinstance(rows, list) or not rows:
+            return Response(
+                {'error': 'Передайте непустой список платежей в поле payments'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(rows) > settings.PAYMENT_BATCH_MAX_ROWS:
+            return Response(
+                {'error': f'Не больше {settings.PAYMENT_BATCH_MAX_ROWS} платежей за один запрос'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        payments, errors = create_payments(rows)
+        if errors:
+            return Response({'errors': errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(
+            {'created': len(payments), 'ids': [payment.pk for payment in payments]},
+            status=status.HTTP_201_CREATED
+        )
+
+    @swagger_auto_schema(
+        operation_summary="Аналитика выручки",
+        operation_description="""
+        Выручка и число платежей по дням, неделям или месяцам.
+        Агрегаты считаются в базе данных, ответ готов для построения графиков.
+
+        ### Права доступа:
+        - Только администраторы
+
+        ### Параметры:
+        - period: day (по умолчанию), week или month
+        - group_by: через запятую course, lesson, payment_method, is_confirmed
+        - payment_date_from / payment_date_to: период (формат: YYYY-MM-DD)
+        - доступны и остальные фильтры списка платежей
+
+        ### Формат ответа:
+        Значения revenue и count каждой серии выровнены по списку buckets.
+        Поле source показывает, посчитан ли ответ по дневным итогам (rollups)
+        или по сырым платежам (payments — при поиске или фильтрах по пользователю/сумме).
+        """,
+        manual_parameters=[
+            openapi.Parameter(
+                'period',
+                openapi.IN_QUERY,
+                description="Период агрегации",
+                type=openapi.TYPE_STRING,
+                enum=['day', 'week', 'month']
+            ),
+            openapi.Parameter(
+                'group_by',
+                openapi.IN_QUERY,
+                description="Группировка через запятую: course, lesson, payment_method, is_confirmed",
+                type=openapi.TYPE_STRING
+            ),
+            openapi.Parameter(
+                'payment_date_from',
+                openapi.IN_QUERY,
+                description="Дата оплаты с (формат: YYYY-MM-DD)",
+                type=openapi.TYPE_STRING,
+                format='date'
+            ),
+            openapi.Parameter(
+                'payment_date_to',
+                openapi.IN_QUERY,
+                description="Дата оплаты по (формат: YYYY-MM-DD)",
+                type=openapi.TYPE_STRING,
+                format='date'
+            ),
+        ],
+        responses={
+            200: "Серии выручки по периодам",
+            400: "Неверные параметры",
+            401: "Пользователь не аутентифицирован",
+            403: "Только для администраторов"
+        }
+    )
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated, IsAdminUser])
+    @deadline_budget(30.0)
+    def analytics(self, request):
+        """Выручка по периодам с группировкой"""
+        period = request.query_params.get('period', 'day')
+        if period not in PERIODS:
+            return Response(
+                {'error': f'Неизвестный период: {period}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            group_by = parse_group_by(request.query_params.get('group_by'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        rollups = self.get_rollup_queryset(request)
+        if rollups is not None:
+            data = revenue_series(rollups, period, group_by, source=ROLLUPS)
+            data['source'] = 'rollups'
+        else:
+            queryset = self.filter_queryset(self.get_queryset())
+            # Шарды и архив агрегируются по отдельности, revenue_series складывает части
+            parts = queryset.parts if isinstance(queryset, MergedQuerySet) else queryset
+            data = revenue_series(parts, period, group_by)
+            data['source'] = 'payments'
+        return Response(data)
+
+    def get_rollup_queryset(self, request):
+        """
+        Дневные итоги с фильтрами запроса или None, если по итогам запрос не посчитать
+        (поиск, фильтр по пользователю или сумме) — тогда агрегируем сырые платежи.
+        """
+        params = set(request.query_params) - {'period', 'group_by', 'ordering', 'format'}
+        if not params <= PaymentRollupFilter.SUPPORTED_PARAMS:
+            return None
+        filterset = PaymentRollupFilter(request.query_params, queryset=PaymentDailyRollup.objects.all())
+        if not filterset.is_valid():
+            return None
+        return filterset.qs
+
     def get_queryset(self):
         """
         Ограничиваем доступ: пользователь видит только свои платежи.
@@ -251,11 +471,88 @@ class PaymentViewSet(viewsets.ModelViewSet):
             return Payment.objects.none()
 
         user = self.request.user
+        # Данные для вложенных user_email, course_detail и lesson_detail забираем одним JOIN
+        # (при шардировании — отдельными запросами)
+        queryset = with_related(Payment.objects.all())
 
         if user.is_staff or user.is_superuser:
-            return Payment.objects.all()
+            return queryset
         else:
-            return Payment.objects.filter(user=user)
+            return queryset.filter(user=user)
+
+    def get_archive_queryset(self):
+        """Архивные платежи с теми же правами доступа, что и get_queryset"""
+        user = self.request.user
+        queryset = ArchivedPayment.objects.select_related('user', 'paid_course', 'paid_lesson')
+        if user.is_staff or user.is_superuser:
+            return queryset
+        return queryset.filter(user=user)
+
+    def filter_archive_queryset(self):
+        """
+        Архив с теми же фильтрами, поиском и сортировкой, что и у горячей таблицы.
+        DjangoFilterBackend проверяет модель queryset, поэтому PaymentFilter применяем напрямую.
+        """
+        filterset = PaymentFilter(self.request.query_params, queryset=self.get_archive_queryset(), request=self.request)
+        if not filterset.is_valid():
+            raise ValidationError(filterset.errors)
+        queryset = filterset.qs
+        for backend in (filters.OrderingFilter, PaymentSearchFilter):
+            queryset = backend().filter_queryset(self.request, queryset, self)
+        return queryset
+
+    def period_reaches_archive(self):
+        """Уходит ли фильтр payment_date_from в архивный период"""
+        value = self.request.query_params.get('payment_date_from')
+        if not value:
+            return False
+        try:
+            date_from = forms.DateField().clean(value)
+        except forms.ValidationError:
+            return False
+        return reaches_archive(date_from)
+
+    def scatter_queryset(self, queryset):
+        """
+        Части выборки по базам платежей: у пользователя — только его шард,
+        у администратора — все шарды (без шардирования — одна часть)
+        """
+        user = self.request.user
+        if user.is_staff or user.is_superuser:
+            return scatter(queryset)
+        return scatter(queryset, user.pk)
+
+    def filter_queryset(self, queryset):
+        """
+        Фильтры применяются к каждому шарду; для списков, выгрузки и аналитики,
+        если период уходит в архив, прозрачно подмешиваются архивные платежи.
+        Несколько частей объединяются в MergedQuerySet с общей сортировкой.
+        """
+        parts = []
+        for part in self.scatter_queryset(queryset):
+            parts.append(super().filter_queryset(part))
+        if self.action in ('list', 'export', 'analytics') and self.period_reaches_archive():
+            parts.append(self.filter_archive_queryset())
+        if len(parts) == 1:
+            return parts[0]
+        return MergedQuerySet(parts)
+
+    def get_object(self):
+        """Платеж по ID: ищем в доступных шардах, для просмотра — и в архиве"""
+        queryset = self.filter_queryset(self.get_queryset())
+        parts = list(queryset.parts) if isinstance(queryset, MergedQuerySet) else [queryset]
+        if self.action == 'retrieve':
+            parts.append(self.get_archive_queryset())
+
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        for part in parts:
+            try:
+                payment = get_object_or_404(part, **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+            except Http404:
+                continue
+            self.check_object_permissions(self.request, payment)
+            return payment
+        raise Http404
 
     def perform_create(self, serializer):
         """При создании платежа автоматически устанавливаем текущего пользователя"""
@@ -283,6 +580,8 @@ class UserViewSet(viewsets.ModelViewSet):
             permission_classes = [IsAuthenticated, IsNotModerator, IsOwner]
         elif self.action in ['update', 'partial_update', 'retrieve']:
             permission_classes = [IsAuthenticated, IsOwnerOrModerator]
+        elif self.action == 'bulk_import':
+            permission_classes = [IsAuthenticated, IsAdminUser]
         else:  # list
             permission_classes = [IsAuthenticated]
         return [permission() for permission in permission_classes]
@@ -297,11 +596,16 @@ class UserViewSet(viewsets.ModelViewSet):
         if not user.is_authenticated:
             return User.objects.none()
 
+        queryset = User.objects.all()
+        if 'spending' in requested_expansions(self.request):
+            # Сводка трат — одна строка на пользователя, забираем ее тем же запросом
+            queryset = queryset.select_related('spending_summary')
+
         if user.is_staff or user.is_superuser:
-            return User.objects.all()
+            return queryset
         else:
             # Пользователи видят только свой профиль через retrieve
-            return User.objects.filter(id=user.id)
+            return queryset.filter(id=user.id)
 
     @swagger_auto_schema(
         operation_summary="Получить список пользователей",
@@ -391,7 +695,7 @@ class UserViewSet(viewsets.ModelViewSet):
             400: "Неверные данные"
         }
     )
-    @action(detail=False, methods=['post'], permission_classes=[AllowAny])
+    @action(detail=False, methods=['post'], permission_classes=[AllowAny], throttle_classes=[RegisterRateThrottle])
     def registration(self, request):
         """Эндпоинт для регистрации пользователя"""
         serializer = UserRegistrationSerializer(data=request.data)
@@ -419,6 +723,8 @@ class UserViewSet(viewsets.ModelViewSet):
         ### Особенности:
         - Используйте /api/users/me/ вместо /api/users/{id}/
         - Автоматически работает с профилем текущего пользователя
+        - ?expand=spending добавляет сводку трат: сумму и число подтвержденных платежей,
+          дату последнего платежа и разбивку по способам оплаты
         """,
         methods=['get', 'put', 'patch']
     )
@@ -436,15 +742,41 @@ class UserViewSet(viewsets.ModelViewSet):
     @swagger_auto_schema(
         operation_summary="Получить платежи пользователя",
         operation_description="""
-        Возвращает все платежи указанного пользователя.
+        Возвращает платежи указанного пользователя постранично.
 
         ### Права доступа:
         - Администраторы: могут просматривать платежи любого пользователя
         - Владелец профиля: может просматривать свои платежи
         - Обычные пользователи: не могут просматривать чужие платежи
+
+        ### Пагинация:
+        - Курсорная по дате оплаты: ссылки next/previous содержат параметр cursor
+        - page_size: размер страницы (по умолчанию 10, максимум 50)
+        - ordering: -payment_date (по умолчанию, сначала новые) или payment_date
+
+        ### Фильтрация:
+        - Те же параметры, что у списка платежей: paid_course, paid_lesson, payment_method,
+          payment_date_from, payment_date_to, amount_min, amount_max
         """,
+        manual_parameters=[
+            openapi.Parameter('cursor', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description="Курсор страницы из ссылок next/previous"),
+            openapi.Parameter('page_size', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description="Размер страницы (максимум 50)"),
+            openapi.Parameter('ordering', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              enum=['-payment_date', 'payment_date']),
+            openapi.Parameter('paid_course', openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+            openapi.Parameter('paid_lesson', openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+            openapi.Parameter('payment_method', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              enum=['cash', 'transfer']),
+            openapi.Parameter('payment_date_from', openapi.IN_QUERY, type=openapi.TYPE_STRING, format='date'),
+            openapi.Parameter('payment_date_to', openapi.IN_QUERY, type=openapi.TYPE_STRING, format='date'),
+            openapi.Parameter('amount_min', openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+            openapi.Parameter('amount_max', openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+        ],
         responses={
             200: PaymentSerializer(many=True),
+            400: "Неверные параметры фильтрации",
             401: "Пользователь не аутентифицирован",
             403: "Вы можете просматривать только свои платежи",
             404: "Пользователь не найден"
@@ -461,11 +793,90 @@ class UserViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        payments = user.payments.all()
-        serializer = PaymentSerializer(payments, many=True)
-        return Response(serializer.data)
+        # Роутер направляет user.payments в шард пользователя
+        filterset = PaymentFilter(request.query_params, queryset=with_related(user.payments.all()), request=request)
+        if not filterset.is_valid():
+            raise ValidationError(filterset.errors)
+
+        paginator = PaymentCursorPagination()
+        page = paginator.paginate_queryset(filterset.qs, request, view=self)
+        serializer = PaymentSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @swagger_auto_schema(
+        operation_summary="Массовый импорт пользователей",
+        operation_description="""
+        Импортирует пользователей из CSV или NDJSON файла.
+
+        ### Права доступа:
+        - Только администраторы
+
+        ### Формат файла:
+        - Колонки/ключи: email, password, first_name, last_name, phone, city
+        - Формат определяется по расширению (.csv, .ndjson, .jsonl) или параметром format
+
+        ### Особенности:
+        - Пароли хешируются параллельно в пуле процессов
+        - Пользователи сохраняются пачками через bulk_create
+        - Занятые email не прерывают импорт, а возвращаются в списке duplicates
+        """,
+        manual_parameters=[
+            openapi.Parameter(
+                'file',
+                openapi.IN_FORM,
+                description="CSV или NDJSON файл с пользователями",
+                type=openapi.TYPE_FILE,
+                required=True
+            ),
+            openapi.Parameter(
+                'format',
+                openapi.IN_FORM,
+                description="Формат файла",
+                type=openapi.TYPE_STRING,
+                enum=['csv', 'ndjson']
+            ),
+        ],
+        responses={
+            200: "Отчет об импорте",
+            400: "Файл не передан или неверный формат",
+            401: "Пользователь не аутентифицирован",
+            403: "Только администраторы могут импортировать пользователей"
+        }
+    )
+    @action(
+        detail=False,
+        methods=['post'],
+        url_path='import',
+        permission_classes=[IsAuthenticated, IsAdminUser],
+        parser_classes=[MultiPartParser],
+    )
+    # Импорт фиксирует пользователей пачками: прерывание по сроку оставило бы его на середине
+    @deadline_budget(NO_DEADLINE)
+    def bulk_import(self, request):
+        """Массовый импорт пользователей из файла"""
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response(
+                {"error": "Не передан файл"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        file_format = request.data.get('format') or detect_format(upload.name)
+        if file_format not in FORMATS:
+            return Response(
+                {"error": f"Неизвестный формат: {file_format}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        report = import_users(
+            read_rows(open_text(upload), file_format),
+            batch_size=DEFAULT_BATCH_SIZE,
+            workers=settings.USER_IMPORT_WORKERS,
+        )
+        return Response(report.as_dict())
 
     def get_object(self):
         """Возвращает текущего пользователя или объект по ID"""
         if self.kwargs.get('pk') == 'me':
             return self.request.user
+        return super().get_object()